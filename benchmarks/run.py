@@ -0,0 +1,520 @@
+"""Benchmarks for rtools discovery and install paths.
+
+Runs on any platform: the registry, Win32 calls, R and the GitHub API are
+replaced by the local stand-ins in `benchmarks.standins`. From the
+repository root:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json --threshold 0.25
+
+With --baseline, cases whose median time regressed by more than the
+threshold are reported, and the exit status is 1.
+"""
+import argparse
+import getpass
+import gzip
+import hashlib
+import importlib
+import json
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict
+
+from . import standins
+
+standins.install()
+
+from rtools import config  # noqa: E402
+from rtools import (  # noqa: E402
+    delta, github_release, probe, repository, rpath, snapshot)
+from rtools.doctor import doctor  # noqa: E402
+from rtools.integrity import sha256_file  # noqa: E402
+from rtools.messages import collect  # noqa: E402
+
+# rtools.install_package is shadowed by the function of the same name,
+# import_module returns the module
+install_module = importlib.import_module('rtools.install_package')
+
+R_CORE = "SOFTWARE\\R-core\\R"
+PROFILE_LIST = "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion\\ProfileList"
+
+SIZES = {
+    'full': {'versions': 20, 'profiles': 500, 'packages': 1000,
+             'description_lines': 5000, 'download_mb': 32},
+    'quick': {'versions': 5, 'profiles': 50, 'packages': 100,
+              'description_lines': 500, 'download_mb': 4},
+}
+
+CASES = OrderedDict()
+# cases timing discovery, whose caches are dropped before each repeat
+COLD_CASES = set()
+
+
+def case(name, cold=False):
+    """Register a benchmark case. The decorated function takes the work
+    directory and sizes, prepares its fixtures, and returns the callable
+    to time, and optionally a function of the median time returning extra
+    metrics. With **cold**, the discovery caches are dropped before each
+    repeat, so the lookups are timed rather than the caches."""
+    def decorator(func):
+        CASES[name] = func
+        if cold:
+            COLD_CASES.add(name)
+        return func
+    return decorator
+
+
+def make_r_home(root, version):
+    r_home = os.path.join(root, 'R', 'R-{}'.format(version))
+    os.makedirs(os.path.join(r_home, 'bin', 'x64'))
+    os.makedirs(os.path.join(r_home, 'library'))
+    with open(os.path.join(r_home, 'bin', 'x64', 'R.dll'), 'wb') as f:
+        # just the PE header of an x64 DLL
+        f.write(b'MZ' + b'\0' * 58 + struct.pack('<L', 64) + b'PE\0\0' +
+                struct.pack('<H', 0x8664))
+    return r_home
+
+
+def make_library(path, packages, binding_version=None):
+    for pos in range(packages):
+        os.makedirs(os.path.join(path, 'pkg{:05d}'.format(pos)))
+    if binding_version:
+        write_description(os.path.join(path, 'arcgisbinding'),
+                          binding_version)
+
+
+def write_description(package_dir, version, extra_lines=0):
+    if not os.path.exists(package_dir):
+        os.makedirs(package_dir)
+    with open(os.path.join(package_dir, 'DESCRIPTION'), 'w') as f:
+        f.write("Package: arcgisbinding\n")
+        for pos in range(extra_lines):
+            f.write("Field{}: value {}\n".format(pos, pos))
+        f.write("Version: {}\n".format(version))
+
+
+def setup_registry(root, versions, profiles, current=True):
+    """Register R versions under HKLM, and user profiles, the calling
+    user first so their hive is found.
+
+    Returns: R home of the most recent version."""
+    standins.registry.reset()
+    users = [getpass.getuser()] + [
+        'user{:05d}'.format(pos) for pos in range(profiles - 1)]
+    for (pos, user) in enumerate(users):
+        sid = 'S-1-5-21-1000-{}'.format(pos)
+        standins.registry.set(
+            standins.HKEY_LOCAL_MACHINE, '{}\\{}'.format(PROFILE_LIST, sid),
+            'ProfileImagePath', 'C:\\Users\\{}'.format(user))
+        standins.registry.set(standins.HKEY_USERS, sid, 'placeholder', '')
+
+    r_home = None
+    for pos in range(versions):
+        version = '3.{}.{}'.format(pos // 10, pos % 10)
+        r_home = make_r_home(root, version)
+        standins.registry.set(
+            standins.HKEY_LOCAL_MACHINE, '{}\\{}'.format(R_CORE, version),
+            'InstallPath', r_home)
+    if current:
+        standins.registry.set(
+            standins.HKEY_LOCAL_MACHINE, R_CORE, 'Current Version', version)
+        standins.registry.set(
+            standins.HKEY_LOCAL_MACHINE, R_CORE, 'InstallPath', r_home)
+    return r_home
+
+
+def reset_environment(root):
+    for var in ('R_HOME', 'R_LIBS', 'R_LIBS_USER', 'R_LIBS_SITE'):
+        os.environ.pop(var, None)
+    documents = os.path.join(root, 'Documents')
+    if not os.path.exists(documents):
+        os.makedirs(documents)
+    os.environ['R_USER'] = documents
+    os.environ['TMPDIR'] = tempfile.gettempdir()
+
+
+@case('r_reg_value_walk', cold=True)
+def bench_reg_walk(root, sizes):
+    # no top-level values, forcing the walk over each version key
+    setup_registry(root, sizes['versions'], sizes['profiles'], current=False)
+    return lambda: rpath.r_reg_value('dict')
+
+
+@case('r_version', cold=True)
+def bench_r_version(root, sizes):
+    setup_registry(root, sizes['versions'], sizes['profiles'])
+    return lambda: rpath.r_version()
+
+
+@case('r_all_lib_paths', cold=True)
+def bench_all_lib_paths(root, sizes):
+    r_home = setup_registry(root, sizes['versions'], sizes['profiles'])
+    for var in ('R_LIBS_USER', 'R_LIBS'):
+        os.environ[var] = os.path.join(root, var)
+        make_library(os.environ[var], sizes['packages'])
+    make_library(os.path.join(r_home, 'library'), sizes['packages'])
+    return lambda: rpath.r_all_lib_paths()
+
+
+@case('r_pkg_path', cold=True)
+def bench_pkg_path(root, sizes):
+    r_home = setup_registry(root, sizes['versions'], sizes['profiles'])
+    for var in ('R_LIBS_USER', 'R_LIBS'):
+        os.environ[var] = os.path.join(root, var)
+        make_library(os.environ[var], sizes['packages'])
+    # the package is only in the last library searched
+    make_library(os.path.join(r_home, 'library'), sizes['packages'],
+                 binding_version='1.0.1.244')
+    return lambda: rpath.r_pkg_path()
+
+
+@case('discovery_snapshot')
+def bench_discovery_snapshot(root, sizes):
+    # a new process: in-process caches empty, snapshot file written by the
+    # last one
+    setup_registry(root, sizes['versions'], sizes['profiles'])
+    config.DISCOVERY_SNAPSHOT = True
+
+    def run():
+        rpath._clear_caches()
+        snapshot.reset()
+        standins.registry.opened = 0
+        rpath.r_reg_value('dict')
+        rpath.r_all_lib_paths()
+        rpath.arcgis_products()
+
+    def metrics(median_s):
+        return {'keys_opened': standins.registry.opened}
+
+    return (run, metrics)
+
+
+@case('r_pkg_version_description', cold=True)
+def bench_description(root, sizes):
+    r_home = setup_registry(root, 1, 1)
+    write_description(os.path.join(r_home, 'library', 'arcgisbinding'),
+                      '1.0.1.244', sizes['description_lines'])
+    return lambda: rpath.r_pkg_version()
+
+
+@case('doctor', cold=True)
+def bench_doctor(root, sizes):
+    setup_registry(root, sizes['versions'], sizes['profiles'])
+    for version in ('3.0.1', '3.0.4'):
+        write_description(os.path.join(
+            root, 'R', 'R-{}'.format(version), 'library', 'arcgisbinding'),
+            '1.0.1.244')
+
+    return lambda: doctor()
+
+
+@case('save_url_download')
+def bench_download(root, sizes):
+    size = sizes['download_mb'] * 1024 * 1024
+    zip_path = os.path.join(root, 'arcgisbinding_1.0.1.244.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr('arcgisbinding/libs/x64/payload.bin', os.urandom(size))
+    server = standins.ReleaseServer()
+    latest = server.publish('v1.0.1.244', zip_path)
+    github_release.latest_url = latest
+    download_url = github_release.release_info()[0]
+    output_path = os.path.join(root, 'download.zip')
+
+    def run():
+        with collect():
+            github_release.save_url(download_url, output_path)
+
+    def metrics(median_s):
+        return {'throughput_mb_s': round(
+            os.path.getsize(zip_path) / 1024.0 / 1024.0 / median_s, 1)}
+    return (run, metrics)
+
+
+@case('delta_download')
+def bench_delta(root, sizes):
+    previous = os.path.join(root, 'previous', 'arcgisbinding_1.0.1.244.zip')
+    latest = os.path.join(root, 'arcgisbinding_1.0.1.300.zip')
+    os.makedirs(os.path.dirname(previous))
+    members = 100
+    member_size = sizes['download_mb'] * 1024 * 1024 // members
+    # incompressible members, two of which change between releases
+    contents = [os.urandom(member_size) for _ in range(members)]
+    for (path, changed) in ((previous, ()), (latest, (7, 42))):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for pos in range(members):
+                data = os.urandom(member_size) if pos in changed else \
+                    contents[pos]
+                zf.writestr('arcgisbinding/libs/file{:03d}'.format(pos), data)
+    server = standins.ReleaseServer()
+    server.publish('v1.0.1.300', latest)
+    url = '{}/download/{}'.format(server.url, os.path.basename(latest))
+    output_path = os.path.join(root, 'delta.zip')
+    config.DELTA_UPDATES = True
+
+    def run():
+        standins.ReleaseServer.reset_sent()
+        with collect():
+            github_release.fetch_release(url, output_path)
+
+    def metrics(median_s):
+        return {'downloaded_kb': standins.ReleaseServer.sent() // 1024,
+                'full_kb': os.path.getsize(latest) // 1024}
+
+    os.environ['LOCALAPPDATA'] = root
+    delta.cache_artifact(previous)
+    return (run, metrics)
+
+
+def _stand_in_execute_r(command='Rcmd', *args):
+    """Installs package zips like `Rcmd INSTALL` would, by extracting them
+    into the library given with --library, or the highest-priority
+    library."""
+    library = rpath.r_lib_path()
+    package_paths = []
+    for arg in args[1:]:
+        if arg.startswith('--library='):
+            library = arg[len('--library='):]
+        else:
+            package_paths.append(arg)
+    for package_path in package_paths:
+        with zipfile.ZipFile(package_path) as zf:
+            zf.extractall(library)
+    probe.invalidate()
+    return 0
+
+
+@case('install_package')
+def bench_install(root, sizes):
+    r_home = setup_registry(root, 2, sizes['profiles'])
+    make_library(os.path.join(r_home, 'library'), sizes['packages'])
+    zip_path = os.path.join(root, 'arcgisbinding_1.0.1.244.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('arcgisbinding/DESCRIPTION',
+                    'Package: arcgisbinding\nVersion: 1.0.1.244\n')
+        zf.writestr('arcgisbinding/libs/x64/rarcproxy_pro.dll',
+                    os.urandom(1024 * 1024))
+    server = standins.ReleaseServer()
+    github_release.latest_url = server.publish('v1.0.1.244', zip_path)
+
+    arcgis_dir = os.path.join(root, 'ArcGIS', 'Pro')
+    os.makedirs(arcgis_dir)
+    config.ARCGIS_INSTALL_INFO = {
+        'ProductName': 'ArcGISPro', 'Version': '2.9', 'InstallDir': arcgis_dir}
+    install_module.execute_r = _stand_in_execute_r
+
+    def run():
+        with collect():
+            report = install_module.install_package(overwrite=True, force=True)
+        failed = [step.name for (step, status) in report
+                  if status == 'failed']
+        if failed:
+            raise RuntimeError("install steps failed: {}".format(failed))
+    return run
+
+
+@case('install_local_zip')
+def bench_install_local(root, sizes):
+    """Offline install from a zip beside the toolbox, with a sha256
+    sidecar to check it against."""
+    setup_registry(root, 2, sizes['profiles'])
+    zip_path = os.path.join(root, 'offline', 'arcgisbinding_1.0.1.244.zip')
+    os.makedirs(os.path.dirname(zip_path))
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('arcgisbinding/DESCRIPTION',
+                    'Package: arcgisbinding\nVersion: 1.0.1.244\n')
+        zf.writestr('arcgisbinding/libs/x64/rarcproxy_pro.dll',
+                    os.urandom(sizes['download_mb'] * 1024 * 1024))
+    with open(zip_path + '.sha256', 'w') as f:
+        f.write("{}  {}\n".format(sha256_file(zip_path),
+                                  os.path.basename(zip_path)))
+    server = standins.ReleaseServer()
+    github_release.latest_url = server.publish('v1.0.1.244', zip_path)
+
+    arcgis_dir = os.path.join(root, 'ArcGIS', 'Pro')
+    os.makedirs(arcgis_dir)
+    config.ARCGIS_INSTALL_INFO = {
+        'ProductName': 'ArcGISPro', 'Version': '2.9', 'InstallDir': arcgis_dir}
+    os.environ['LOCALAPPDATA'] = os.path.join(root, 'appdata')
+    install_module.execute_r = _stand_in_execute_r
+
+    def run():
+        saved = install_module.local_package_zip
+        install_module.local_package_zip = lambda: zip_path
+        try:
+            with collect():
+                report = install_module.install_package(
+                    overwrite=True, force=True)
+        finally:
+            install_module.local_package_zip = saved
+        failed = [step.name for (step, status) in report
+                  if status == 'failed']
+        if failed:
+            raise RuntimeError("install steps failed: {}".format(failed))
+    return run
+
+
+@case('repository_install')
+def bench_repository(root, sizes):
+    """Resolve, download and install the package and 30 dependencies from
+    a repository answering after 20ms, into an empty library."""
+    server = standins.ReleaseServer()
+    server.set_delay(0.02)
+    contrib = '/bin/windows/contrib/4.1'
+    names = ['dep{:02d}'.format(pos) for pos in range(30)]
+    records = []
+    for (pos, name) in enumerate(names + ['arcgisbinding']):
+        if name == 'arcgisbinding':
+            imports = ', '.join(names[:10])
+        else:
+            # each of the first ten needs two of the others
+            imports = ', '.join(names[10 + 2 * pos:12 + 2 * pos]) \
+                if pos < 10 else ''
+        zip_path = os.path.join(root, '{}_1.0-1.zip'.format(name))
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.writestr('{}/DESCRIPTION'.format(name),
+                        'Package: {}\nVersion: 1.0-1\n'.format(name))
+            zf.writestr('{}/libs/x64/{}.dll'.format(name, name),
+                        os.urandom(256 * 1024))
+        with open(zip_path, 'rb') as f:
+            data = f.read()
+        server.serve('{}/{}'.format(contrib, os.path.basename(zip_path)),
+                     data, 'application/zip')
+        records.append('Package: {}\nVersion: 1.0-1\nDepends: R (>= 4.0), '
+                       'methods\nImports: {}\nMD5sum: {}\n'.format(
+                           name, imports, hashlib.md5(data).hexdigest()))
+    server.serve(contrib + '/PACKAGES.gz',
+                 gzip.compress('\n'.join(records).encode('utf-8')))
+    os.environ['LOCALAPPDATA'] = os.path.join(root, 'appdata')
+    repository.execute_r = _stand_in_execute_r
+    library = os.path.join(root, 'library')
+
+    def run():
+        shutil.rmtree(library, ignore_errors=True)
+        shutil.rmtree(os.path.join(root, 'appdata'), ignore_errors=True)
+        installed = repository.install_from_repositories(
+            ['arcgisbinding'], library, '4.1.2', [library],
+            repositories=[server.url])
+        if installed is None or len(installed) != 31:
+            raise RuntimeError("repository install failed: {}".format(
+                installed))
+    return run
+
+
+def measure(func, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times
+
+
+def run_cases(names, sizes, repeat):
+    results = OrderedDict()
+    for name in names:
+        root = tempfile.mkdtemp(prefix='rtools-bench-')
+        saved_env = dict(os.environ)
+        try:
+            reset_environment(root)
+            config.ALLOW_ARCPY = False
+            # cases time the lookups themselves, see discovery_snapshot
+            config.DISCOVERY_SNAPSHOT = False
+            config.DELTA_UPDATES = False
+            config.DISCOVERY_SNAPSHOT_FILE = os.path.join(
+                root, 'snapshot', snapshot.SNAPSHOT_NAME)
+            snapshot.reset()
+            config.ARCGIS_INSTALL_INFO = {
+                'ProductName': 'ArcGISPro', 'Version': '2.9',
+                'InstallDir': root}
+            prepared = CASES[name](root, sizes)
+            if isinstance(prepared, tuple):
+                (func, metrics) = prepared
+            else:
+                (func, metrics) = (prepared, None)
+            setup = probe.invalidate if name in COLD_CASES else None
+            func()  # warm up
+            times = measure(func, repeat, setup)
+            median = times[len(times) // 2]
+            result = OrderedDict((
+                ('median_ms', round(median * 1e3, 3)),
+                ('min_ms', round(times[0] * 1e3, 3)),
+                ('max_ms', round(times[-1] * 1e3, 3)),
+                ('repeat', repeat),
+            ))
+            if metrics:
+                result.update(metrics(median))
+            results[name] = result
+            print("{:<28} median {:>10.3f} ms  min {:>10.3f} ms".format(
+                name, result['median_ms'], result['min_ms']))
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Find cases whose median regressed beyond the threshold.
+
+    Returns: list of (case, baseline ms, current ms) tuples."""
+    regressions = []
+    for (name, result) in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base and result['median_ms'] > base['median_ms'] * (1 + threshold):
+            regressions.append((name, base['median_ms'], result['median_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run', description=__doc__.split('\n')[0])
+    parser.add_argument('cases', nargs='*', metavar='case',
+                        help="cases to run, all by default: {}".format(
+                            ", ".join(CASES)))
+    parser.add_argument('--quick', action='store_true',
+                        help="use small fixtures, for a fast check")
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare with")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="allowed median slowdown, as a fraction")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error("unknown cases: {}".format(", ".join(unknown)))
+
+    size_name = 'quick' if args.quick else 'full'
+    results = run_cases(args.cases or list(CASES), SIZES[size_name],
+                        args.repeat)
+    document = {'sizes': size_name, 'python': platform.python_version(),
+                'platform': platform.platform(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('sizes') != size_name:
+            print("Baseline was recorded with {} sizes, not {}.".format(
+                baseline.get('sizes'), size_name))
+        regressions = compare(results, baseline, args.threshold)
+        for (name, before, after) in regressions:
+            print("REGRESSION {}: {:.3f} ms -> {:.3f} ms (+{:.0%})".format(
+                name, before, after, after / before - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""Local stand-ins for the Windows registry, the Win32 DLLs and the
+GitHub API, so that rtools can be exercised on any platform.
+
+`install()` must be called before rtools is imported.
+"""
+import builtins
+import ctypes
+import errno
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+HKEY_USERS = 0x80000003
+HKEY_CURRENT_USER = 0x80000001
+HKEY_LOCAL_MACHINE = 0x80000002
+
+# an arbitrary FILETIME, 100ns intervals since 1601
+DEFAULT_FILETIME = 132000000000000000
+
+
+class RegistryKey(object):
+    """A registry key, with case-insensitive subkey names like Windows."""
+
+    def __init__(self):
+        self.subkeys = {}
+        self.names = []
+        self.values = {}
+        self.last_write = DEFAULT_FILETIME
+
+    def child(self, name, create=False):
+        key = self.subkeys.get(name.lower())
+        if key is None:
+            if not create:
+                raise FileNotFoundError(
+                    errno.ENOENT, "The system cannot find the file specified")
+            key = RegistryKey()
+            self.subkeys[name.lower()] = key
+            self.names.append(name)
+            self.last_write += 1
+        return key
+
+    def find(self, path, create=False):
+        key = self
+        for part in path.split("\\"):
+            if part:
+                key = key.child(part, create)
+        return key
+
+
+class RegistryHandle(object):
+    """An open key, as returned by winreg.OpenKey."""
+
+    def __init__(self, key):
+        self.key = key
+        self.closed = False
+
+    def Close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+
+class Registry(object):
+    """An in-memory registry, exposed as a winreg-compatible module."""
+
+    def __init__(self):
+        self.hives = {HKEY_USERS: RegistryKey(),
+                      HKEY_CURRENT_USER: RegistryKey(),
+                      HKEY_LOCAL_MACHINE: RegistryKey()}
+        self.opened = 0
+
+    def reset(self):
+        """Remove all keys and values."""
+        self.__init__()
+
+    def _key(self, key):
+        if isinstance(key, RegistryHandle):
+            return key.key
+        return self.hives[key]
+
+    def set(self, hive, path, name, value):
+        key = self.hives[hive].find(path, create=True)
+        key.values[name] = value
+        key.last_write += 1
+
+    def module(self):
+        registry = self
+        winreg = types.ModuleType(str('winreg'))
+        winreg.HKEY_USERS = HKEY_USERS
+        winreg.HKEY_CURRENT_USER = HKEY_CURRENT_USER
+        winreg.HKEY_LOCAL_MACHINE = HKEY_LOCAL_MACHINE
+        winreg.KEY_QUERY_VALUE = 0x0001
+        winreg.KEY_SET_VALUE = 0x0002
+        winreg.KEY_NOTIFY = 0x0010
+        winreg.KEY_READ = 0x20019
+        winreg.KEY_WRITE = 0x20006
+        winreg.KEY_ALL_ACCESS = 0xF003F
+        winreg.KEY_WOW64_64KEY = 0x0100
+        winreg.KEY_WOW64_32KEY = 0x0200
+        winreg.REG_SZ = 1
+        winreg.REG_EXPAND_SZ = 2
+        winreg.HKEYType = RegistryHandle
+
+        def OpenKey(key, sub_key, reserved=0, access=winreg.KEY_READ):
+            registry.opened += 1
+            return RegistryHandle(registry._key(key).find(sub_key))
+
+        def CreateKeyEx(key, sub_key, reserved=0, access=winreg.KEY_WRITE):
+            registry.opened += 1
+            return RegistryHandle(registry._key(key).find(sub_key, True))
+
+        def QueryValueEx(handle, name):
+            values = registry._key(handle).values
+            if name not in values:
+                raise FileNotFoundError(
+                    errno.ENOENT, "The system cannot find the file specified")
+            return (values[name], winreg.REG_SZ)
+
+        def SetValueEx(handle, name, reserved, value_type, value):
+            key = registry._key(handle)
+            key.values[name] = value
+            key.last_write += 1
+
+        def EnumKey(handle, index):
+            names = registry._key(handle).names
+            if index >= len(names):
+                raise OSError(errno.ENOENT, "No more data is available")
+            return names[index]
+
+        def QueryInfoKey(handle):
+            key = registry._key(handle)
+            return (len(key.names), len(key.values), key.last_write)
+
+        def CloseKey(handle):
+            handle.Close()
+
+        for func in (OpenKey, CreateKeyEx, QueryValueEx, SetValueEx,
+                     EnumKey, QueryInfoKey, CloseKey):
+            setattr(winreg, func.__name__, func)
+        winreg.OpenKeyEx = OpenKey
+        return winreg
+
+
+class _Function(object):
+    """A Win32 function which accepts anything and returns a constant."""
+
+    def __init__(self, result):
+        self.result = result
+
+    def __call__(self, *args):
+        return self.result
+
+
+class _Library(object):
+    # results for the functions that rtools checks
+    results = {'GetModuleHandleW': None, 'IsUserAnAdmin': 1}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        func = _Function(self.results.get(name, 1))
+        setattr(self, name, func)
+        return func
+
+
+class _WinDLL(object):
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        library = _Library()
+        setattr(self, name, library)
+        return library
+
+    def LoadLibrary(self, name):
+        return self.kernel32
+
+
+registry = Registry()
+
+
+def install():
+    """Install the stand-ins in place of the Windows-only modules."""
+    if not hasattr(builtins, 'WindowsError'):
+        builtins.WindowsError = OSError
+    if not hasattr(ctypes, 'WinError'):
+        ctypes.WinError = lambda code=None, descr=None: OSError(code, descr)
+    if not hasattr(ctypes, 'windll'):
+        ctypes.windll = _WinDLL()
+    sys.modules['winreg'] = registry.module()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    routes = {}
+    # bytes of response bodies sent, to measure delta updates
+    sent = 0
+    # seconds before each response, standing in for network latency
+    delay = 0
+
+    def do_GET(self):
+        if self.delay:
+            time.sleep(self.delay)
+        route = self.routes.get(self.path)
+        if route is None:
+            self.send_error(404)
+            return
+        (content_type, body) = route
+        byte_range = self._range(len(body))
+        if byte_range:
+            (start, end) = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end - 1, len(body)))
+            body = body[start:end]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        _Handler.sent += len(body)
+
+    def _range(self, size):
+        """Parse a single Range header, as (start, end) offsets."""
+        header = self.headers.get('Range', '')
+        if not header.startswith('bytes=') or ',' in header:
+            return None
+        (first, last) = header[len('bytes='):].split('-')
+        if not first:
+            return (max(0, size - int(last)), size)
+        return (int(first), min(size, int(last) + 1) if last else size)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ReleaseServer(object):
+    """A local HTTP server, standing in for the GitHub releases API and
+    package repositories."""
+
+    def __init__(self):
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, tag, zip_path):
+        """Serve a release zip, and a latest release API response for it.
+
+        Returns: URL of the latest release API response."""
+        name = os.path.basename(zip_path)
+        with open(zip_path, 'rb') as f:
+            data = f.read()
+        _Handler.routes['/download/' + name] = ('application/zip', data)
+        release = {'tag_name': tag, 'assets': [{
+            'browser_download_url': '{}/download/{}'.format(self.url, name),
+            'digest': 'sha256:' + hashlib.sha256(data).hexdigest()}]}
+        _Handler.routes['/releases/latest'] = (
+            'application/json', json.dumps(release).encode('utf-8'))
+        return self.url + '/releases/latest'
+
+    def serve(self, path, data, content_type='application/octet-stream'):
+        """Serve bytes at a path.
+
+        Returns: URL of the path."""
+        _Handler.routes[path] = (content_type, data)
+        return self.url + path
+
+    @staticmethod
+    def set_delay(seconds):
+        _Handler.delay = seconds
+
+    @staticmethod
+    def sent():
+        """Bytes of response bodies sent by all servers."""
+        return _Handler.sent
+
+    @staticmethod
+    def reset_sent():
+        _Handler.sent = 0
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,18 +1,27 @@
 
 from .config import *
+from . import logs
+from . import watch
 
 from .rpath import (
+    arcgis_products,
     arcmap_path,
     r_path,
     r_set_install,
     r_version,
+    r_home_version,
     r_version_dict,
     r_pkg_path,
     r_pkg_version,
     r_lib_path,
+    r_site_lib_path,
     r_user_lib_path,
     r_all_lib_paths,
 )
 from .bootstrap_r import execute_r
 from .install_package import install_package
-from .update_package import update_package
+from .doctor import doctor
+from .update_package import rollback_package, update_package
+from .fleet import install_fleet, install_shared, verify_fleet
+from .integrity import verify_install
+from .dedup import dedup_packages
@@ -6,19 +6,22 @@ from __future__ import absolute_import
 import os
 import subprocess
 import sys
-import arcpy
 
+from .messages import add_error, add_message, add_warning
+from .probe import invalidate
 from .rpath import r_path
+from .trace import traced
 from .utils import platform
 
 PY2 = sys.version_info[0] == 2
 
 
+@traced(args=True)
 def execute_r(command='Rcmd', *args):
     if r_install_valid():
         valid_commands = ['R', 'Rcmd', 'Rscript']
         if command not in valid_commands:
-            arcpy.AddError("Invalid R command, '{}.exe'.".format(command))
+            add_error("Invalid R command, '{}.exe'.".format(command))
             return
 
         rcommand_exe = "{}.exe".format(command)
@@ -38,15 +41,15 @@ def execute_r(command='Rcmd', *args):
 
         if r_command_valid(rcommand_path):
             command_parts = [rcommand_exe] + list(args)
-            arcpy.AddMessage(subprocess.list2cmdline(command_parts))
+            add_message(subprocess.list2cmdline(command_parts))
 
             if command is 'Rscript':
                 script_base = os.path.dirname(os.path.realpath(__file__))
                 # if we have a script, it should be the first passed arg
                 script_path = os.path.join(script_base, args[0])
                 if not os.path.exists(script_path):
-                    arcpy.AddError("Couldn't locate requested script, "
-                                   "'{}'.".format(script_path))
+                    add_error("Couldn't locate requested script, "
+                              "'{}'.".format(script_path))
                     return
                 else:
                     command_parts[1] = script_path
@@ -59,14 +62,16 @@ def execute_r(command='Rcmd', *args):
             while process.poll() is None:
                 stdout_msg = process.stdout.readline().strip()
                 if stdout_msg:
-                    arcpy.AddMessage(stdout_msg)
+                    add_message(stdout_msg)
                 stderr_msg = process.stderr.readline().strip()
                 if stderr_msg:
                     # highlight standard error as warnings
-                    arcpy.AddWarning(stderr_msg)
+                    add_warning(stderr_msg)
 
+            # R may have changed the libraries, rescan them
+            invalidate()
             if process.returncode != 0:
-                arcpy.AddWarning("R command returned non-zero exit status.")
+                add_warning("R command returned non-zero exit status.")
             return process.returncode
 
 
@@ -80,13 +85,13 @@ def path_exists(path):
 def r_install_valid():
     valid = path_exists(r_path())
     if not valid:
-        arcpy.AddError("Unable to find valid R installation. Please install R.")
+        add_error("Unable to find valid R installation. Please install R.")
     return valid
 
 
 def r_command_valid(command_path):
     valid = path_exists(command_path)
     if not valid:
-        arcpy.AddError("Unable to locate requested R command: {}".format(
+        add_error("Unable to locate requested R command: {}".format(
             command_path))
     return valid
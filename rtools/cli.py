@@ -0,0 +1,315 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import sys
+
+from . import config
+from . import trace
+from .logs import dump_recent
+from .messages import collect
+
+
+def _arcgis_info(args):
+    """ArcGIS installation details from the command line, or a JSON file
+    in the form of arcpy.GetInstallInfo()."""
+    info = None
+    if args.arcgis_info:
+        with open(args.arcgis_info) as f:
+            info = json.load(f)
+    elif args.product:
+        product_name = 'ArcGISPro' if args.product == 'Pro' else 'Desktop'
+        info = {'ProductName': product_name,
+                'Version': args.arcgis_version,
+                'InstallDir': args.install_dir}
+    return info
+
+
+def cmd_detect(args):
+    from .rpath import (
+        arcgis_install_info,
+        arcgis_products,
+        r_all_lib_paths,
+        r_lib_path,
+        r_path,
+        r_pkg_path,
+        r_pkg_version,
+        r_site_lib_path,
+        r_version,
+        r_version_dict,
+    )
+    result = {
+        'r': {
+            'version': r_version(),
+            'home': r_path(),
+            'versions': r_version_dict(),
+            'library': r_lib_path(),
+            'libraries': r_all_lib_paths(),
+            'site_library': r_site_lib_path(),
+        },
+        'package': {
+            'path': r_pkg_path(),
+            'version': r_pkg_version(),
+        },
+        'arcgis': arcgis_install_info(),
+        'arcgis_products': [dict(record._asdict())
+                            for record in arcgis_products()],
+    }
+    return (result['r']['home'] is not None, result)
+
+
+def cmd_install(args):
+    from .install_package import install_package
+    report = install_package(
+        overwrite=args.overwrite, r_library_path=args.library,
+        dry_run=args.dry_run, force=args.force, dedup=args.dedup or None)
+    steps = [{'step': step.name, 'status': status}
+             for (step, status) in report]
+    ok = all(step['status'] != 'failed' for step in steps)
+    return (ok, {'steps': steps})
+
+
+def cmd_update(args):
+    from .rpath import r_pkg_version
+    from .update_package import update_package
+    before = r_pkg_version()
+    update_package(r_library_path=args.library)
+    after = r_pkg_version()
+    return (after is not None, {'previous_version': before,
+                                'version': after,
+                                'updated': before != after})
+
+
+def cmd_rollback(args):
+    from .rpath import r_lib_path
+    from .update_package import rollback_package
+    from .versions import installed_versions
+    library = args.library or r_lib_path()
+    restored = rollback_package(r_library_path=library, version=args.version)
+    return (restored is not None, {'version': restored,
+                                   'installed': installed_versions(library)})
+
+
+def cmd_export_lock(args):
+    from .lockfile import export_lockfile
+    lock = export_lockfile(args.file, args.artifacts)
+    return (lock is not None, lock)
+
+
+def cmd_replay_lock(args):
+    from .lockfile import replay_lockfile
+    report = replay_lockfile(args.file, args.artifacts or (), args.mirror,
+                             args.dry_run)
+    steps = [{'step': step.name, 'status': status}
+             for (step, status) in report]
+    ok = all(step['status'] != 'failed' for step in steps)
+    return (ok, {'steps': steps})
+
+
+def cmd_check_update(args):
+    from .rpath import r_pkg_version
+    from .update_check import newer_available
+    installed = r_pkg_version()
+    max_age = 0 if args.refresh else None
+    (newer, record) = newer_available(installed, max_age=max_age)
+    latest = None
+    checked = None
+    if record is not None:
+        latest = record['tag'].strip('v')
+        checked = record['checked']
+    return (latest is not None, {'installed': installed, 'latest': latest,
+                                 'checked': checked,
+                                 'newer_available': newer})
+
+
+def cmd_doctor(args):
+    from .doctor import doctor
+    from .install_package import arcgis_platform, environment_problems
+
+    report = doctor(load=args.load)
+    # the default R's checks, followed by those of the machine
+    checks = report['checks'][0:1]
+    for inst in report['installations']:
+        if inst['default']:
+            checks.extend(inst['checks'])
+    checks.extend(report['checks'][1:])
+
+    (install_dir, arc_version, product) = arcgis_platform()
+    if product is not None:
+        problems = environment_problems(True, product, arc_version)
+        checks.append({'check': 'environment', 'ok': not problems,
+                       'detail': problems})
+
+    return (all(c['ok'] for c in checks),
+            {'checks': checks, 'installations': report['installations']})
+
+
+def cmd_verify(args):
+    from .fleet import verify_fleet
+    from .integrity import verify_install
+    from .rpath import r_pkg_path
+    if args.all_users:
+        users = verify_fleet(quick=args.quick)
+        ok = all(user['status'] in ('ok', 'missing') for user in users)
+        return (ok, {'users': users})
+    library = args.library
+    if library is None:
+        package_path = r_pkg_path()
+        library = os.path.dirname(package_path) if package_path else None
+    if library is None:
+        return (False, None)
+    result = verify_install(library, quick=args.quick)
+    return (result['status'] == 'ok', result)
+
+
+def cmd_dedup(args):
+    from .dedup import dedup_packages
+    result = dedup_packages(libraries=args.library, dry_run=args.dry_run,
+                            all_users=args.all_users)
+    return (not result['failed'], result)
+
+
+COMMANDS = {
+    'detect': cmd_detect,
+    'install': cmd_install,
+    'update': cmd_update,
+    'check-update': cmd_check_update,
+    'rollback': cmd_rollback,
+    'export-lock': cmd_export_lock,
+    'replay-lock': cmd_replay_lock,
+    'doctor': cmd_doctor,
+    'verify': cmd_verify,
+    'dedup': cmd_dedup,
+}
+
+
+def parser():
+    p = argparse.ArgumentParser(
+        prog='python -m rtools',
+        description="Install and inspect the R-ArcGIS bridge without "
+                    "ArcGIS. Prints a JSON report on standard output.")
+    p.add_argument('--arcgis-info', metavar='FILE',
+                   help="JSON file of ArcGIS installation details, as "
+                        "returned by arcpy.GetInstallInfo()")
+    p.add_argument('--product', choices=('Pro', 'ArcMap'),
+                   help="ArcGIS product the bridge is used with")
+    p.add_argument('--arcgis-version', help="version of the ArcGIS product")
+    p.add_argument('--install-dir', help="ArcGIS installation directory")
+    p.add_argument('--use-arcpy', action='store_true',
+                   help="import arcpy to find ArcGIS installation details")
+    p.add_argument('--verbose', action='store_true',
+                   help="also print progress messages on standard error")
+    p.add_argument('--trace', metavar='FILE',
+                   help="write timed spans as a Chrome trace to FILE, and "
+                        "a summary on standard error")
+
+    sub = p.add_subparsers(dest='command', metavar='command')
+    sub.required = True
+    sub.add_parser('detect', help="report R, library and package details")
+    install = sub.add_parser('install', help="install the package")
+    install.add_argument('--overwrite', action='store_true')
+    install.add_argument('--force', action='store_true',
+                         help="reinstall an up to date package")
+    install.add_argument('--dry-run', action='store_true',
+                         help="only report the steps that would run")
+    install.add_argument('--library', help="R library to install into")
+    install.add_argument('--dedup', action='store_true',
+                         help="afterwards, link identical package files "
+                              "across libraries")
+    update = sub.add_parser('update', help="install a newer release")
+    update.add_argument('--library', help="R library to install into")
+    rollback = sub.add_parser(
+        'rollback', help="switch back to the previously installed version")
+    rollback.add_argument('--library', help="R library holding the package")
+    rollback.add_argument('--version',
+                          help="installed version to switch to, instead")
+    export_lock = sub.add_parser(
+        'export-lock', help="write the R and package environment of this "
+                            "machine to a lockfile")
+    export_lock.add_argument('file', help="lockfile to write")
+    export_lock.add_argument('--artifacts', metavar='DIR',
+                             help="also copy the release zip into DIR")
+    replay_lock = sub.add_parser(
+        'replay-lock', help="bring this machine to the environment of a "
+                            "lockfile, skipping what already matches")
+    replay_lock.add_argument('file', help="lockfile to replay")
+    replay_lock.add_argument('--artifacts', metavar='DIR', action='append',
+                             help="directory holding release zips, may be "
+                                  "repeated")
+    replay_lock.add_argument('--mirror', metavar='URL',
+                             help="base URL serving release zips by name")
+    replay_lock.add_argument('--dry-run', action='store_true',
+                             help="only report the steps that would run")
+    check_update = sub.add_parser(
+        'check-update', help="check for a newer release, using the "
+                             "release recorded by a recent check")
+    check_update.add_argument('--refresh', action='store_true',
+                              help="always look up the latest release")
+    doctor = sub.add_parser(
+        'doctor', help="check every R installation for problems")
+    doctor.add_argument('--load', action='store_true',
+                        help="also time loading the package in each R")
+    verify = sub.add_parser(
+        'verify', help="check the installed files against the manifest "
+                       "recorded when the package was installed")
+    verify.add_argument('--library', help="R library holding the package")
+    verify.add_argument('--quick', action='store_true',
+                        help="only compare file sizes and times")
+    verify.add_argument('--all-users', action='store_true',
+                        help="check the library of every user profile")
+    dedup = sub.add_parser(
+        'dedup', help="replace identical package files across libraries "
+                      "and R versions with hard links")
+    dedup.add_argument('--library', action='append',
+                       help="R library to include, may be repeated. "
+                            "Defaults to the libraries of every R")
+    dedup.add_argument('--all-users', action='store_true',
+                       help="include the libraries of every user profile")
+    dedup.add_argument('--dry-run', action='store_true',
+                       help="only report the files that would be linked")
+    return p
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+
+    config.ALLOW_ARCPY = args.use_arcpy
+    info = _arcgis_info(args)
+    if info is not None:
+        config.ARCGIS_INSTALL_INFO = info
+
+    if args.trace:
+        trace.enable()
+
+    ok = False
+    result = None
+    with collect() as messages:
+        try:
+            (ok, result) = COMMANDS[args.command](args)
+        except SystemExit:
+            # validation failures exit, their reasons are in the messages
+            ok = False
+
+    if not ok:
+        log_path = dump_recent()
+        if log_path:
+            messages.append({'level': 'message', 'message':
+                             "Recent log messages written to {}.".format(
+                                 log_path)})
+
+    if args.verbose:
+        for msg in messages:
+            print("{}: {}".format(msg['level'], msg['message']),
+                  file=sys.stderr)
+
+    if args.trace:
+        trace.write_chrome_trace(args.trace)
+        print("\n".join(trace.summary()), file=sys.stderr)
+
+    print(json.dumps({'command': args.command, 'ok': ok, 'result': result,
+                      'messages': messages}, indent=2, sort_keys=True))
+    return 0 if ok else 1
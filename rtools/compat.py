@@ -0,0 +1,248 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from bisect import bisect_right
+from collections import namedtuple
+import functools
+import re
+
+PART_PATTERN = re.compile(r'(\d+)(.*)')
+
+# raw string: Version
+_versions = {}
+
+
+@functools.total_ordering
+class Version(object):
+    """A version such as '3.2.4', 'v1.0.1.244' or '3.2.4revised'.
+
+    Parsing stops at the first part that isn't a plain number, its text
+    is kept as the suffix: '3.2.4revised' is (3, 2, 4) with suffix
+    'revised'. Versions are ordered numerically, trailing zeros don't
+    matter, and a version with a suffix sorts after the same version
+    without one. Use `parse_version` to share parsed instances."""
+
+    __slots__ = ('raw', 'numbers', 'suffix', 'key')
+
+    def __init__(self, raw):
+        self.raw = raw
+        numbers = []
+        suffix = ''
+        for part in raw.strip().lstrip('vV').split('.'):
+            match = PART_PATTERN.match(part)
+            if not match:
+                suffix = part
+                break
+            numbers.append(int(match.group(1)))
+            if match.group(2):
+                suffix = match.group(2).strip()
+                break
+        if not numbers:
+            raise ValueError("Not a version: {!r}".format(raw))
+        self.numbers = tuple(numbers)
+        self.suffix = suffix
+        trimmed = list(numbers)
+        while len(trimmed) > 1 and trimmed[-1] == 0:
+            trimmed.pop()
+        self.key = (tuple(trimmed), bool(suffix))
+
+    def __eq__(self, other):
+        return isinstance(other, Version) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "Version({!r})".format(self.raw)
+
+    def __str__(self):
+        return self.raw
+
+    @property
+    def major(self):
+        return self.numbers[0]
+
+
+def parse_version(raw):
+    """Cached `Version` for a version string.
+
+    Returns: Version, or None if raw is None or not a version."""
+    if raw is None:
+        return None
+    if isinstance(raw, Version):
+        return raw
+    if raw not in _versions:
+        try:
+            _versions[raw] = Version(raw)
+        except ValueError:
+            _versions[raw] = None
+    return _versions[raw]
+
+
+# Compatibility between ArcGIS products, their versions, and R versions.
+#
+# Each rule applies to a product ('Pro', 'ArcMap', or None for any) and
+# half-open ranges [low, high) of ArcGIS and R versions, where None is
+# unbounded. Every matching rule applies its settings in turn, so later
+# rules override earlier ones. Rules with bounded ranges don't apply
+# when the corresponding version is unknown.
+#
+# Settings:
+#  - problem: why the combination isn't supported, None if it is.
+#  - install_method: 'release_zip', the package zip from the GitHub
+#    release, or 'repository', install.packages from r.esri.com.
+#  - link_rintegration: the package must also be linked into the ArcMap
+#    Rintegration folder.
+#  - patch_level_check: the bridge fails to load from Program Files with
+#    R patch releases such as 3.2.4revised.
+COMPATIBILITY_RULES = (
+    {'product': None, 'arcgis': (None, None), 'r': (None, None),
+     'problem': None, 'install_method': 'release_zip',
+     'link_rintegration': False, 'patch_level_check': False},
+    # R 4.0+ binaries are published to the repository
+    {'product': None, 'arcgis': (None, None), 'r': ('4', None),
+     'install_method': 'repository'},
+    # earlier versions excluded by virtue of not having Python toolbox
+    # support
+    {'product': 'ArcMap', 'arcgis': (None, '10.3.1'), 'r': (None, None),
+     'problem': "The ArcGIS R bridge requires ArcGIS 10.3.1 or later."},
+    {'product': 'Pro', 'arcgis': (None, '1.1'), 'r': (None, None),
+     'problem': "The ArcGIS R bridge requires ArcGIS Pro 1.1 or later."},
+    # at 10.3.1, the bridge must be installed at the Rintegration location
+    {'product': 'ArcMap', 'arcgis': ('10.3.1', '10.3.2'), 'r': (None, None),
+     'link_rintegration': True},
+    {'product': 'ArcMap', 'arcgis': ('10.4', '10.4.1'), 'r': (None, None),
+     'patch_level_check': True},
+    {'product': 'Pro', 'arcgis': ('1.1', '1.3'), 'r': (None, None),
+     'patch_level_check': True},
+)
+
+PRODUCTS = (None, 'Pro', 'ArcMap')
+
+Compatibility = namedtuple('Compatibility', (
+    'problem', 'install_method', 'link_rintegration', 'patch_level_check'))
+
+# representative of an unknown version
+_UNKNOWN = object()
+
+
+def _in_range(version, bounds):
+    """Whether a version lies in [low, high). The version None stands for
+    any version below all bounds."""
+    (low, high) = bounds
+    if version is _UNKNOWN:
+        return low is None and high is None
+    if low is not None and (version is None or version < low):
+        return False
+    if high is not None and version is not None and version >= high:
+        return False
+    return True
+
+
+class CompatibilityMatrix(object):
+    """Resolves compatibility rules ahead of time. The version bounds in
+    the rules split each axis into segments that all rules treat alike,
+    so a lookup is a binary search per axis and a dictionary access."""
+
+    def __init__(self, rules=COMPATIBILITY_RULES):
+        self.rules = []
+        for rule in rules:
+            rule = dict(rule)
+            for axis in ('arcgis', 'r'):
+                rule[axis] = tuple(parse_version(bound)
+                                   for bound in rule[axis])
+            self.rules.append(rule)
+
+        self._arcgis_bounds = {}
+        for product in PRODUCTS:
+            self._arcgis_bounds[product] = self._bounds('arcgis', product)
+        self._r_bounds = self._bounds('r')
+
+        self._table = {}
+        for product in PRODUCTS:
+            arcgis_segments = self._segments(self._arcgis_bounds[product])
+            for (arc_pos, arc_version) in arcgis_segments:
+                for (r_pos, r_version) in self._segments(self._r_bounds):
+                    self._table[(product, arc_pos, r_pos)] = self._resolve(
+                        product, arc_version, r_version)
+        # (product, ArcGIS version, R version) strings: Compatibility
+        self._cache = {}
+
+    def _applies(self, rule, product):
+        return rule['product'] is None or rule['product'] == product
+
+    def _bounds(self, axis, product=None):
+        bounds = set()
+        for rule in self.rules:
+            if axis == 'r' or self._applies(rule, product):
+                bounds.update(b for b in rule[axis] if b is not None)
+        return sorted(bounds)
+
+    def _segments(self, bounds):
+        """(position, representative version) of each segment: unknown,
+        below the first bound, and from each bound up to the next."""
+        return [(-1, _UNKNOWN), (0, None)] + [
+            (pos + 1, bound) for (pos, bound) in enumerate(bounds)]
+
+    def _position(self, bounds, version):
+        if version is None:
+            return -1
+        return bisect_right(bounds, version)
+
+    def _resolve(self, product, arc_version, r_version):
+        settings = {}
+        for rule in self.rules:
+            if self._applies(rule, product) and \
+                    _in_range(arc_version, rule['arcgis']) and \
+                    _in_range(r_version, rule['r']):
+                settings.update((field, rule[field])
+                                for field in Compatibility._fields
+                                if field in rule)
+        return Compatibility(**settings)
+
+    def lookup(self, product, arc_version, r_version):
+        """Compatibility of an ArcGIS product and version with an R
+        version. Versions may be None when unknown.
+
+        Returns: Compatibility tuple."""
+        cache_key = (product, arc_version, r_version)
+        result = self._cache.get(cache_key)
+        if result is None:
+            if product not in self._arcgis_bounds:
+                product = None
+            arc_pos = self._position(self._arcgis_bounds[product],
+                                     parse_version(arc_version))
+            r_pos = self._position(self._r_bounds, parse_version(r_version))
+            result = self._table[(product, arc_pos, r_pos)]
+            self._cache[cache_key] = result
+        return result
+
+
+_matrix = None
+
+
+def compatibility(product, arc_version, r_version):
+    """Look up how the bridge is installed for a product ('Pro', 'ArcMap'
+    or None when unknown), ArcGIS version and R version, and whether the
+    combination is supported. See COMPATIBILITY_RULES.
+
+    Returns: Compatibility tuple of problem, install_method,
+    link_rintegration and patch_level_check."""
+    global _matrix
+    if _matrix is None:
+        _matrix = CompatibilityMatrix()
+    return _matrix.lookup(product, arc_version, r_version)
+
+
+def install_method(r_version):
+    """How the package is installed for an R version, whatever the ArcGIS
+    product: 'release_zip' or 'repository'."""
+    return compatibility(None, None, r_version).install_method
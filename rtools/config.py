@@ -1,10 +1,106 @@
 import logging
 import os
 
-LOGGING = False
+# Log discovery and installation details to LOG_FILE: False, True for
+# everything, or a level name such as 'INFO'. Also set by the RTOOLS_LOG
+# environment variable. Call rtools.logs.configure() after changing the
+# logging settings at runtime.
+LOGGING = os.environ.get('RTOOLS_LOG') or False
 
-if LOGGING:
-    filename = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), "rtools.log")
-    logging.basicConfig(filename=filename, level=logging.DEBUG)
-    log = logging.getLogger(__name__)
+# Log file, by default rtools.log beside the rtools package.
+LOG_FILE = os.environ.get('RTOOLS_LOG_FILE') or None
+
+# Number of recent log records kept in memory, even with LOGGING off, and
+# written to rtools-failure.log in the temporary directory when an
+# installation fails. 0 disables the buffer.
+LOG_BUFFER = int(os.environ.get('RTOOLS_LOG_BUFFER') or 0)
+
+# Record timed spans of discovery, network and install phases, see
+# rtools.trace. Also enabled by setting RTOOLS_TRACE to an output path.
+TRACING = False
+
+# Seconds a recorded release lookup is trusted for, before checking
+# GitHub again, see rtools.update_check.
+UPDATE_CHECK_INTERVAL = 24 * 60 * 60
+
+# File recording the latest release, by default
+# %LOCALAPPDATA%\rtools\latest-release.json.
+UPDATE_CHECK_FILE = os.environ.get('RTOOLS_UPDATE_CHECK_FILE') or None
+
+# Keep discovery results in a per-user snapshot file, with the registry
+# key write times, directory modification times and environment they
+# depend on, so a new process reuses them when nothing changed, see
+# rtools.snapshot. The file is DISCOVERY_SNAPSHOT_FILE, by default
+# %LOCALAPPDATA%\rtools\discovery.json. Off by default, set to True to
+# opt in.
+DISCOVERY_SNAPSHOT = False
+DISCOVERY_SNAPSHOT_FILE = os.environ.get('RTOOLS_DISCOVERY_SNAPSHOT') or None
+
+# Keep discovery results, such as R installations, libraries and ArcGIS
+# products, until the registry keys or directories they came from change,
+# rather than for a few seconds, once rtools.watch.start() is called. When
+# on, the toolbox starts watching when it is loaded, for long-lived ArcGIS
+# Pro sessions. Off by default, set to True to opt in.
+WATCH_DISCOVERY = False
+
+# Update from the previous release zip, downloading only the files that
+# changed, when the release server supports Range requests, see
+# rtools.delta. Releases with a published or pinned SHA-256 digest are
+# always downloaded in full, so the digest can be checked. Off by default,
+# set to True to opt in.
+DELTA_UPDATES = False
+
+# Install each version of the package side by side within the library,
+# and select the active one with a directory link, so that updates and
+# rollbacks switch the link. Up to KEEP_VERSIONS versions are kept, see
+# rtools.versions. Libraries on volumes without link support are
+# installed into in place. Off by default, as it changes the layout of the
+# library: set to True to opt in. Libraries already holding versions side
+# by side stay that way.
+VERSIONED_INSTALLS = False
+KEEP_VERSIONS = 3
+
+# For R 4.0 and later, install the package from these repositories,
+# resolving its dependencies and downloading them at once rather than
+# leaving it to install.packages(), see rtools.repository. Repository
+# indexes are downloaded again once older than REPOSITORY_INDEX_TTL
+# seconds, and only when they changed. Set RESOLVE_DEPENDENCIES to False
+# to always use install.packages().
+RESOLVE_DEPENDENCIES = True
+R_REPOSITORIES = ['https://r.esri.com', 'https://cloud.r-project.org']
+REPOSITORY_INDEX_TTL = 60 * 60
+DOWNLOAD_WORKERS = 4
+
+# SHA-256 digest the release zip must have, for pinning a release or
+# checking a zip placed next to the toolbox for offline installation.
+# Without it, downloads are checked against the digest GitHub publishes,
+# and local zips against a zip.sha256 file beside them, when present.
+RELEASE_SHA256 = os.environ.get('RTOOLS_RELEASE_SHA256') or None
+
+# Base URL of a mirror serving release zips by file name, searched when
+# replaying a lockfile after the local directories, see rtools.lockfile.
+ARTIFACT_MIRROR = os.environ.get('RTOOLS_ARTIFACT_MIRROR') or None
+
+# Number of files hashed at once when writing or checking the manifest of
+# an installed package, see rtools.integrity.
+VERIFY_WORKERS = 8
+
+# Replace identical package files across libraries, R versions and the
+# versions kept side by side with hard links after each install, see
+# rtools.dedup. Files smaller than DEDUP_MIN_SIZE bytes are left alone,
+# NTFS keeps those within the file's record anyway.
+DEDUP_AFTER_INSTALL = False
+DEDUP_MIN_SIZE = 1024
+
+# ArcGIS installation details, in the form returned by
+# arcpy.GetInstallInfo(): at least 'InstallDir', 'Version' and
+# 'ProductName'. When set, e.g. by the command line interface, arcpy
+# isn't imported to look them up.
+ARCGIS_INSTALL_INFO = None
+
+# Whether arcpy may be imported to find ArcGIS installation details.
+# Disabled by the command line interface, unless asked for.
+ALLOW_ARCPY = True
+
+# stay quiet unless logging is configured, see rtools.logs
+logging.getLogger('rtools').addHandler(logging.NullHandler())
@@ -0,0 +1,325 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import glob
+import json
+import logging
+import os
+from collections import defaultdict
+
+from . import config
+from .fs import create_hard_link, hardlinks_supported
+from .integrity import MANIFEST_NAME, read_manifest, sha256_file
+from .probe import invalidate
+from .rpath import (
+    _user,
+    _user_profiles,
+    r_all_lib_paths,
+    r_user_lib_path,
+    r_version_dict,
+)
+from .utils import parallel_map
+from . import versions
+
+# Deduplication of package files across libraries.
+#
+# Each R minor version has its own user library, every user has their
+# own, and side by side installs keep each version of the package in the
+# library's store. Most of the package files, such as the proxy DLLs and R
+# sources, are byte-identical between them. dedup_packages() hashes the
+# package trees and replaces identical files on the same volume with hard
+# links to one copy. R installs a package by unpacking it anew rather than
+# writing into the existing files, so an install never changes the files
+# of the other libraries through a link.
+#
+# A hard linked file has a single owner and ACL, so files are only linked
+# within a trust domain, see trust_domains(): the libraries of one user
+# profile, or the libraries within the R homes, writable by
+# administrators only. Linking across them would let one user change the
+# files another user, or every user, loads.
+
+log = logging.getLogger(__name__)
+
+PACKAGE_NAME = 'arcgisbinding'
+# suffix of the link created beside a file, before it replaces it
+LINK_SUFFIX = '.rtools-link'
+
+
+def _links_supported(path):
+    try:
+        return hardlinks_supported(path)
+    except (OSError, AttributeError):
+        return False
+
+
+def default_libraries(all_users=False):
+    """Libraries which may hold copies of the package: those of the current
+    R, the library of each registered R, and the user library of every R
+    minor version, for the current user or all users.
+
+    Returns: list of paths."""
+    libraries = list(r_all_lib_paths())
+    for r_home in (r_version_dict() or {}).values():
+        if r_home:
+            libraries.append(os.path.join(r_home, 'library'))
+    if all_users:
+        usernames = sorted(u for (u, (sid, path)) in _user_profiles().items()
+                           if sid.startswith('S-1-5-21-'))
+    else:
+        usernames = [None]
+    for username in usernames:
+        user_library = r_user_lib_path(username)
+        if user_library:
+            # Documents\R\win-library\<x.y>, for each R version used
+            libraries.extend(sorted(glob.glob(os.path.join(
+                os.path.dirname(user_library), '*'))))
+
+    unique = []
+    seen = set()
+    for library in libraries:
+        key = os.path.normcase(os.path.normpath(library))
+        if key not in seen and os.path.isdir(library):
+            seen.add(key)
+            unique.append(library)
+    return unique
+
+
+def _path_key(path):
+    return os.path.normcase(os.path.normpath(os.path.abspath(path)))
+
+
+def _within(key, prefix):
+    return key == prefix or key.startswith(prefix.rstrip(os.sep) + os.sep)
+
+
+def trust_domains(libraries):
+    """Who may write to each library: a library within a user profile, or
+    that user's R library directory, belongs to that user; the library of
+    an R home to administrators, as 'machine'. Any other library, such as
+    one given by R_LIBS, is a domain of its own.
+
+    Returns: dictionary of library path to domain name."""
+    owners = []
+    for (username, (sid, profile)) in _user_profiles().items():
+        prefixes = [profile]
+        user_libraries = [r_user_lib_path(username)]
+        if username == _user():
+            # R_USER and R_LIBS_USER may move the current user's library
+            user_libraries.append(r_user_lib_path())
+        for user_library in user_libraries:
+            if user_library:
+                # Documents may be redirected out of the profile
+                prefixes.append(os.path.dirname(user_library))
+        owners.extend((_path_key(prefix), 'user:{}'.format(sid))
+                      for prefix in prefixes if prefix)
+    # the most specific prefix first
+    owners.sort(key=lambda owner: -len(owner[0]))
+    machine = set(_path_key(os.path.join(r_home, 'library'))
+                  for r_home in (r_version_dict() or {}).values() if r_home)
+
+    domains = {}
+    for library in libraries:
+        key = _path_key(library)
+        domain = None
+        for (prefix, owner) in owners:
+            if _within(key, prefix):
+                domain = owner
+                break
+        if domain is None:
+            domain = 'machine' if key in machine else \
+                'library:{}'.format(key)
+        domains[library] = domain
+    return domains
+
+
+def package_trees(libraries, package=PACKAGE_NAME):
+    """Copies of a package within libraries, including the versions kept
+    side by side in their stores. Each copy is listed once, even when
+    reached through the package link of a library.
+
+    Returns: list of (manifest directory, package directory, library)
+    tuples, the first holding the manifest describing the second, if
+    any."""
+    candidates = []
+    for library in libraries:
+        candidates.append((library, os.path.join(library, package), library))
+        for version in versions.installed_versions(library):
+            version_root = os.path.join(versions.store_dir(library), version)
+            candidates.append((version_root,
+                               os.path.join(version_root, package), library))
+
+    trees = []
+    seen = set()
+    for (root, package_dir, library) in candidates:
+        if not os.path.isdir(package_dir):
+            continue
+        key = os.path.normcase(os.path.realpath(package_dir))
+        if key in seen:
+            continue
+        seen.add(key)
+        trees.append((root, package_dir, library))
+    return trees
+
+
+def _manifest_digests(root, package_dir):
+    """Digests recorded in the manifest of a package, keyed by path, for
+    files unchanged since it was written."""
+    manifest = read_manifest(root)
+    if manifest is None or \
+            os.path.realpath(os.path.join(
+                root, manifest.get('package') or '')) != \
+            os.path.realpath(package_dir):
+        return {}
+    digests = {}
+    for (rel_path, record) in manifest['files'].items():
+        path = os.path.join(package_dir, *rel_path.split('/'))
+        digests[path] = (record['size'], record['mtime'], record['sha256'])
+    return digests
+
+
+def _replace_with_link(path, target):
+    link = path + LINK_SUFFIX
+    try:
+        create_hard_link(link, target)
+        # replace in one step, so the file never goes missing
+        replace = getattr(os, 'replace', None)
+        if replace is None:
+            # py 2 can't rename over an existing file on Windows
+            os.remove(path)
+            replace = os.rename
+        replace(link, path)
+    except (IOError, OSError) as e:
+        log.debug("Unable to link %s to %s: %s", path, target, e)
+        if os.path.exists(link):
+            os.remove(link)
+        return False
+    return True
+
+
+def _refresh_manifest(root, package_dir, linked):
+    """Record the modification times linked files now share, so quick
+    checks of the manifest still pass. Their contents didn't change."""
+    manifest = read_manifest(root)
+    if manifest is None:
+        return
+    changed = False
+    for (rel_path, record) in manifest['files'].items():
+        path = os.path.join(package_dir, *rel_path.split('/'))
+        if path in linked:
+            record['mtime'] = os.stat(path).st_mtime
+            changed = True
+    if changed:
+        with open(os.path.join(root, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def dedup_packages(libraries=None, package=PACKAGE_NAME, dry_run=False,
+                   all_users=False, workers=None):
+    """Replace identical files of a package, across libraries and the
+    versions kept side by side, with hard links to a single copy. Only
+    files within the same `trust_domains` are linked together.
+
+    Parameters
+    ----------
+    libraries: list, R libraries to look in. Defaults to
+               `default_libraries`.
+    package: str, package name.
+    dry_run: bool, only report what would be linked.
+    all_users: bool, with the default libraries, include those of every
+               user profile.
+    workers: int, files hashed at once, defaults to config.VERIFY_WORKERS.
+
+    Returns
+    -------
+    dictionary with the 'trees' examined, the number of 'files' in them,
+    the number of files 'linked' (or that would be), the 'bytes_saved',
+    and the files which couldn't be linked, as 'failed'.
+    """
+    if libraries is None:
+        libraries = default_libraries(all_users)
+    trees = package_trees(libraries, package)
+    domains = trust_domains(libraries)
+    result = {'trees': [package_dir for (_, package_dir, _) in trees],
+              'files': 0, 'linked': 0, 'bytes_saved': 0, 'failed': []}
+
+    # files of the same size on the same volume and in the same trust
+    # domain may be identical; files already linked together count once.
+    by_size = defaultdict(dict)
+    recorded = {}
+    for (root, package_dir, library) in trees:
+        domain = domains[library]
+        digests = _manifest_digests(root, package_dir)
+        for (dirpath, dirnames, filenames) in os.walk(package_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                result['files'] += 1
+                if st.st_size < config.DEDUP_MIN_SIZE:
+                    continue
+                inodes = by_size[(domain, st.st_dev, st.st_size)]
+                # Python 2 reports no inode numbers on Windows
+                inode = st.st_ino or path
+                inodes.setdefault(inode, (st, []))[1].append(path)
+                record = digests.get(path)
+                if record and record[:2] == (st.st_size, st.st_mtime):
+                    recorded[path] = record[2]
+
+    volumes = {}
+    candidates = []
+    for ((domain, dev, size), inodes) in by_size.items():
+        if len(inodes) < 2:
+            continue
+        first_path = next(iter(inodes.values()))[1][0]
+        if dev not in volumes:
+            volumes[dev] = _links_supported(os.path.dirname(first_path))
+        if volumes[dev]:
+            candidates.extend((domain, st, paths)
+                              for (st, paths) in inodes.values())
+
+    # hash one path of each inode
+    unhashed = [paths[0] for (domain, st, paths) in candidates
+                if paths[0] not in recorded]
+    hashed = dict(zip(unhashed, parallel_map(
+        _digest, unhashed, workers or config.VERIFY_WORKERS)))
+    groups = defaultdict(list)
+    for (domain, st, paths) in candidates:
+        digest = recorded.get(paths[0]) or hashed.get(paths[0])
+        if digest:
+            groups[(domain, st.st_dev, digest)].append((st, paths))
+
+    linked = set()
+    for inodes in groups.values():
+        if len(inodes) < 2:
+            continue
+        # keep the copy with the most links already
+        inodes.sort(key=lambda inode: -inode[0].st_nlink)
+        target = inodes[0][1][0]
+        for (st, paths) in inodes[1:]:
+            for path in paths:
+                if dry_run or _replace_with_link(path, target):
+                    linked.add(path)
+                    result['linked'] += 1
+                else:
+                    result['failed'].append(path)
+            # the inode is freed once all of its paths are links
+            if all(path in linked for path in paths) and \
+                    st.st_nlink <= len(paths):
+                result['bytes_saved'] += st.st_size
+
+    if linked and not dry_run:
+        for (root, package_dir, _) in trees:
+            _refresh_manifest(root, package_dir, linked)
+        invalidate()
+    return result
+
+
+def _digest(path):
+    try:
+        return sha256_file(path)
+    except (IOError, OSError):
+        return None
@@ -0,0 +1,311 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import namedtuple
+import glob
+import logging
+import os
+import re
+import shutil
+import struct
+import zipfile
+import zlib
+try:
+    import urllib.request as request
+except ImportError:
+    import urllib2 as request
+
+from .fs import create_hard_link
+from .utils import user_data_dir
+
+# Delta updates: rather than downloading a whole release zip, read its
+# central directory with HTTP Range requests, reuse the members whose
+# CRC32 and size match the previously installed release, and fetch only
+# the changed members.
+
+log = logging.getLogger(__name__)
+
+ARTIFACT_DIR = 'releases'
+
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD_FORMAT = '<4s4H2LH'
+EOCD_SIZE = struct.calcsize(EOCD_FORMAT)
+CENTRAL_SIGNATURE = b'PK\x01\x02'
+CENTRAL_FORMAT = '<4s6H3L5H2L'
+CENTRAL_SIZE = struct.calcsize(CENTRAL_FORMAT)
+LOCAL_SIGNATURE = b'PK\x03\x04'
+LOCAL_FORMAT = '<4s5H3L2H'
+LOCAL_SIZE = struct.calcsize(LOCAL_FORMAT)
+# the end of central directory record, and its longest comment
+TAIL_SIZE = EOCD_SIZE + 0xFFFF
+# first guess at the tail to fetch, enough for the directory of a package
+# without a long archive comment
+FIRST_TAIL_SIZE = 16 * 1024
+# flag marking UTF-8 member names
+UTF8_FLAG = 0x800
+
+RemoteMember = namedtuple('RemoteMember', (
+    'name', 'method', 'crc', 'compress_size', 'file_size', 'date_time',
+    'external_attr', 'offset'))
+
+
+class DeltaUnavailable(Exception):
+    """The release can't be fetched as a delta, e.g. the server ignores
+    Range requests. Download it in full instead."""
+
+
+def _fetch_range(url, spec):
+    """Fetch part of a URL.
+
+    Parameters
+    ----------
+    url: str, URL to fetch.
+    spec: str, byte range such as '0-99', or '-100' for the last 100.
+
+    Returns
+    -------
+    (data, total size) tuple.
+    """
+    req = request.Request(url, headers={'Range': 'bytes={}'.format(spec)})
+    try:
+        r = request.urlopen(req)
+    except (request.URLError, ValueError) as e:
+        raise DeltaUnavailable("Range request failed: {}".format(e))
+    try:
+        content_range = r.headers.get('Content-Range') or ''
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+)', content_range)
+        if r.code != 206 or not match:
+            raise DeltaUnavailable("Server doesn't support Range requests.")
+        return (r.read(), int(match.group(3)))
+    finally:
+        r.close()
+
+
+def _date_time(dos_time, dos_date):
+    return ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F,
+            dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2)
+
+
+def remote_members(url):
+    """Read the central directory of a remote zip, fetching only the end
+    of the file.
+
+    Returns: (list of RemoteMember, offset of the central directory)."""
+    (tail, total) = _fetch_range(url, '-{}'.format(FIRST_TAIL_SIZE))
+    pos = tail.rfind(EOCD_SIGNATURE)
+    if pos == -1 and len(tail) < total:
+        (tail, total) = _fetch_range(url, '-{}'.format(TAIL_SIZE))
+        pos = tail.rfind(EOCD_SIGNATURE)
+    if pos == -1 or len(tail) - pos < EOCD_SIZE:
+        raise DeltaUnavailable("No zip directory found.")
+    (_, _, _, _, entries, cd_size, cd_offset, _) = struct.unpack(
+        EOCD_FORMAT, tail[pos:pos + EOCD_SIZE])
+    if cd_offset == 0xFFFFFFFF or entries == 0xFFFF:
+        raise DeltaUnavailable("Zip64 archives aren't supported.")
+
+    tail_start = total - len(tail)
+    if cd_offset >= tail_start:
+        directory = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+    else:
+        (directory, _) = _fetch_range(url, '{}-{}'.format(
+            cd_offset, cd_offset + cd_size - 1))
+
+    members = []
+    pos = 0
+    for _ in range(entries):
+        fields = struct.unpack(CENTRAL_FORMAT,
+                               directory[pos:pos + CENTRAL_SIZE])
+        (signature, _, _, flags, method, dos_time, dos_date, crc,
+         compress_size, file_size, name_len, extra_len, comment_len,
+         _, _, external_attr, offset) = fields
+        if signature != CENTRAL_SIGNATURE:
+            raise DeltaUnavailable("Invalid zip directory entry.")
+        raw_name = directory[pos + CENTRAL_SIZE:pos + CENTRAL_SIZE + name_len]
+        name = raw_name.decode('utf-8' if flags & UTF8_FLAG else 'cp437')
+        members.append(RemoteMember(
+            name, method, crc, compress_size, file_size,
+            _date_time(dos_time, dos_date), external_attr, offset))
+        pos += CENTRAL_SIZE + name_len + extra_len + comment_len
+    return (members, cd_offset)
+
+
+def _file_crc(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xFFFFFFFF
+
+
+class _LocalSource(object):
+    """Finds unchanged members in the previous release zip, or among the
+    files of the installed package."""
+
+    def __init__(self, previous_zip=None, library=None):
+        self.zip = None
+        self.entries = {}
+        if previous_zip and os.path.exists(previous_zip):
+            try:
+                self.zip = zipfile.ZipFile(previous_zip)
+                self.entries = dict((info.filename, info)
+                                    for info in self.zip.infolist())
+            except (zipfile.BadZipfile, IOError, OSError):
+                self.zip = None
+        self.library = library
+
+    def read(self, member):
+        """Contents of an unchanged member, or None if it changed."""
+        if member.name.endswith('/') and member.file_size == 0:
+            return b''
+        info = self.entries.get(member.name)
+        if info is not None and info.CRC == member.crc and \
+                info.file_size == member.file_size:
+            return self.zip.read(info)
+        if self.library and not member.name.endswith('/'):
+            path = os.path.join(self.library, *member.name.split('/'))
+            try:
+                if os.path.getsize(path) == member.file_size and \
+                        _file_crc(path) == member.crc:
+                    with open(path, 'rb') as f:
+                        return f.read()
+            except (IOError, OSError):
+                pass
+        return None
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+
+
+def _ranges(positions):
+    """Merge adjacent member positions into contiguous runs."""
+    runs = []
+    for pos in sorted(positions):
+        if runs and runs[-1][1] == pos - 1:
+            runs[-1][1] = pos
+        else:
+            runs.append([pos, pos])
+    return runs
+
+
+def _member_data(member, record):
+    """Decompress a member from its local file record."""
+    (signature, _, _, _, _, _, _, _, _, name_len, extra_len) = struct.unpack(
+        LOCAL_FORMAT, record[:LOCAL_SIZE])
+    if signature != LOCAL_SIGNATURE:
+        raise DeltaUnavailable("Invalid zip member {}.".format(member.name))
+    start = LOCAL_SIZE + name_len + extra_len
+    raw = record[start:start + member.compress_size]
+    if member.method == zipfile.ZIP_STORED:
+        data = raw
+    elif member.method == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+        data = decompressor.decompress(raw) + decompressor.flush()
+    else:
+        raise DeltaUnavailable("Unsupported compression for {}.".format(
+            member.name))
+    if zlib.crc32(data) & 0xFFFFFFFF != member.crc:
+        raise DeltaUnavailable("CRC mismatch for {}.".format(member.name))
+    return data
+
+
+def delta_download(url, output_path, previous_zip=None, library=None,
+                   cancel=None):
+    """Rebuild a remote release zip locally, downloading only the members
+    that differ from the previous release or the installed package.
+
+    Parameters
+    ----------
+    url: str, release zip URL. The server must support Range requests.
+    output_path: str, zip file to write. It has the same members as the
+                 remote zip, each verified against its CRC32, though it
+                 isn't a byte for byte copy.
+    previous_zip: str, earlier release zip, see `cached_artifact`.
+    library: str, R library holding the installed package.
+    cancel: threading.Event, stop when set.
+
+    Returns
+    -------
+    dictionary of 'reused' and 'fetched' member counts and 'bytes'
+    downloaded, or None if cancelled. Raises DeltaUnavailable when a full
+    download is needed instead.
+    """
+    (members, cd_offset) = remote_members(url)
+    # in file order, so that changed neighbours are fetched together
+    members.sort(key=lambda member: member.offset)
+    source = _LocalSource(previous_zip, library)
+    try:
+        contents = {}
+        for (pos, member) in enumerate(members):
+            data = source.read(member)
+            if data is not None:
+                contents[pos] = data
+    finally:
+        source.close()
+
+    changed = [pos for pos in range(len(members)) if pos not in contents]
+    if len(changed) == len(members):
+        raise DeltaUnavailable("No members in common with the previous "
+                               "release.")
+
+    # members are stored in offset order, each record runs up to the next
+    bounds = sorted(member.offset for member in members) + [cd_offset]
+    record_end = dict((bounds[pos], bounds[pos + 1])
+                      for pos in range(len(bounds) - 1))
+    downloaded = 0
+    for (first, last) in _ranges(changed):
+        if cancel is not None and cancel.is_set():
+            return None
+        start = members[first].offset
+        end = record_end[members[last].offset]
+        (data, _) = _fetch_range(url, '{}-{}'.format(start, end - 1))
+        downloaded += len(data)
+        for pos in range(first, last + 1):
+            member = members[pos]
+            contents[pos] = _member_data(
+                member, data[member.offset - start:
+                             record_end[member.offset] - start])
+
+    with zipfile.ZipFile(output_path, 'w') as out:
+        for (pos, member) in enumerate(members):
+            info = zipfile.ZipInfo(member.name, member.date_time)
+            info.external_attr = member.external_attr
+            info.compress_type = member.method
+            out.writestr(info, contents[pos])
+
+    return {'reused': len(members) - len(changed), 'fetched': len(changed),
+            'bytes': downloaded}
+
+
+def cached_artifact():
+    """The release zip kept from the last installation, used as the base
+    of a delta update.
+
+    Returns: path to the zip, or None."""
+    zips = glob.glob(os.path.join(user_data_dir(), ARTIFACT_DIR, '*.zip'))
+    return zips[0] if zips else None
+
+
+def cache_artifact(zip_path):
+    """Keep a release zip as the base for the next delta update,
+    replacing any earlier one."""
+    artifact_dir = os.path.join(user_data_dir(), ARTIFACT_DIR)
+    try:
+        if not os.path.exists(artifact_dir):
+            os.makedirs(artifact_dir)
+        for old_zip in glob.glob(os.path.join(artifact_dir, '*.zip')):
+            if os.path.basename(old_zip) != os.path.basename(zip_path):
+                os.remove(old_zip)
+        cached = os.path.join(artifact_dir, os.path.basename(zip_path))
+        # removed rather than written over, it may be a link to the zip
+        # installed last time
+        if os.path.exists(cached):
+            os.remove(cached)
+        try:
+            create_hard_link(cached, zip_path)
+        except (OSError, AttributeError):
+            shutil.copyfile(zip_path, cached)
+    except (IOError, OSError) as e:
+        log.debug("Unable to keep the release zip: %s", e)
@@ -0,0 +1,232 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import struct
+import subprocess
+import threading
+import time
+
+from .compat import compatibility
+from .rpath import (
+    _clean_version,
+    arcgis_products,
+    package_description_version,
+    r_home_lib_paths,
+    r_home_version,
+    r_path,
+    r_pkg_path,
+    r_user_lib_path,
+    r_version,
+    r_version_dict,
+)
+from .trace import traced
+from .utils import parallel_map, platform
+
+# Health checks of every R installation on this machine, run concurrently
+# and gathered into one report.
+
+PACKAGE_NAME = 'arcgisbinding'
+
+# IMAGE_FILE_HEADER Machine values of the R.dll builds
+PE_MACHINES = {0x8664: 'x64', 0x14c: 'i386'}
+
+# seconds to wait for R to load the package
+LOAD_TIMEOUT = 120
+
+
+def _check(name, ok, detail=None):
+    return {'check': name, 'ok': bool(ok), 'detail': detail}
+
+
+def dll_architecture(dll_path):
+    """Architecture a DLL was built for, from its PE header rather than
+    by loading it.
+
+    Returns: 'x64', 'i386', or None if unknown."""
+    try:
+        with open(dll_path, 'rb') as f:
+            header = f.read(4096)
+    except (IOError, OSError):
+        return None
+    if len(header) < 0x40 or header[0:2] != b'MZ':
+        return None
+    pe_offset = struct.unpack('<L', header[0x3C:0x40])[0]
+    if header[pe_offset:pe_offset + 4] != b'PE\0\0':
+        return None
+    machine = struct.unpack('<H', header[pe_offset + 4:pe_offset + 6])[0]
+    return PE_MACHINES.get(machine)
+
+
+def _writable(library):
+    """Whether packages can be installed into a library, including one
+    that doesn't exist yet but can be created."""
+    path = library
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return bool(path) and os.access(path, os.W_OK)
+
+
+def load_package(r_home, timeout=LOAD_TIMEOUT):
+    """Time library(arcgisbinding) in a new session of the R installed in
+    **r_home**.
+
+    Returns: (loaded, seconds, last line of output) tuple."""
+    rscript = os.path.join(r_home, 'bin', platform(), 'Rscript.exe')
+    if not os.path.exists(rscript):
+        return (False, None, "Rscript not found at {}".format(rscript))
+    # R_HOME may point at another installation
+    env = dict((key, value) for (key, value) in os.environ.items()
+               if key != 'R_HOME')
+    start = time.time()
+    try:
+        process = subprocess.Popen(
+            [rscript, '-e', 'library({})'.format(PACKAGE_NAME)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, cwd=os.path.dirname(rscript), env=env)
+    except OSError as e:
+        return (False, None, str(e))
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        (stdout, stderr) = process.communicate()
+    finally:
+        timer.cancel()
+    seconds = round(time.time() - start, 3)
+    lines = [line for line in (stdout + stderr).splitlines() if line.strip()]
+    detail = lines[-1] if lines else None
+    if seconds >= timeout:
+        detail = "timed out after {} seconds".format(timeout)
+    return (process.returncode == 0, seconds, detail)
+
+
+def check_installation(version_key, r_home, default=False, load=False):
+    """Check one R installation: its R.dll matches the architecture of
+    this Python, where packages would be installed, and which version of
+    the package it would load.
+
+    Parameters
+    ----------
+    version_key: str, registry key of the installation, e.g. '4.1.2'.
+    r_home: str, R installation directory.
+    default: bool, whether this is the R used by ArcGIS.
+    load: bool, also time loading the package in R.
+
+    Returns
+    -------
+    dictionary with 'version', 'home', 'default', 'library', 'package'
+    (with 'path' and 'version'), 'checks' and 'ok'.
+    """
+    version = r_home_version(r_home) or _clean_version(version_key)
+    checks = []
+
+    rdll = os.path.join(r_home, 'bin', platform(), 'R.dll')
+    arch = dll_architecture(rdll) if os.path.exists(rdll) else None
+    if arch is None:
+        checks.append(_check('r_dll', False, "{} missing".format(rdll)))
+    else:
+        checks.append(_check('r_dll', arch == platform(),
+                             "{} ({})".format(rdll, arch)))
+
+    libraries = r_home_lib_paths(r_home, version)
+    if not os.environ.get('R_LIBS_USER'):
+        # the install tool creates the per-user library when needed
+        user_library = r_user_lib_path(version=version)
+        if user_library is not None and user_library not in libraries:
+            libraries.insert(0, user_library)
+    library = libraries[0] if libraries else None
+    checks.append(_check('library_writable',
+                         library is not None and _writable(library),
+                         library))
+
+    package = {'path': None, 'version': None}
+    for lib_path in libraries:
+        package_path = os.path.join(lib_path, PACKAGE_NAME)
+        if os.path.exists(package_path):
+            package = {'path': package_path,
+                       'version': package_description_version(package_path)}
+            break
+    if default and package['path'] is None:
+        # also linked through the registry, or in ArcGIS Rintegration
+        package_path = r_pkg_path()
+        if package_path is not None:
+            package = {'path': package_path,
+                       'version': package_description_version(package_path)}
+    checks.append(_check('package_installed', package['version'] is not None,
+                         package['version']))
+
+    if load and package['path'] is not None:
+        (loaded, seconds, detail) = load_package(r_home)
+        checks.append(_check('package_loads', loaded,
+                             {'seconds': seconds, 'output': detail}))
+
+    return {'version': version, 'home': r_home, 'default': default,
+            'library': library, 'package': package, 'checks': checks,
+            'ok': all(c['ok'] for c in checks)}
+
+
+def _link_checks(r_version_raw):
+    """Check the package links of ArcMap releases that load the package
+    from their Rintegration directory, such as 10.3.1."""
+    checks = []
+    package_path = None
+    for record in arcgis_products():
+        if record.product != 'ArcMap' or not compatibility(
+                'ArcMap', record.version, r_version_raw).link_rintegration:
+            continue
+        if package_path is None:
+            package_path = r_pkg_path()
+        link_dir = os.path.join(record.rintegration_dir, PACKAGE_NAME)
+        linked = os.path.exists(link_dir) and package_path is not None and \
+            os.path.realpath(link_dir) == os.path.realpath(package_path)
+        checks.append(_check('arcmap_link', linked, {
+            'arcgis_version': record.version, 'link': link_dir,
+            'target': os.path.realpath(link_dir)
+            if os.path.exists(link_dir) else None}))
+    return checks
+
+
+@traced(args=True)
+def doctor(load=False, workers=4):
+    """Check every R installation on this machine at once, see
+    `check_installation`.
+
+    Parameters
+    ----------
+    load: bool, also time loading the package in each R that has it.
+    workers: int, number of installations checked concurrently.
+
+    Returns
+    -------
+    dictionary with 'checks' of the machine, 'installations', one report
+    per R found, the default R first, and 'ok', whether the machine
+    checks and the default R passed. Other installations don't affect
+    'ok', they may well be unused.
+    """
+    default_home = r_path()
+    homes = []
+    if default_home:
+        homes.append((r_version() or '', default_home))
+    seen = set(os.path.normcase(os.path.normpath(home))
+               for (_, home) in homes)
+    for (version_key, home) in sorted((r_version_dict() or {}).items(),
+                                      reverse=True):
+        if home and os.path.normcase(os.path.normpath(home)) not in seen:
+            seen.add(os.path.normcase(os.path.normpath(home)))
+            homes.append((version_key, home))
+
+    installations = parallel_map(
+        lambda item: check_installation(
+            item[0], item[1], default=item[1] == default_home, load=load),
+        homes, workers)
+
+    checks = [_check('r_installed', default_home is not None, default_home)]
+    checks.extend(_link_checks(r_version()))
+    default_ok = all(inst['ok'] for inst in installations if inst['default'])
+    return {'checks': checks, 'installations': installations,
+            'ok': default_ok and all(c['ok'] for c in checks)}
@@ -0,0 +1,496 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import ctypes
+import glob
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+
+try:
+    import winreg
+except ImportError:
+    # py 2
+    import _winreg as winreg
+
+from .bootstrap_r import execute_r
+from .compat import install_method
+from .github_release import fetch_release, release_info
+from .install_package import (
+    PACKAGE_NAME,
+    arcgis_platform,
+    create_registry_entry,
+    local_package_zip,
+    package_version_from_name,
+)
+from .integrity import (
+    IntegrityError,
+    local_digest,
+    stage_verified,
+    verify_install,
+    write_manifest,
+)
+from .lock import install_lock, record_install
+from . import versions
+from .messages import add_error, add_message, add_warning
+from .rpath import (
+    _user_profiles,
+    r_site_lib_path,
+    r_user_lib_path,
+    r_version,
+    registry_key,
+)
+from .utils import mkdtemp, parallel_map, r_tmpdir
+
+# registry hive of a user, within their profile
+HIVE_FILE = 'NTUSER.DAT'
+# privileges needed to load and unload a hive, held by administrators
+HIVE_PRIVILEGES = ('SeBackupPrivilege', 'SeRestorePrivilege')
+SE_PRIVILEGE_ENABLED = 0x2
+TOKEN_ADJUST_PRIVILEGES = 0x20
+TOKEN_QUERY = 0x8
+ERROR_NOT_ALL_ASSIGNED = 1300
+
+
+def is_admin():
+    """Check whether we're running with administrator rights, which are
+    needed to write into the libraries of other users."""
+    admin = False
+    try:
+        admin = bool(ctypes.windll.shell32.IsUserAnAdmin())
+    except (AttributeError, OSError):
+        pass
+    return admin
+
+
+def fleet_targets(usernames=None):
+    """Resolve the per-user R library for each profile on this machine.
+
+    Parameters
+    ----------
+    usernames: list, profiles to target. Defaults to every profile with
+               a home directory on this machine.
+
+    Returns
+    -------
+    list of (username, library path) tuples.
+    """
+    profiles = _user_profiles()
+    if usernames is None:
+        # skip service profiles (systemprofile, LocalService, ...), which
+        # don't live under a user's home directory.
+        usernames = sorted(u for (u, (sid, path)) in profiles.items()
+                           if os.path.exists(path) and
+                           sid.startswith('S-1-5-21-'))
+
+    targets = []
+    for username in usernames:
+        if username not in profiles:
+            add_warning("No profile found for user {}.".format(username))
+            continue
+        targets.append((username, r_user_lib_path(username)))
+    return targets
+
+
+def fetch_artifact(temp_dir):
+    """Get a single copy of the package zip, used for every install.
+
+    Returns: path to the package zip, or None."""
+    zip_path = local_package_zip()
+    if zip_path:
+        add_message("Found local copy of binding, installing from zip")
+        try:
+            return stage_verified(zip_path, temp_dir, local_digest(zip_path))
+        except IntegrityError as e:
+            add_error(str(e))
+            return None
+
+    if install_method(r_version()) == 'repository':
+        # For R 4.0+, the binary comes from the repository. Have R download
+        # it once, then install the zip into each library.
+        script = os.path.join(temp_dir, 'download.R')
+        with open(script, 'w') as f:
+            f.write("download.packages(\"{}\", destdir=\"{}\", "
+                    "repos=\"https://r.esri.com\", type=\"win.binary\")".format(
+                        PACKAGE_NAME, temp_dir.replace("\\", "/")))
+        execute_r("Rscript", script)
+    else:
+        download_url = release_info()[0]
+        if download_url:
+            fetch_release(download_url, os.path.join(
+                temp_dir, os.path.basename(download_url)))
+
+    zip_glob = glob.glob(os.path.join(temp_dir, "{}*.zip".format(PACKAGE_NAME)))
+    if zip_glob:
+        return zip_glob[0]
+    return None
+
+
+def _install_user(package_path, username, library, overwrite):
+    """Install the package zip into one user library, and describe
+    the outcome."""
+    status = {'user': username, 'library': library,
+              'status': 'failed', 'detail': ''}
+    if library is None:
+        status['detail'] = 'unable to resolve library'
+        return status
+
+    if not overwrite and os.path.exists(os.path.join(library, PACKAGE_NAME)):
+        status['status'] = 'skipped'
+        status['detail'] = 'already installed'
+        return status
+
+    if not os.path.exists(library):
+        try:
+            os.makedirs(library)
+        except OSError as e:
+            status['detail'] = 'unable to create library: {}'.format(e)
+            return status
+
+    version = package_version_from_name(package_path)
+    with install_lock(library) as lock_state:
+        if lock_state['timed_out']:
+            status['detail'] = 'timed out waiting for another installation'
+            return status
+        previous = lock_state['previous']
+        if previous and version and previous.get('version') == version:
+            status['status'] = 'skipped'
+            status['detail'] = 'just installed by {}'.format(
+                previous.get('user'))
+            return status
+
+        # side by side with earlier versions when the volume allows it,
+        # see rtools.versions
+        staging = None
+        if versions.enabled(library):
+            staging = versions.staging_dir(library)
+        try:
+            rcmd_return = execute_r(
+                'Rcmd', 'INSTALL', '--library={}'.format(staging or library),
+                package_path)
+            if rcmd_return != 0:
+                status['detail'] = 'Rcmd INSTALL returned {}'.format(
+                    rcmd_return)
+            elif staging is not None:
+                installed_version = versions.commit_staged(library, staging)
+                if installed_version is None:
+                    status['detail'] = 'no package installed into staging'
+                else:
+                    versions.activate(library, installed_version)
+                    versions.prune(library)
+        finally:
+            if staging is not None and os.path.exists(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+        if not status['detail']:
+            status['status'] = 'installed'
+            record_install(library, version)
+            write_manifest(library, PACKAGE_NAME, version)
+    return status
+
+
+def install_fleet(usernames=None, overwrite=False, workers=4):
+    """Install ArcGIS R bindings for many users of a shared host, such as
+    a Remote Desktop or Citrix server.
+
+    The package is fetched once, then installed into each user's
+    R/win-library/x.y concurrently.
+
+    Parameters
+    ----------
+    usernames: list, profiles to install into. Defaults to all profiles.
+    overwrite: bool, replace existing installations.
+    workers: int, number of concurrent installations.
+
+    Returns
+    -------
+    list of per-user status dictionaries, with the keys 'user',
+    'library', 'status' and 'detail'.
+    """
+    if not is_admin():
+        add_warning(
+            "Not running as an administrator, installing into the libraries"
+            " of other users will likely fail.")
+
+    if r_version() is None:
+        add_error("It doesn't look like R is installed. Install R prior "
+                  "to running this tool.")
+        return []
+
+    targets = fleet_targets(usernames)
+    if not targets:
+        add_error("No user profiles found to install into.")
+        return []
+
+    with r_tmpdir(), mkdtemp() as temp_dir:
+        package_path = fetch_artifact(temp_dir)
+        if package_path is None:
+            add_error(
+                "Unable to access online package, and no "
+                "local copy of package found.")
+            return []
+
+        add_message("Installing {} for {} users.".format(
+            os.path.basename(package_path), len(targets)))
+        results = parallel_map(
+            lambda target: _install_user(
+                package_path, target[0], target[1], overwrite),
+            targets, workers)
+
+    for res in results:
+        line = "{user}: {status} ({library}) {detail}".format(**res)
+        if res['status'] == 'failed':
+            add_warning(line)
+        else:
+            add_message(line)
+    return results
+
+
+def verify_fleet(usernames=None, quick=False, workers=4):
+    """Check the package installed for each user against the manifest
+    recorded when it was installed, see `rtools.integrity`.
+
+    Parameters
+    ----------
+    usernames: list, profiles to check. Defaults to all profiles.
+    quick: bool, only compare file sizes and modification times.
+    workers: int, number of libraries checked at once.
+
+    Returns
+    -------
+    list of per-user status dictionaries, with the keys 'user',
+    'library', 'status' and 'detail'. The status is 'ok', 'modified',
+    'no_manifest' or 'missing'.
+    """
+    def verify_user(target):
+        (username, library) = target
+        status = {'user': username, 'library': library,
+                  'status': 'missing', 'detail': ''}
+        if library is None or \
+                not os.path.exists(os.path.join(library, PACKAGE_NAME)):
+            status['detail'] = 'not installed'
+            return status
+        result = verify_install(library, quick)
+        status['status'] = result['status']
+        changed = result['missing'] + result['modified'] + result['extra']
+        if changed:
+            status['detail'] = '{} files changed, e.g. {}'.format(
+                len(changed), changed[0])
+        elif result['version']:
+            status['detail'] = 'version {}'.format(result['version'])
+        return status
+
+    results = parallel_map(verify_user, fleet_targets(usernames), workers)
+    for res in results:
+        line = "{user}: {status} ({library}) {detail}".format(**res)
+        if res['status'] in ('ok', 'missing'):
+            add_message(line)
+        else:
+            add_warning(line)
+    return results
+
+
+def _enable_privileges(names):
+    """Enable privileges the process token holds but doesn't enable by
+    default, such as those needed to load registry hives.
+
+    Returns: whether all of them were enabled."""
+    try:
+        from ctypes import wintypes
+        advapi32 = ctypes.WinDLL(str('advapi32'), use_last_error=True)
+        kernel32 = ctypes.WinDLL(str('kernel32'), use_last_error=True)
+    except (AttributeError, OSError, ImportError):
+        return False
+
+    class LUID(ctypes.Structure):
+        _fields_ = [('LowPart', wintypes.DWORD), ('HighPart', wintypes.LONG)]
+
+    class TOKEN_PRIVILEGES(ctypes.Structure):
+        # a single LUID_AND_ATTRIBUTES
+        _fields_ = [('PrivilegeCount', wintypes.DWORD), ('Luid', LUID),
+                    ('Attributes', wintypes.DWORD)]
+
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    advapi32.OpenProcessToken.argtypes = [
+        wintypes.HANDLE, wintypes.DWORD, ctypes.POINTER(wintypes.HANDLE)]
+    advapi32.LookupPrivilegeValueW.argtypes = [
+        wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.POINTER(LUID)]
+    advapi32.AdjustTokenPrivileges.argtypes = [
+        wintypes.HANDLE, wintypes.BOOL, ctypes.POINTER(TOKEN_PRIVILEGES),
+        wintypes.DWORD, ctypes.c_void_p, ctypes.c_void_p]
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+
+    token = wintypes.HANDLE()
+    if not advapi32.OpenProcessToken(
+            kernel32.GetCurrentProcess(),
+            TOKEN_ADJUST_PRIVILEGES | TOKEN_QUERY, ctypes.byref(token)):
+        return False
+    try:
+        for name in names:
+            privileges = TOKEN_PRIVILEGES(1, LUID(), SE_PRIVILEGE_ENABLED)
+            if not advapi32.LookupPrivilegeValueW(
+                    None, name, ctypes.byref(privileges.Luid)):
+                return False
+            # succeeds without enabling privileges the token lacks
+            if not advapi32.AdjustTokenPrivileges(
+                    token, False, ctypes.byref(privileges), 0, None, None) \
+                    or ctypes.get_last_error() == ERROR_NOT_ALL_ASSIGNED:
+                return False
+    finally:
+        kernel32.CloseHandle(token)
+    return True
+
+
+def _unload_hive(sid):
+    try:
+        from ctypes import wintypes
+        advapi32 = ctypes.WinDLL(str('advapi32'))
+    except (AttributeError, OSError, ImportError):
+        return False
+    advapi32.RegUnLoadKeyW.argtypes = [wintypes.HANDLE, wintypes.LPCWSTR]
+    return advapi32.RegUnLoadKeyW(winreg.HKEY_USERS, sid) == 0
+
+
+@contextmanager
+def user_hive(sid, profile_path):
+    """Make the registry hive of a user available within HKEY_USERS for
+    the duration of a with block. The hives of users who aren't logged on
+    are loaded from NTUSER.DAT in their profile, which needs administrator
+    rights, and unloaded on the way out.
+
+    Yields: whether the hive is available."""
+    with registry_key(winreg.HKEY_USERS, sid) as key:
+        loaded = key is not None
+    if not loaded and profile_path:
+        hive_path = os.path.join(profile_path, HIVE_FILE)
+        if os.path.exists(hive_path) and \
+                _enable_privileges(HIVE_PRIVILEGES):
+            try:
+                winreg.LoadKey(winreg.HKEY_USERS, sid, hive_path)
+            except (OSError, NotImplementedError):
+                # in use under another name, or not a hive
+                pass
+            else:
+                try:
+                    yield True
+                finally:
+                    _unload_hive(sid)
+                return
+    yield loaded
+
+
+def _link_user(binding_path, product, arc_version, sid, profile_path,
+               username, library):
+    """Point one user's ArcGIS at the shared package, and describe
+    the outcome."""
+    status = {'user': username, 'library': library,
+              'status': 'failed', 'detail': ''}
+    with user_hive(sid, profile_path) as available:
+        if not available:
+            # linked by the next run once the user has logged on
+            status['status'] = 'pending'
+            status['detail'] = 'registry hive not loaded'
+            return status
+        linked = create_registry_entry(
+            product, arc_version, binding_path, sid)
+    if linked:
+        status['status'] = 'linked'
+        # user libraries precede the site library, an old copy there
+        # would be loaded by R instead of the shared one.
+        if library and os.path.exists(os.path.join(library, PACKAGE_NAME)):
+            status['detail'] = 'shadowed by per-user copy'
+    else:
+        status['detail'] = 'no ArcGIS settings'
+    return status
+
+
+def install_shared(usernames=None, overwrite=False):
+    """Install ArcGIS R bindings once into the site library, and point
+    each user's ArcGIS at it with a per-user registry entry. The registry
+    hives of users who aren't logged on are loaded for this, see
+    `user_hive`.
+
+    Parameters
+    ----------
+    usernames: list, profiles to link. Defaults to all profiles.
+    overwrite: bool, replace an existing site installation.
+
+    Returns
+    -------
+    list of per-user status dictionaries, with the keys 'user',
+    'library', 'status' and 'detail'. The status is 'linked', 'failed',
+    or 'pending' for users whose hive couldn't be loaded, to link again
+    once they have logged on.
+    """
+    if not is_admin():
+        add_warning(
+            "Not running as an administrator, installing into the site"
+            " library will likely fail.")
+
+    if r_version() is None:
+        add_error("It doesn't look like R is installed. Install R prior "
+                  "to running this tool.")
+        return []
+
+    site_library = r_site_lib_path()
+    if site_library is None:
+        add_error("Unable to locate the R site library.")
+        return []
+    binding_path = os.path.join(site_library, PACKAGE_NAME)
+
+    if overwrite or not os.path.exists(binding_path):
+        with r_tmpdir(), mkdtemp() as temp_dir:
+            package_path = fetch_artifact(temp_dir)
+            if package_path is None:
+                add_error(
+                    "Unable to access online package, and no "
+                    "local copy of package found.")
+                return []
+            status = _install_user(package_path, 'site', site_library, True)
+
+        if status['status'] != 'installed':
+            add_error("Failed to install into the site library {}: "
+                      "{}".format(site_library, status['detail']))
+            return []
+    else:
+        add_message("Using existing installation in {}.".format(
+            site_library))
+
+    (install_dir, arc_version, product) = arcgis_platform()
+    if product is None:
+        add_error("Unable to determine the ArcGIS installation to link.")
+        return []
+    profiles = _user_profiles()
+    results = []
+    for (username, library) in fleet_targets(usernames):
+        (sid, profile_path) = profiles[username]
+        results.append(_link_user(
+            binding_path, product, arc_version, sid, profile_path,
+            username, library))
+
+    for res in results:
+        line = "{user}: {status} {detail}".format(**res)
+        if res['status'] == 'failed' or res['detail']:
+            add_warning(line)
+        else:
+            add_message(line)
+    return results
+
+# execute as standalone script, get usernames from sys.argv. Pass --shared
+# to install once into the site library instead of every user library, or
+# --verify to check the installed files of each user.
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    shared = '--shared' in args
+    verify = '--verify' in args
+    usernames = [arg for arg in args
+                 if arg not in ('--shared', '--verify')] or None
+
+    if verify:
+        verify_fleet(usernames=usernames)
+    elif shared:
+        install_shared(usernames=usernames)
+    else:
+        install_fleet(usernames=usernames)
@@ -24,6 +24,8 @@
 # From the NTFS project: https://github.com/sid0/ntfs
 
 import ctypes
+import os
+import subprocess
 from ctypes import POINTER, WinError, byref
 from ctypes.wintypes import DWORD, BOOL
 
@@ -83,3 +85,72 @@ def hardlinks_supported(path):
 def junctions_supported(path):
     (fsname, fsflags) = getvolumeinfo(path)
     return bool(fsflags & FILE_SUPPORTS_REPARSE_POINTS)
+
+
+# Directory links, used to switch between installed package versions.
+
+FILE_ATTRIBUTE_REPARSE_POINT = 0x400
+INVALID_FILE_ATTRIBUTES = 0xFFFFFFFF
+SYMBOLIC_LINK_FLAG_DIRECTORY = 0x1
+# Windows 10 developer mode, no privilege needed
+SYMBOLIC_LINK_FLAG_ALLOW_UNPRIVILEGED_CREATE = 0x2
+
+
+def links_supported(path):
+    """Whether directory links can be created at the given path."""
+    if os.name != 'nt':
+        return True
+    try:
+        return junctions_supported(path)
+    except OSError:
+        return False
+
+
+def is_dir_link(path):
+    """Whether the path is a directory symlink or junction, rather than a
+    directory."""
+    if os.path.islink(path):
+        return True
+    if os.name != 'nt':
+        return False
+    attributes = ctypes.windll.kernel32.GetFileAttributesW(path)
+    return attributes != INVALID_FILE_ATTRIBUTES and \
+        bool(attributes & FILE_ATTRIBUTE_REPARSE_POINT)
+
+
+def create_dir_link(link, target):
+    """Link a directory to another. On Windows, a directory symlink when
+    this user may create one, otherwise a junction, which needs no
+    privileges but must point to a local volume."""
+    if os.name != 'nt':
+        os.symlink(target, link)
+        return
+    flags = SYMBOLIC_LINK_FLAG_DIRECTORY | \
+        SYMBOLIC_LINK_FLAG_ALLOW_UNPRIVILEGED_CREATE
+    if ctypes.windll.kernel32.CreateSymbolicLinkW(link, target, flags):
+        return
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call(
+            ['cmd', '/c', 'mklink', '/J', link, target],
+            stdout=devnull, stderr=devnull)
+    if returncode != 0:
+        raise OSError("Unable to link {} to {}.".format(link, target))
+
+
+def remove_dir_link(link):
+    """Remove a directory link, leaving its target alone."""
+    if os.name == 'nt':
+        # RemoveDirectoryW deletes the link, not the linked directory
+        os.rmdir(link)
+    else:
+        os.remove(link)
+
+
+def create_hard_link(link, target):
+    """Hard link a file to another on the same volume. Python 2 has no
+    os.link on Windows, use CreateHardLinkW there."""
+    if hasattr(os, 'link'):
+        os.link(target, link)
+        return
+    if not ctypes.windll.kernel32.CreateHardLinkW(link, target, None):
+        raise WinError()
@@ -1,14 +1,24 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
-import arcpy
+import hashlib
 import json
+import os
+import shutil
+import tempfile
+import threading
 import time
 try:
     import urllib.request as request
 except ImportError:
     import urllib2 as request
 
+from . import config
+from .delta import DeltaUnavailable, cached_artifact, delta_download
+from .integrity import IntegrityError, check_digest, normalize_digest
+from .messages import add_error, add_message, add_warning, buffered, replay
+from .trace import traced
+
 API_URL = "https://api.github.com"
 org = 'R-ArcGIS'
 project = 'r-bridge'
@@ -16,12 +26,35 @@ project = 'r-bridge'
 latest_url = '{API_URL}/repos/{org}/{project}/releases/latest'.format(
              API_URL=API_URL, org=org, project=project)
 
+# read downloads in 1MB chunks, so they can be cancelled
+CHUNK_SIZE = 1024 * 1024
+
+# download URL: SHA-256 digest published for the release asset
+_published_digests = {}
+
+
+@traced(args=True)
+def save_url(url, output_path, cancel=None, sha256=None):
+    """Save a URL to disk.
 
-def save_url(url, output_path):
-    """Save a URL to disk."""
+    Parameters
+    ----------
+    url: str, URL to download.
+    output_path: str, file to write.
+    cancel: threading.Event, stop the download when set. Any partial
+            file is removed.
+    sha256: str, digest the download must have. It is hashed as it is
+            written, and removed if it doesn't match.
+
+    Returns
+    -------
+    bool, whether the download completed.
+    """
     valid_types = ['application/zip', 'application/octet-stream']
     r = None
     for _ in range(5):
+        if cancel is not None and cancel.is_set():
+            return False
         try:
             r = request.urlopen(url)
             break
@@ -29,27 +62,104 @@ def save_url(url, output_path):
             reason = "None given"
             if e.reason:
                 reason = e.reason
-            arcpy.AddError("Unable to access '{}', (reason: {}).".format(
+            add_error("Unable to access '{}', (reason: {}).".format(
                 url, reason))
         except request.URLError as e:
-            arcpy.AddWarning("Access failed, trying again.")
+            add_warning("Access failed, trying again.")
             # retry all URLErrors
             time.sleep(3)
 
     if r and r.headers['content-type'] in valid_types and r.code == 200:
-        arcpy.AddMessage("Saving URL to '{}'".format(output_path))
+        add_message("Saving URL to '{}'".format(output_path))
+        cancelled = False
+        digest = hashlib.sha256()
         with open(output_path, 'wb') as f:
-            f.write(r.read())
+            while True:
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    break
+                chunk = r.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        r.close()
+        if cancelled:
+            os.remove(output_path)
+            return False
+        try:
+            check_digest(os.path.basename(output_path), digest.hexdigest(),
+                         sha256)
+        except IntegrityError as e:
+            os.remove(output_path)
+            add_error("{} The download may be corrupted or tampered with, "
+                      "try again.".format(e))
+            return False
+        if sha256:
+            add_message("Verified SHA-256 {}.".format(digest.hexdigest()))
+        return True
     else:
-        arcpy.AddError("Unable to access '{}', invalid content.".format(url))
+        add_error("Unable to access '{}', invalid content.".format(url))
         if r:
-            arcpy.AddError("Content type: {}, response code: {}".format(
+            add_error("Content type: {}, response code: {}".format(
                 r.headers['content-type'], r.code))
         msg = "Either a connectivity issue or restrictions on downloading " + \
               "prevented the tool from downloading. Please download the " + \
               "zip manually from {}".format(latest_url) + " and move it to " + \
               "the same location as this toolbox."
-        arcpy.AddError(msg)
+        add_error(msg)
+    return False
+
+
+def published_digest(url):
+    """Digest expected for a release zip: config.RELEASE_SHA256, or the
+    one GitHub published for the asset, as seen by `release_info`.
+
+    Returns: hex digest, or None when unknown."""
+    return normalize_digest(config.RELEASE_SHA256) or \
+        _published_digests.get(url)
+
+
+def fetch_release(url, output_path, library=None, cancel=None):
+    """Save a release zip, as a delta from the previous release when
+    possible (see config.DELTA_UPDATES), otherwise in full. A zip rebuilt
+    from a delta can only be checked against the CRC32 of each member,
+    which come with the download itself, and can't match a digest. So
+    when a `published_digest` is known, the release is downloaded in full
+    and checked against it.
+
+    Parameters
+    ----------
+    url: str, release zip URL.
+    output_path: str, file to write.
+    library: str, R library holding an installed copy of the package,
+             whose unchanged files can be reused.
+    cancel: threading.Event, stop the download when set.
+
+    Returns
+    -------
+    bool, whether the download completed.
+    """
+    expected = published_digest(url)
+    previous_zip = cached_artifact()
+    if config.DELTA_UPDATES and expected is None and \
+            (previous_zip or library):
+        try:
+            stats = delta_download(url, output_path, previous_zip, library,
+                                   cancel)
+            if stats is None:
+                return False
+            add_message(
+                "Updated from the previous release: reused {} files, "
+                "downloaded {} changed files ({:.0f} KB).".format(
+                    stats['reused'], stats['fetched'],
+                    stats['bytes'] / 1024.0))
+            return True
+        except (DeltaUnavailable, IOError, OSError) as e:
+            add_message("Downloading the full release ({}).".format(e))
+            if os.path.exists(output_path):
+                os.remove(output_path)
+    return save_url(url, output_path, cancel, expected)
 
 
 def parse_json_url(url):
@@ -75,11 +185,12 @@ def parse_json_url(url):
         time.sleep(3)
 
     if err_msg:
-        arcpy.AddWarning(err_msg)
+        add_warning(err_msg)
 
     return res
 
 
+@traced()
 def release_info():
     """Get latest release version and download URL from
        the GitHub API.
@@ -96,8 +207,93 @@ def release_info():
                 'tag_name' in json_r:
             download_url = assets['browser_download_url']
             tag = json_r['tag_name']
+            digest = normalize_digest(assets.get('digest'))
+            if digest:
+                _published_digests[download_url] = digest
         if not download_url or not tag:
-            arcpy.AddError("Invalid GitHub API response for URL '{}'".format(
+            add_error("Invalid GitHub API response for URL '{}'".format(
                 latest_url))
 
     return (download_url, tag)
+
+
+class ReleasePrefetch(object):
+    """Look up the latest release and download it on a background thread,
+    while the caller validates the environment. Messages from the
+    background thread are sent from the caller's, by `release` and
+    `artifact`.
+
+    Parameters
+    ----------
+    need_download: callable, run on the background thread with the
+                   (download_url, tag_name) release. Return False to skip
+                   the download, e.g. when a local copy of the package
+                   exists.
+    library: str, R library the package is installed into, whose files
+             may be reused by a delta update.
+    """
+
+    def __init__(self, need_download=None, library=None):
+        self._need_download = need_download
+        self._library = library
+        self._cancel = threading.Event()
+        self._temp_dir = tempfile.mkdtemp(prefix='rtools')
+        self._release = None
+        self._artifact = None
+        self._messages = []
+        self._messages_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        with buffered(self._messages):
+            self._fetch()
+
+    def _fetch(self):
+        try:
+            self._release = release_info()
+            download_url = self._release[0]
+            if not download_url or self._cancel.is_set():
+                return
+            if self._need_download is not None and \
+                    not self._need_download(self._release):
+                return
+            output_path = os.path.join(
+                self._temp_dir, os.path.basename(download_url))
+            if fetch_release(download_url, output_path, self._library,
+                             self._cancel):
+                self._artifact = output_path
+        finally:
+            if self._cancel.is_set():
+                shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+    def release(self):
+        """Wait for the release lookup.
+
+        Returns: (download_url, tag_name) tuple."""
+        while self._release is None and self._thread.is_alive():
+            self._thread.join(0.1)
+        self._replay()
+        return self._release or (None, None)
+
+    def artifact(self):
+        """Wait for the download.
+
+        Returns: path of the downloaded zip, or None."""
+        self._thread.join()
+        self._replay()
+        return self._artifact
+
+    def _replay(self):
+        """Send the messages of the background thread so far."""
+        with self._messages_lock:
+            while self._messages:
+                replay([self._messages.pop(0)])
+
+    def cancel(self):
+        """Stop any download in progress, and remove what was fetched. Safe
+        to call once the prefetched artifact has been consumed."""
+        self._cancel.set()
+        if not self._thread.is_alive():
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
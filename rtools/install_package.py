@@ -3,8 +3,6 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 
-import arcpy
-
 import glob
 import os
 import shutil
@@ -20,21 +18,42 @@ except (ImportError, TypeError):
     kdll = None
 
 from .bootstrap_r import execute_r
-from .github_release import save_url, release_info
+from .compat import compatibility, install_method, parse_version
+from .dedup import dedup_packages
+from .delta import cache_artifact
+from .github_release import fetch_release, ReleasePrefetch
+from .integrity import (
+    IntegrityError,
+    local_digest,
+    stage_verified,
+    write_manifest,
+)
+from .messages import add_error, add_message, add_warning
 from .rpath import (
+    arcgis_install_info,
+    r_all_lib_paths,
     r_lib_path,
     r_path,
     r_pkg_path,
     r_pkg_version,
     r_user_lib_path,
     r_version,
+    registry_key,
     arcmap_exists,
     arcmap_path,
     fnf_exception,
     handle_fnf,
 )
-from .utils import mkdtemp, set_env_tmpdir
+from .utils import mkdtemp, r_tmpdir
 from .fs import getvolumeinfo, hardlinks_supported, junctions_supported
+from .logs import dump_recent
+from .lock import install_lock, record_install
+from .plan import Plan
+from .probe import invalidate, is_remote
+from .repository import RepositoryError, install_from_repositories
+from .update_check import record_release
+from . import config
+from . import versions
 try:
     import winreg
 except ImportError:
@@ -42,7 +61,21 @@ except ImportError:
     import _winreg as winreg
 
 PACKAGE_NAME = 'arcgisbinding'
-PACKAGE_VERSION = r_pkg_version()
+
+# install.packages() into a staging directory, for side by side installs.
+# R only looks for the dependencies in its libraries, so those missing are
+# installed into the library first, and only the package is staged.
+STAGED_INSTALL_SCRIPT = """repos <- c({repos})
+db <- available.packages(repos=repos, type="win.binary")
+deps <- tools::package_dependencies(
+    "{package}", db=db, which=c("Depends", "Imports"), recursive=TRUE)[[1]]
+deps <- setdiff(deps, c("R", rownames(installed.packages())))
+if (length(deps) > 0) {{
+    install.packages(deps, repos=repos, type="win.binary", lib="{library}")
+}}
+install.packages("{package}", repos=repos, type="win.binary",
+                 lib="{staging}", dependencies=FALSE)
+"""
 
 
 def bridge_running(product):
@@ -62,9 +95,27 @@ def bridge_running(product):
     return running
 
 
+def local_package_zip():
+    """Find a copy of the package zip placed next to the toolbox, used for
+    offline installation.
+
+    Returns: path to the zip, or None."""
+    zip_path = None
+    base_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')
+    zip_glob = glob.glob(os.path.join(base_path, "arcgisbinding*.zip"))
+    if zip_glob and os.path.exists(zip_glob[0]):
+        zip_path = zip_glob[0]
+    return zip_path
+
+
 def arcgis_platform():
-    """ ArcGIS platform details used internally."""
-    info = arcpy.GetInstallInfo()
+    """ ArcGIS platform details used internally.
+
+    Returns: (install_dir, arc_version, product) tuple, all None when
+    the ArcGIS installation is unknown."""
+    info = arcgis_install_info()
+    if info is None:
+        return (None, None, None)
     install_dir = info['InstallDir']
     arc_version = info['Version']
     if info['ProductName'] == 'ArcGISPro':
@@ -76,193 +127,620 @@ def arcgis_platform():
     return (install_dir, arc_version, product)
 
 
-def validate_environment(overwrite=None):
-    """Make sure we have a version of the product that works, and that
-    the library isn't already loaded."""
+def environment_problems(overwrite, product, arc_version):
+    """Check that we have a version of the product that works, and that
+    the library isn't already loaded.
 
-    (install_dir, arc_version, product) = arcgis_platform()
-    # earlier versions excluded by virtue of not having Python toolbox support
-    no_hook_versions = ('10.1', '10.2', '10.2.1', '10.2.2', '10.3')
-    valid_env = True
+    Returns: list of messages describing each problem found."""
     msg = []
-    if arc_version in no_hook_versions and product is not 'Pro':
-        msg.append("The ArcGIS R bridge requires ArcGIS 10.3.1 or later.")
-        valid_env = False
-
-    if arc_version in ('1.0', '1.0.2') and product == 'Pro':
-        msg.append("The ArcGIS R bridge requires ArcGIS Pro 1.1 or later.")
-        valid_env = False
+    if product is None:
+        msg.append("Unable to determine the ArcGIS installation. Run this "
+                   "tool from ArcGIS, or provide the installation details.")
+    else:
+        problem = compatibility(product, arc_version, r_version()).problem
+        if problem:
+            msg.append(problem)
 
-    if not overwrite and PACKAGE_VERSION:
-        msg.append("The ArcGIS R bridge is already installed, and " 
-             "overwrite is disabled.")
-        valid_env = False
+    if not overwrite and r_pkg_version():
+        msg.append("The ArcGIS R bridge is already installed, and "
+                   "overwrite is disabled.")
 
     if kdll is None:
         msg.append("Unable to connect to your Windows configuration, "
-              "this is likely due to an incorrect Python installation. "
-              "Try repairing your ArcGIS installation.")
-        valid_env = False
+                   "this is likely due to an incorrect Python installation. "
+                   "Try repairing your ArcGIS installation.")
 
     # check the library isn't loaded
     if kdll is not None and bridge_running(product):
         msg.append("The ArcGIS R bridge is currently in-use, restart the "
-              "application and try again.")
-        valid_env = False
+                   "application and try again.")
 
     if r_version() is None:
         msg.append("It doesn't look like R is installed. Install R prior "
                    "to running this tool.")
-        valid_env = False
+    return msg
+
 
-    if not valid_env:
-        arcpy.AddError("\n\n".join(msg))
+def validate_environment(overwrite=None):
+    """Make sure we have a version of the product that works, and that
+    the library isn't already loaded."""
+
+    (install_dir, arc_version, product) = arcgis_platform()
+    msg = environment_problems(overwrite, product, arc_version)
+    if msg:
+        add_error("\n\n".join(msg))
         sys.exit()
 
 
-def create_registry_entry(product, arc_version):
-    """Create a registry link back to the arcgisbinding package."""
-    root_key = winreg.HKEY_CURRENT_USER
+def create_registry_entry(product, arc_version, binding_path=None, sid=None):
+    """Create a registry link back to the arcgisbinding package.
+
+    Parameters
+    ----------
+    product: str, 'Pro' or 'ArcMap'.
+    arc_version: str, version of ArcGIS Desktop, used for its key name.
+    binding_path: str, package directory to link to. Defaults to the
+                  package within the highest-priority library.
+    sid: str, write the link for the user with this SID, instead of the
+         current user. The user's hive must be loaded.
+
+    Returns
+    -------
+    bool, whether the link was written.
+    """
+    if sid:
+        root_key = winreg.HKEY_USERS
+    else:
+        root_key = winreg.HKEY_CURRENT_USER
     if product == 'Pro':
         product_name = "ArcGISPro"
     else:
         product_name = "Desktop{}".format(arc_version)
     reg_path = "SOFTWARE\\Esri\\{}".format(product_name)
+    if sid:
+        reg_path = "{}\\{}".format(sid, reg_path)
 
     package_key = 'RintegrationProPackagePath'
-    link_key = None
-
-    try:
-        full_access = (winreg.KEY_WOW64_64KEY + winreg.KEY_ALL_ACCESS)
-        # find the key, 64- or 32-bit we want it all
-        link_key = winreg.OpenKey(root_key, reg_path, 0, full_access)
-    except fnf_exception as error:
-        handle_fnf(error)
-
-    if link_key:
-        try:
-            arcpy.AddMessage("Using registry key to link install.")
-            binding_path = "{}\\{}".format(r_lib_path(), "arcgisbinding")
-            winreg.SetValueEx(link_key, package_key, 0,
-                              winreg.REG_SZ, binding_path)
-        except fnf_exception as error:
-            handle_fnf(error)
-
-
-def install_package(overwrite=False, r_library_path=r_lib_path()):
-    """Install ArcGIS R bindings onto this machine."""
-    if overwrite is True:
-        overwrite = True
-    else:
-        overwrite = False
+    linked = False
 
+    full_access = (winreg.KEY_WOW64_64KEY + winreg.KEY_ALL_ACCESS)
+    # find the key, 64- or 32-bit we want it all
+    with registry_key(root_key, reg_path, full_access) as link_key:
+        if link_key:
+            try:
+                if not sid:
+                    add_message("Using registry key to link install.")
+                if binding_path is None:
+                    binding_path = "{}\\{}".format(
+                        r_lib_path(), "arcgisbinding")
+                winreg.SetValueEx(link_key, package_key, 0,
+                                  winreg.REG_SZ, binding_path)
+                linked = True
+            except fnf_exception as error:
+                handle_fnf(error)
+
+    return linked
+
+
+def _release_zip_needed(release, force=False):
+    """Whether installation will need the release zip from GitHub: R 4.0+
+    installs from the repository, a local zip is used when present, and
+    nothing is needed when the release is already installed."""
+    tag = release[1]
+    if not force and tag and r_pkg_version() == tag.strip('v'):
+        return False
+    library = r_lib_path()
+    if not force and tag and versions.enabled(library) and \
+            tag.strip('v') in versions.installed_versions(library):
+        # kept from an earlier install, switching to it is enough
+        return False
+    from_repository = install_method(r_version()) == 'repository'
+    return not from_repository and local_package_zip() is None
+
+
+def _step_platform(context):
     (install_dir, arc_version, product) = arcgis_platform()
-    arcmap_needs_link = False
+    return {'install_dir': install_dir, 'arc_version': arc_version,
+            'product': product}
+
+
+def _step_validate(context):
+    msg = environment_problems(
+        context['overwrite'], context['product'], context['arc_version'])
+    if msg:
+        add_error("\n\n".join(msg))
+        return False
+    return {'valid': True}
+
 
-    # check that we're in a sane installation environment
-    validate_environment(overwrite)
+def _step_arcmap(context):
+    product = context['product']
+    arcmap_dir = None
 
     # detect if we we have a 10.3.1 install that needs linking
     if product == 'Pro' and arcmap_exists("10.3"):
-        arcmap_needs_link = True
+        arcmap_dir = arcmap_path("10.3")
         msg_base = "Pro side by side with 10.3 detected,"
-        if arcmap_path() is not None:
+        if arcmap_dir is not None:
             msg = "{} installing bridge for both environments.".format(msg_base)
-            arcpy.AddMessage(msg)
+            add_message(msg)
         else:
             msg = "{} but unable to find install path.".format(msg_base) + \
                   "ArcGIS bridge must be manually installed in ArcGIS 10.3."
-            arcpy.AddWarning(msg)
+            add_warning(msg)
 
-    # if we're going to install the bridge in 10.3.1, create the appropriate
-    # directory before trying to install.
-    if arc_version == '10.3.1' and product == 'ArcMap' or arcmap_needs_link:
-        r_integration_dir = os.path.join(arcmap_path(), "Rintegration")
-        # TODO escalate privs here? test on non-admin user
-        if not os.path.exists(r_integration_dir):
-            try:
-                write_test = os.path.join(install_dir, 'test.txt')
-                with open(write_test, 'w') as f:
-                    f.write('test')
-                os.remove(write_test)
-                os.makedirs(r_integration_dir)
-            except IOError:
-                arcpy.AddError(
-                    "Insufficient privileges to create 10.3.1 bridge directory."
-                    " Please start {} as an administrator, by right clicking"
-                    " the icon, selecting \"Run as Administrator\", then run this"
-                    " script again.".format(product))
-                return
+    r_integration_dir = None
+    if compatibility(product, context['arc_version'],
+                     r_version()).link_rintegration:
+        arcmap_dir = arcmap_path("10.3")
+    if arcmap_dir is not None:
+        r_integration_dir = os.path.join(arcmap_dir, "Rintegration")
+    return {'r_integration_dir': r_integration_dir}
 
-    # set an R-compatible temporary folder, if needed.
-    orig_tmpdir = os.getenv("TMPDIR")
-    if not orig_tmpdir:
-        set_env_tmpdir()
 
-    download_url = release_info()[0]
+def _step_release(context):
+    (download_url, tag) = context['prefetch'].release()
+    record_release((download_url, tag))
     if download_url is None:
-        arcpy.AddWarning(
+        add_warning(
             "Unable to get current release information."
             " Trying offline installation.")
 
     local_install = False
-    base_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')
-    zip_glob = glob.glob(os.path.join(base_path, "arcgisbinding*.zip"))
+    zip_path = local_package_zip()
     # see if we have a local copy of the binding
-    if zip_glob and os.path.exists(zip_glob[0]):
+    if zip_path:
         local_install = True
-        zip_path = zip_glob[0]
         zip_name = os.path.basename(zip_path)
     elif not download_url and not local_install:
-        arcpy.AddError(
+        add_error(
             "Unable to access online package, and no "
             "local copy of package found.")
-        return
+        return False
     else:
         local_install = False
         zip_name = os.path.basename(download_url)
 
+    release_version = package_version_from_name(zip_name)
+    if release_version is None and tag:
+        release_version = tag.strip('v')
+
+    return {'download_url': download_url, 'zip_path': zip_path,
+            'zip_name': zip_name, 'local_install': local_install,
+            'release_version': release_version}
+
+
+def _rintegration_dir_satisfied(context):
+    r_integration_dir = context['r_integration_dir']
+    return r_integration_dir is None or os.path.exists(r_integration_dir)
+
+
+def _step_rintegration_dir(context):
+    # if we're going to install the bridge in 10.3.1, create the appropriate
+    # directory before trying to install.
+    # TODO escalate privs here? test on non-admin user
+    try:
+        write_test = os.path.join(context['install_dir'], 'test.txt')
+        with open(write_test, 'w') as f:
+            f.write('test')
+        os.remove(write_test)
+        os.makedirs(context['r_integration_dir'])
+    except IOError:
+        add_error(
+            "Insufficient privileges to create 10.3.1 bridge directory."
+            " Please start {} as an administrator, by right clicking"
+            " the icon, selecting \"Run as Administrator\", then run this"
+            " script again.".format(context['product']))
+        return False
+    return {'rintegration_ready': True}
+
+
+def _install_satisfied(context):
+    release_version = context['release_version']
+    return not context['force'] and release_version is not None and \
+        r_pkg_version() == release_version
+
+
+def _step_install(context):
+    # set an R-compatible temporary folder, if needed.
+    with r_tmpdir():
+        return _install_locked(context)
+
+
+def _install_locked(context):
+    r_library_path = context['r_library_path']
+    release_version = context['release_version']
+
     # check for a network-based R installation
-    if r_path() and r_path()[0:2] == r'\\':
-        arcpy.AddMessage(
+    if is_remote(r_path()):
+        add_message(
             "R installed on a network path, using fallback installation method.")
         r_local_install = False
     else:
         r_local_install = True
 
+    # other sessions (e.g. login scripts) may be installing into the same
+    # library, wait for them rather than interleaving the installs.
+    lock_dir = r_library_path or r_user_lib_path()
+    with install_lock(lock_dir) as lock_state:
+        if lock_state['timed_out']:
+            return False
+        previous = lock_state['previous']
+        if previous and release_version and \
+                previous.get('version') == release_version:
+            add_message(
+                "Version {} was just installed by {}, skipping.".format(
+                    release_version, previous.get('user')))
+        elif not context['force'] and release_version and \
+                versions.enabled(lock_dir) and \
+                release_version in versions.installed_versions(lock_dir):
+            add_message("Version {} is already installed side by side, "
+                        "switching to it.".format(release_version))
+            versions.activate(lock_dir, release_version)
+        else:
+            installed = _install_release(
+                context['zip_name'], context['zip_path'],
+                context['download_url'], context['local_install'],
+                r_local_install, context['prefetch'], lock_dir)
+            if not installed:
+                return False
+            record_install(lock_dir, release_version)
+            _record_manifest(lock_dir, release_version)
+    return {'installed': True}
+
+
+def _record_manifest(library, version):
+    """Keep a manifest of the installed files, for `rtools.integrity`."""
+    package_dir = os.path.join(library, PACKAGE_NAME)
+    if not os.path.isdir(package_dir):
+        # installed elsewhere by the fallback method
+        package_dir = r_pkg_path()
+    if package_dir and write_manifest(os.path.dirname(package_dir),
+                                      PACKAGE_NAME, version) is None:
+        add_warning("Unable to record the installed files, they can't be "
+                    "verified later.")
+
+
+def _dedup_satisfied(context):
+    return not context['dedup']
+
+
+def _step_dedup(context):
+    result = dedup_packages()
+    if result['linked']:
+        add_message("Linked {} identical package files across {} "
+                    "libraries, saving {:.1f} MB.".format(
+                        result['linked'], len(result['trees']),
+                        result['bytes_saved'] / 1024.0 ** 2))
+    if result['failed']:
+        add_warning("Unable to link {} package files, they may be in "
+                    "use.".format(len(result['failed'])))
+    return {'deduplicated': True}
+
+
+def _step_patch_check(context):
+    arc_version = context['arc_version']
+    product = context['product']
+    r_library_path = context['r_library_path']
+    # at 10.4 and Pro <=1.2, if the user has installed a version with a non-
+    # numeric patch level (e.g. 3.2.4revised), and the bridge is installed
+    # into Program Files, the link will fail. In this case, set the
+    # appropriate registry key so that the bridge will still work. Note that
+    # this isn't ideal, because it will persist after updates, but it is
+    # better than the bridge failing to work at all.
+    r_version_raw = r_version()
+    if compatibility(product, arc_version, r_version_raw).patch_level_check:
+        version = parse_version(r_version_raw)
+        if version is not None:
+            # if we have a patchlevel like '4revised' or '3alpha', and
+            # the global library path is used, then use the registry key.
+            if version.suffix and 'Program Files' in r_library_path:
+                # create_registry_entry(product, arc_version)
+                msg = ("Currently, the bridge doesn't support patched releases"
+                       " (e.g. 3.2.4 Revised) in a global install. Please use"
+                       " another version of R.")
+                add_error(msg)
+                return False
+    return {'patch_checked': True}
+
+
+def _link_satisfied(context):
+    r_integration_dir = context['r_integration_dir']
+    if r_integration_dir is None:
+        return True
+    link_dir = os.path.join(r_integration_dir, PACKAGE_NAME)
+    r_package_path = r_pkg_path()
+    return os.path.exists(link_dir) and r_package_path is not None and \
+        os.path.realpath(link_dir) == os.path.realpath(r_package_path)
+
+
+def _step_link(context):
+    # at 10.3.1, we _must_ have the bridge installed at the correct location.
+    # create a symlink that connects back to the correct location on disk.
+    r_integration_dir = context['r_integration_dir']
+    with install_lock(r_integration_dir) as lock_state:
+        if lock_state['timed_out']:
+            return False
+        if link_arcmap(r_integration_dir) is False:
+            return False
+    return {'linked': True}
+
+
+def install_plan():
+    """The steps to install the bridge, with their inputs and outputs.
+    Expects a context with 'overwrite', 'force', 'r_library_path',
+    'prefetch' and 'dedup' values.
+
+    Returns: `rtools.plan.Plan`."""
+    plan = Plan('install')
+    plan.add('platform', _step_platform, probe=True,
+             provides=('install_dir', 'arc_version', 'product'),
+             description="Detect the ArcGIS product and version")
+    plan.add('release', _step_release, probe=True,
+             requires=('prefetch',),
+             provides=('download_url', 'zip_path', 'zip_name',
+                       'local_install', 'release_version'),
+             description="Find the latest release, or a local zip")
+    plan.add('validate', _step_validate, probe=True,
+             requires=('overwrite', 'product', 'arc_version'),
+             provides=('valid',),
+             description="Check ArcGIS, R, and that the bridge isn't loaded")
+    plan.add('arcmap', _step_arcmap, probe=True,
+             requires=('product', 'arc_version'),
+             provides=('r_integration_dir',),
+             description="Detect ArcMap installs needing a package link")
+    plan.add('rintegration_dir', _step_rintegration_dir,
+             requires=('valid', 'install_dir', 'r_integration_dir'),
+             provides=('rintegration_ready',),
+             satisfied=_rintegration_dir_satisfied,
+             description="Create the ArcMap Rintegration directory")
+    plan.add('install', _step_install,
+             requires=('valid', 'force', 'r_library_path', 'release_version',
+                       'rintegration_ready'),
+             provides=('installed',),
+             satisfied=_install_satisfied,
+             description="Install the package into R")
+    plan.add('patch_check', _step_patch_check,
+             requires=('installed',),
+             provides=('patch_checked',),
+             description="Check for unsupported patched R releases")
+    plan.add('link', _step_link,
+             requires=('patch_checked', 'r_integration_dir'),
+             provides=('linked',),
+             satisfied=_link_satisfied,
+             description="Link the package into ArcMap Rintegration")
+    plan.add('dedup', _step_dedup,
+             requires=('installed', 'dedup'),
+             provides=('deduplicated',),
+             satisfied=_dedup_satisfied,
+             description="Link identical package files across libraries")
+    return plan
+
+
+def install_package(overwrite=False, r_library_path=None,
+                    dry_run=False, force=False, dedup=None):
+    """Install ArcGIS R bindings onto this machine.
+
+    Parameters
+    ----------
+    overwrite: bool, replace an existing installation.
+    r_library_path: str, library to install into. Defaults to the
+                    highest-priority library.
+    dry_run: bool, only inspect this machine, and print the steps that
+             would run.
+    force: bool, reinstall even when the release is already installed.
+    dedup: bool, afterwards link identical package files across libraries,
+           see `rtools.dedup`. Defaults to config.DEDUP_AFTER_INSTALL.
+
+    Returns
+    -------
+    list of (step, status) tuples, see `rtools.plan.Plan.run`.
+    """
+    if overwrite is True:
+        overwrite = True
+    else:
+        overwrite = False
+    if r_library_path is None:
+        r_library_path = r_lib_path()
+    if dedup is None:
+        dedup = config.DEDUP_AFTER_INSTALL
+
+    # the release lookup and download only wait on the network, start them
+    # while we inspect the local environment.
+    if dry_run:
+        need_download = lambda release: False
+    else:
+        need_download = lambda release: _release_zip_needed(release, force)
+    prefetch = ReleasePrefetch(need_download=need_download,
+                               library=r_library_path)
+
+    context = {'overwrite': overwrite, 'force': force,
+               'r_library_path': r_library_path, 'prefetch': prefetch,
+               'dedup': dedup}
+    plan = install_plan()
+    try:
+        report = plan.run(context, dry_run=dry_run)
+    finally:
+        # stops the prefetch if we bailed out early, and cleans up
+        # whatever it fetched.
+        prefetch.cancel()
+
+    if any(status == 'failed' for (step, status) in report):
+        log_path = dump_recent()
+        if log_path:
+            add_message("Recent log messages written to {}.".format(
+                log_path))
+
+    if dry_run:
+        add_message("Installation plan:\n{}".format(
+            "\n".join(plan.describe(report))))
+    else:
+        for (step, status) in report:
+            if status == 'satisfied' and not step.probe and \
+                    step.name not in ('rintegration_dir', 'dedup'):
+                add_message("{}: already up to date.".format(
+                    step.description))
+    return report
+
+
+def package_version_from_name(zip_name):
+    """Parse the package version from a release file name, such as
+    arcgisbinding_1.0.1.244.zip.
+
+    Returns: version string, or None."""
+    version = None
+    if zip_name:
+        base = os.path.splitext(os.path.basename(zip_name))[0]
+        if base.startswith("{}_".format(PACKAGE_NAME)):
+            version = base.split('_', 1)[1]
+    return version
+
+
+def _activate_staged(library, staging):
+    """Move a version installed into a staging directory into the side by
+    side store of a library, switch to it, and remove old versions.
+
+    Returns: True if the package was installed."""
+    version = versions.commit_staged(library, staging)
+    if version is None:
+        add_error("The package wasn't installed into {}.".format(staging))
+        return False
+    versions.activate(library, version)
+    add_message("Version {} is now active in {}.".format(version, library))
+    removed = versions.prune(library)
+    if removed:
+        add_message("Removed old versions: {}.".format(", ".join(removed)))
+    return True
+
+
+def _install_from_repositories(library, staging):
+    """Install the package and its missing dependencies from the R
+    repositories, see `rtools.repository`.
+
+    Returns: True if installed, False if `Rcmd INSTALL` failed, or None
+    when the repositories couldn't be used and install.packages() should
+    be tried instead."""
+    library = library or r_lib_path() or r_user_lib_path()
+    if library is None:
+        return None
+    try:
+        installed = install_from_repositories(
+            [PACKAGE_NAME], library, r_version(), r_all_lib_paths(),
+            target=staging)
+    except (RepositoryError, IOError, OSError) as e:
+        add_warning("{} Falling back to install.packages().".format(e))
+        return None
+    if installed is None:
+        add_error("Failed to install the bridge from the R repositories.")
+        return False
+    dependencies = [name for name in installed if name != PACKAGE_NAME]
+    if dependencies:
+        add_message("Installed dependencies: {}.".format(
+            ", ".join(dependencies)))
+    if staging is not None:
+        return _activate_staged(library, staging)
+    return True
+
+
+def _install_release(zip_name, zip_path, download_url, local_install,
+                     r_local_install, prefetch=None, library=None,
+                     sha256=None, from_zip=False):
+    """Install the package into R, from the R repository for R 4.0+,
+    otherwise from the release zip. When the library supports it, the
+    package is installed side by side with earlier versions, see
+    `rtools.versions`.
+
+    Parameters
+    ----------
+    sha256: str, digest the local zip must have, instead of its
+            `rtools.integrity.local_digest`.
+    from_zip: bool, install the local zip even for R 4.0+, e.g. when
+              replaying a lockfile.
+
+    Returns: True if the package was found for installation."""
+    staging = None
+    if r_local_install and versions.enabled(library):
+        staging = versions.staging_dir(library)
+    try:
+        return _install_release_into(
+            zip_name, zip_path, download_url, local_install,
+            r_local_install, prefetch, library, staging, sha256, from_zip)
+    finally:
+        if staging is not None and os.path.exists(staging):
+            # a failed install, or the fallback method was used
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def _install_release_into(zip_name, zip_path, download_url, local_install,
+                          r_local_install, prefetch, library, staging,
+                          sha256, from_zip):
     # we have a release, write it to disk for installation
     with mkdtemp() as temp_dir:
         # For R 4.0+, check version from GitHub but install via repo
-        if r_version() and r_version().split(".")[0] == '4':
+        if install_method(r_version()) == 'repository' and not from_zip:
+            if config.RESOLVE_DEPENDENCIES and r_local_install:
+                installed = _install_from_repositories(library, staging)
+                if installed is not None:
+                    return installed
             cmd = "install.packages(\"arcgisbinding\", repos=\"https://r.esri.com\", type=\"win.binary\")"
+            script = cmd
+            if staging is not None:
+                script = STAGED_INSTALL_SCRIPT.format(
+                    repos=", ".join('"{}"'.format(repo)
+                                    for repo in config.R_REPOSITORIES),
+                    package=PACKAGE_NAME,
+                    library=library.replace("\\", "/"),
+                    staging=staging.replace("\\", "/"))
             install_script = os.path.join(temp_dir, 'install.R')
             with open(install_script, 'w') as f:
-                f.write(cmd)
+                f.write(script)
             rcmd_return = execute_r("Rscript", install_script)
             if rcmd_return != 0:
-                arcpy.AddError("Failed to install bridge with `install.packages`, try manualy running the command `{cmd}` from an R session or RStudio.")
+                add_error("Failed to install bridge with `install.packages`, try manualy running the command `{}` from an R session or RStudio.".format(cmd))
+            elif staging is not None:
+                return _activate_staged(library, staging)
         else:
             package_path = os.path.join(temp_dir, zip_name)
             if local_install:
-                arcpy.AddMessage("Found local copy of binding, installing from zip")
-                shutil.copyfile(zip_path, package_path)
+                add_message("Found local copy of binding, installing from zip")
+                try:
+                    package_path = stage_verified(
+                        zip_path, temp_dir, sha256 or local_digest(zip_path))
+                except IntegrityError as e:
+                    add_error(str(e))
+                    return False
             else:
-                save_url(download_url, package_path)
+                prefetched_path = None
+                if prefetch is not None:
+                    prefetched_path = prefetch.artifact()
+                if prefetched_path:
+                    # removed by the prefetch once the install is done
+                    package_path = prefetched_path
+                else:
+                    fetch_release(download_url, package_path,
+                                  library or r_lib_path())
             if os.path.exists(package_path):
                 # TODO -- need to do UAC escalation here?
                 # call the R installation script
                 rcmd_return = 0
-                if r_local_install:
+                if staging is not None:
+                    rcmd_return = execute_r(
+                        'Rcmd', 'INSTALL', '--library={}'.format(staging),
+                        package_path)
+                    if rcmd_return == 0 and \
+                            not _activate_staged(library, staging):
+                        rcmd_return = 1
+                elif r_local_install:
                     rcmd_return = execute_r('Rcmd', 'INSTALL', package_path)
                 if not r_local_install or rcmd_return != 0:
                     # if we don't have a per-user library, create one
                     r_user_lib = r_user_lib_path()
                     if not os.path.exists(r_user_lib):
                         try:
-                            arcpy.AddMessage("Creating per-user library directory")
+                            add_message("Creating per-user library directory")
                             os.makedirs(r_user_lib)
                         except OSError:
-                            arcpy.AddWarning("Failed to create per-user library.")
+                            add_warning("Failed to create per-user library.")
                     # Can't execute Rcmd in this context, write out a temporary
                     # script and run install.packages() from within an R session.
                     install_script = os.path.join(temp_dir, 'install.R')
@@ -271,69 +749,54 @@ def install_package(overwrite=False, r_library_path=r_lib_path()):
                             package_path.replace("\\", "/")))
                     rcmd_return = execute_r("Rscript", install_script)
                     if rcmd_return != 0:
-                        arcpy.AddWarning("Fallback installation method failed.")
+                        add_warning("Fallback installation method failed.")
+                if rcmd_return == 0 and not local_install:
+                    # the base of the next delta update. A local zip, as
+                    # on a share or removable drive, would be copied
+                    cache_artifact(package_path)
             else:
-                arcpy.AddError("No package found at {}".format(package_path))
-                return
+                add_error("No package found at {}".format(package_path))
+                return False
+    return True
 
-    # return TMPDIR to its original value; only need it for Rcmd INSTALL
-    set_env_tmpdir(orig_tmpdir)
 
-    # at 10.4 and Pro <=1.2, if the user has installed a version with a non-
-    # numeric patch level (e.g. 3.2.4revised), and the bridge is installed
-    # into Program Files, the link will fail. In this case, set the
-    # appropriate registry key so that the bridge will still work. Note that
-    # this isn't ideal, because it will persist after updates, but it is
-    # better than the bridge failing to work at all.
-    if (arc_version == '10.4' and product == 'Desktop') or \
-            (arc_version in ('1.1', '1.1.1', '1.2')
-             and product == 'Pro'):
-
-        if r_version():
-            (r_major, r_minor, r_patchlevel) = r_version().split(".")
-            # if we have a patchlevel like '4revised' or '3alpha', and
-            # the global library path is used, then use the registry key.
-            if len(r_patchlevel) > 1 and 'Program Files' in r_library_path:
-                # create_registry_entry(product, arc_version)
-                msg = ("Currently, the bridge doesn't support patched releases"
-                       " (e.g. 3.2.4 Revised) in a global install. Please use"
-                       " another version of R.")
-                arcpy.AddError(msg)
-                return
+def link_arcmap(r_integration_dir):
+    """Link the installed package into the ArcGIS 10.3.1 Rintegration
+    directory, copying it on volumes without link support.
 
-    # at 10.3.1, we _must_ have the bridge installed at the correct location.
-    # create a symlink that connects back to the correct location on disk.
-    if arc_version == '10.3.1' and product == 'ArcMap' or arcmap_needs_link:
-        link_dir = os.path.join(r_integration_dir, PACKAGE_NAME)
+    Returns: False if the package couldn't be found."""
+    link_dir = os.path.join(r_integration_dir, PACKAGE_NAME)
 
-        if os.path.exists(link_dir):
-            if junctions_supported(link_dir) or hardlinks_supported(link_dir):
-                # os.rmdir uses RemoveDirectoryW, and can delete a junction
-                os.rmdir(link_dir)
-            else:
-                shutil.rmtree(link_dir)
+    if os.path.exists(link_dir):
+        if junctions_supported(link_dir) or hardlinks_supported(link_dir):
+            # os.rmdir uses RemoveDirectoryW, and can delete a junction
+            os.rmdir(link_dir)
+        else:
+            shutil.rmtree(link_dir)
+        invalidate()
 
-        # set up the link
-        r_package_path = r_pkg_path()
+    # set up the link
+    r_package_path = r_pkg_path()
 
-        if r_package_path:
-            arcpy.AddMessage("R package path: {}.".format(r_package_path))
-        else:
-            arcpy.AddError("Unable to locate R package library. Link failed.")
-            return
+    if r_package_path:
+        add_message("R package path: {}.".format(r_package_path))
+    else:
+        add_error("Unable to locate R package library. Link failed.")
+        return False
 
-        detect_msg = "ArcGIS 10.3.1 detected."
-        if junctions_supported(link_dir) or hardlinks_supported(link_dir):
-            arcpy.AddMessage("{} Creating link to package.".format(detect_msg))
-            kdll.CreateSymbolicLinkW(link_dir, r_package_path, 1)
-        else:
-            # working on a non-NTFS volume, copy instead
-            vol_info = getvolumeinfo(link_dir)
-            arcpy.AddMessage("{} Drive type: {}. Copying package files.".format(
-                detect_msg, vol_info[0]))
-            # NOTE: this will need to be resynced when the package is updated,
-            #       if installed from the R side.
-            shutil.copytree(r_package_path, link_dir)
+    detect_msg = "ArcGIS 10.3.1 detected."
+    if junctions_supported(link_dir) or hardlinks_supported(link_dir):
+        add_message("{} Creating link to package.".format(detect_msg))
+        kdll.CreateSymbolicLinkW(link_dir, r_package_path, 1)
+    else:
+        # working on a non-NTFS volume, copy instead
+        vol_info = getvolumeinfo(link_dir)
+        add_message("{} Drive type: {}. Copying package files.".format(
+            detect_msg, vol_info[0]))
+        # NOTE: this will need to be resynced when the package is updated,
+        #       if installed from the R side.
+        shutil.copytree(r_package_path, link_dir)
+    invalidate()
 
 # execute as standalone script, get parameters from sys.argv
 if __name__ == '__main__':
@@ -0,0 +1,300 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import time
+
+from . import config
+from .fs import create_hard_link
+from .probe import is_remote
+from .utils import parallel_map
+
+# Integrity checks: release zips are hashed with SHA-256 as they are
+# written, and compared with a published or configured digest. After an
+# install, a manifest of the package's files is kept in the library, so
+# the installed files can later be checked against it, hashing many files
+# at once.
+
+MANIFEST_NAME = '.rtools-manifest.json'
+SIDECAR_EXTENSION = '.sha256'
+
+# read files in 1MB chunks
+CHUNK_SIZE = 1024 * 1024
+
+
+class IntegrityError(Exception):
+    """A file doesn't match its expected digest."""
+
+
+def normalize_digest(digest):
+    """Lower case hex digest, without a 'sha256:' prefix as used by the
+    GitHub API.
+
+    Returns: str, or None for an empty digest."""
+    if not digest:
+        return None
+    digest = digest.strip().lower()
+    if digest.startswith('sha256:'):
+        digest = digest[len('sha256:'):]
+    return digest or None
+
+
+def check_digest(name, actual, expected):
+    """Raise IntegrityError if a digest doesn't match the expected one.
+    Nothing is checked when there is no expected digest."""
+    expected = normalize_digest(expected)
+    if expected and actual != expected:
+        raise IntegrityError(
+            "Checksum mismatch for {}: expected SHA-256 {}, got {}.".format(
+                name, expected, actual))
+
+
+def sha256_file(path):
+    """SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def local_digest(zip_path):
+    """Expected digest of a package zip placed next to the toolbox:
+    config.RELEASE_SHA256, or the first word of a zip.sha256 file beside
+    it, as written by sha256sum.
+
+    Returns: str, or None when there is nothing to check against."""
+    if config.RELEASE_SHA256:
+        return normalize_digest(config.RELEASE_SHA256)
+    try:
+        with open(zip_path + SIDECAR_EXTENSION) as f:
+            words = f.read().split()
+    except (IOError, OSError):
+        return None
+    return normalize_digest(words[0]) if words else None
+
+
+def copy_verified(src, dst, expected=None):
+    """Copy a file, hashing it on the way through rather than reading it
+    a second time.
+
+    Parameters
+    ----------
+    src: str, file to copy.
+    dst: str, destination path.
+    expected: str, SHA-256 digest the file must have. On a mismatch, the
+              copy is removed and IntegrityError raised.
+
+    Returns
+    -------
+    str, SHA-256 hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                fdst.write(chunk)
+    try:
+        check_digest(os.path.basename(src), digest.hexdigest(), expected)
+    except IntegrityError:
+        os.remove(dst)
+        raise
+    return digest.hexdigest()
+
+
+def stage_verified(src, staging_dir, expected=None):
+    """Make a file available to install from, copying it only when needed.
+
+    Without an expected digest, the file is used where it is, and a
+    missing or unreadable file is left for the install to report. Otherwise
+    the bytes checked must be the bytes installed: a local file is hard
+    linked into **staging_dir**, so replacing the original can't swap it
+    after the check, or checked in place where the volume has no hard
+    links. A file on a network share is copied, hashing it on the way
+    through, so it is read over the network once.
+
+    Parameters
+    ----------
+    src: str, file to stage.
+    staging_dir: str, directory for a link or copy, removed by the caller.
+    expected: str, SHA-256 digest the file must have, IntegrityError is
+              raised on a mismatch.
+
+    Returns
+    -------
+    str, path to install from: **src**, or a file within **staging_dir**
+    of the same name.
+
+    Raises
+    ------
+    IntegrityError, also when the file to check can't be read.
+    """
+    if not expected:
+        return src
+    dst = os.path.join(staging_dir, os.path.basename(src))
+    path = src
+    try:
+        if is_remote(src):
+            # removes a partial copy itself on a mismatch
+            path = dst
+            copy_verified(src, dst, expected)
+            return dst
+        try:
+            create_hard_link(dst, src)
+            path = dst
+        except (OSError, AttributeError):
+            # a FAT formatted drive, or another volume
+            pass
+        check_digest(os.path.basename(src), sha256_file(path), expected)
+        return path
+    except (IOError, OSError) as e:
+        if path == dst:
+            _remove(dst)
+        raise IntegrityError("Unable to check {}: {}".format(src, e))
+    except IntegrityError:
+        if path == dst:
+            _remove(dst)
+        raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _package_files(package_dir):
+    """Paths of the files in a package, relative to it, with '/'
+    separators."""
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(package_dir):
+        rel_dir = os.path.relpath(dirpath, package_dir)
+        for filename in filenames:
+            rel_path = os.path.normpath(os.path.join(rel_dir, filename))
+            files.append(rel_path.replace(os.sep, '/'))
+    return sorted(files)
+
+
+def _file_record(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime,
+            'sha256': sha256_file(path)}
+
+
+def write_manifest(library, package='arcgisbinding', version=None,
+                   workers=None):
+    """Record the size, modification time and SHA-256 of each file of an
+    installed package, in .rtools-manifest.json within its library.
+
+    Parameters
+    ----------
+    library: str, R library holding the package.
+    package: str, package name.
+    version: str, installed version.
+    workers: int, files hashed at once, defaults to config.VERIFY_WORKERS.
+
+    Returns
+    -------
+    dictionary written, or None if the package isn't there or the
+    manifest couldn't be written.
+    """
+    package_dir = os.path.join(library, package)
+    if not os.path.isdir(package_dir):
+        return None
+    files = _package_files(package_dir)
+    records = parallel_map(
+        lambda rel_path: _file_record(
+            os.path.join(package_dir, *rel_path.split('/'))),
+        files, workers or config.VERIFY_WORKERS)
+    manifest = {'package': package, 'version': version,
+                'created': time.time(), 'files': dict(zip(files, records))}
+    try:
+        with open(os.path.join(library, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    except (IOError, OSError):
+        return None
+    return manifest
+
+
+def read_manifest(library):
+    """The manifest written by the last install into a library.
+
+    Returns: dictionary, or None."""
+    try:
+        with open(os.path.join(library, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or 'files' not in manifest:
+        return None
+    return manifest
+
+
+def _check_file(path, record, quick):
+    """Compare a file with its manifest record.
+
+    Returns: 'ok', 'missing' or 'modified'."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 'missing'
+    if st.st_size != record['size']:
+        return 'modified'
+    if quick:
+        return 'ok' if st.st_mtime == record['mtime'] else 'modified'
+    try:
+        return 'ok' if sha256_file(path) == record['sha256'] else 'modified'
+    except (IOError, OSError):
+        return 'missing'
+
+
+def verify_install(library, quick=False, workers=None):
+    """Check an installed package against the manifest kept in its
+    library, hashing files on a pool of threads.
+
+    Parameters
+    ----------
+    library: str, R library holding the package.
+    quick: bool, only compare sizes and modification times.
+    workers: int, files checked at once, defaults to
+             config.VERIFY_WORKERS.
+
+    Returns
+    -------
+    dictionary with 'status', one of 'ok', 'modified' or 'no_manifest',
+    the 'package' and 'version' from the manifest, and lists of the
+    'missing', 'modified' and 'extra' files.
+    """
+    result = {'library': library, 'status': 'no_manifest', 'package': None,
+              'version': None, 'missing': [], 'modified': [], 'extra': []}
+    manifest = read_manifest(library)
+    if manifest is None:
+        return result
+    result['package'] = manifest.get('package')
+    result['version'] = manifest.get('version')
+    package_dir = os.path.join(library, manifest.get('package') or '')
+
+    files = sorted(manifest['files'])
+    outcomes = parallel_map(
+        lambda rel_path: _check_file(
+            os.path.join(package_dir, *rel_path.split('/')),
+            manifest['files'][rel_path], quick),
+        files, workers or config.VERIFY_WORKERS)
+    for (rel_path, outcome) in zip(files, outcomes):
+        if outcome != 'ok':
+            result[outcome].append(rel_path)
+    if os.path.isdir(package_dir):
+        known = set(files)
+        result['extra'] = [rel_path for rel_path in
+                           _package_files(package_dir)
+                           if rel_path not in known]
+
+    problems = result['missing'] or result['modified'] or result['extra']
+    result['status'] = 'modified' if problems else 'ok'
+    return result
@@ -0,0 +1,142 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+import json
+import os
+import time
+
+try:
+    import msvcrt
+except ImportError:
+    # non-Windows platforms, used when testing
+    msvcrt = None
+    import fcntl
+
+from .messages import add_error, add_message, add_warning
+from .rpath import _user
+
+LOCK_NAME = '.rtools-install.lock'
+STATE_NAME = '.rtools-install.json'
+
+
+def _try_lock(lock_file):
+    """Take an OS-level lock on the first byte of an open file. These locks
+    are released by the OS if the holder crashes, so they never go stale.
+
+    Returns: True if the lock was acquired."""
+    try:
+        if msvcrt:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _unlock(lock_file):
+    if msvcrt:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def last_install(directory):
+    """Read the version and time of the last install recorded for a
+    directory by a lock holder.
+
+    Returns: dictionary with 'version', 'time' and 'user' keys, or None."""
+    state = None
+    state_path = os.path.join(directory, STATE_NAME)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        pass
+    return state
+
+
+def record_install(directory, version):
+    """Record that the lock holder installed a version into a directory,
+    so that waiting installs can skip the same work."""
+    state_path = os.path.join(directory, STATE_NAME)
+    try:
+        with open(state_path, 'w') as f:
+            json.dump({'version': version, 'time': time.time(),
+                       'user': _user()}, f)
+    except (IOError, OSError):
+        pass
+
+
+@contextmanager
+def install_lock(directory, timeout=600, poll=1, report_every=10):
+    """Serialize installations into a directory across processes and users.
+
+    Parameters
+    ----------
+    directory: str, library or link directory being installed into. Created
+               if it doesn't exist yet.
+    timeout: int, seconds to wait for another installation to finish.
+    poll: int, seconds between attempts to take the lock.
+    report_every: int, seconds between progress messages while waiting.
+
+    Yields
+    ------
+    dict, with the keys:
+      'timed_out': bool, whether we gave up waiting for the lock.
+      'waited': bool, whether another installation held the lock first.
+      'previous': dict, the install recorded by a holder while we waited,
+                  see `last_install`. None if we didn't wait.
+    """
+    state = {'timed_out': False, 'waited': False, 'previous': None}
+    lock_file = None
+    acquired = False
+
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        lock_file = open(os.path.join(directory, LOCK_NAME), 'a+')
+    except (IOError, OSError) as e:
+        # can't create a lock where we can't write, installing there will
+        # fail with a more specific error.
+        add_warning("Unable to lock {}: {}".format(directory, e))
+
+    if lock_file:
+        start = time.time()
+        last_report = start
+        while not _try_lock(lock_file):
+            state['waited'] = True
+            now = time.time()
+            if now - start > timeout:
+                break
+            if now - last_report >= report_every:
+                add_message(
+                    "Waiting for another installation into {} to finish "
+                    "({:.0f}s)...".format(directory, now - start))
+                last_report = now
+            time.sleep(poll)
+        else:
+            acquired = True
+
+        if not acquired:
+            state['timed_out'] = True
+            add_error(
+                "Timed out after {}s waiting for another installation into"
+                " {}.".format(timeout, directory))
+        elif state['waited']:
+            previous = last_install(directory)
+            if previous and previous.get('time', 0) >= start:
+                state['previous'] = previous
+
+    try:
+        yield state
+    finally:
+        if lock_file:
+            if acquired:
+                _unlock(lock_file)
+            lock_file.close()
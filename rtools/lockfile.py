@@ -0,0 +1,398 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+import time
+
+from . import config
+from . import versions
+from .delta import ARTIFACT_DIR, cached_artifact
+from .github_release import save_url
+from .install_package import (
+    PACKAGE_NAME,
+    _install_release,
+    create_registry_entry,
+    link_arcmap,
+    local_package_zip,
+    package_version_from_name,
+)
+from .integrity import copy_verified, normalize_digest, sha256_file
+from .lock import install_lock, record_install
+from .messages import add_error, add_message, add_warning
+from .plan import Plan
+from .probe import invalidate, is_remote
+from .rpath import (
+    arcgis_products,
+    fnf_exception,
+    handle_fnf,
+    package_description_version,
+    r_all_lib_paths,
+    r_lib_path,
+    r_path,
+    r_set_install,
+    r_site_lib_path,
+    r_user_lib_path,
+    r_version,
+    registry_key,
+)
+from .update_check import cached_release
+from .utils import user_data_dir
+try:
+    import winreg
+except ImportError:
+    # py 2
+    import _winreg as winreg
+
+# Lockfiles capture the resolved bridge environment of a machine: the R
+# installation, the library and version of the package, the release zip it
+# came from, and how ArcGIS is linked to it. Replaying a lockfile on another
+# machine only does the steps whose outcome doesn't already match.
+
+FORMAT_VERSION = 1
+PRO_REG_PATH = "SOFTWARE\\Esri\\ArcGISPro"
+PRO_PACKAGE_KEY = 'RintegrationProPackagePath'
+
+
+def _same_path(a, b):
+    if not a or not b:
+        return False
+    return os.path.normcase(os.path.normpath(a)) == \
+        os.path.normcase(os.path.normpath(b))
+
+
+def _pro_package_link():
+    """The package path ArcGIS Pro is pointed at in the registry, see
+    `rtools.install_package.create_registry_entry`."""
+    value = None
+    with registry_key(winreg.HKEY_CURRENT_USER, PRO_REG_PATH) as pro_reg:
+        if pro_reg:
+            try:
+                value = winreg.QueryValueEx(pro_reg, PRO_PACKAGE_KEY)[0]
+            except fnf_exception as error:
+                handle_fnf(error)
+    return value or None
+
+
+def _library_spec(library):
+    """Describe a library so it resolves on other machines: the per-user
+    or site library of whoever replays the lockfile, or a fixed path."""
+    if _same_path(library, r_user_lib_path()):
+        return {'kind': 'user', 'path': library}
+    if _same_path(library, r_site_lib_path()):
+        return {'kind': 'site', 'path': library}
+    return {'kind': 'path', 'path': library}
+
+
+def resolve_library(spec):
+    """The library on this machine described by a lockfile."""
+    if spec['kind'] == 'user':
+        return r_user_lib_path()
+    if spec['kind'] == 'site':
+        return r_site_lib_path()
+    return spec['path']
+
+
+def _artifact(version, artifact_dir=None):
+    """Details of the release zip of an installed version, when it was
+    kept from the install, optionally copying it to artifact_dir."""
+    artifact = {'name': "{}_{}.zip".format(PACKAGE_NAME, version),
+                'sha256': None, 'size': None, 'url': None}
+    record = cached_release()
+    if record and record.get('download_url') and \
+            package_version_from_name(record['download_url']) == version:
+        artifact['url'] = record['download_url']
+
+    zip_path = cached_artifact()
+    if zip_path is None or package_version_from_name(zip_path) != version:
+        local_zip = local_package_zip()
+        if local_zip and package_version_from_name(local_zip) == version:
+            zip_path = local_zip
+        else:
+            return artifact
+    artifact['name'] = os.path.basename(zip_path)
+    artifact['size'] = os.path.getsize(zip_path)
+    if artifact_dir:
+        if not os.path.exists(artifact_dir):
+            os.makedirs(artifact_dir)
+        artifact['sha256'] = copy_verified(
+            zip_path, os.path.join(artifact_dir, artifact['name']))
+    else:
+        artifact['sha256'] = sha256_file(zip_path)
+    return artifact
+
+
+def export_lockfile(path=None, artifact_dir=None):
+    """Capture the bridge environment of this machine.
+
+    Parameters
+    ----------
+    path: str, file to write the lockfile to, as JSON.
+    artifact_dir: str, also copy the release zip here, for replaying
+                  without network access.
+
+    Returns
+    -------
+    dictionary of the lockfile, or None if the package isn't installed.
+    """
+    library = r_lib_path()
+    package_dir = None
+    for lib_path in r_all_lib_paths():
+        if os.path.isdir(os.path.join(lib_path, PACKAGE_NAME)):
+            (library, package_dir) = (lib_path,
+                                      os.path.join(lib_path, PACKAGE_NAME))
+            break
+    version = package_description_version(package_dir) if package_dir \
+        else None
+    if version is None:
+        add_error("The ArcGIS R package isn't installed, nothing to lock.")
+        return None
+
+    links = []
+    for record in arcgis_products():
+        link_dir = os.path.join(record.rintegration_dir, PACKAGE_NAME)
+        if record.product == 'ArcMap' and os.path.exists(link_dir):
+            links.append({'arcgis_version': record.version,
+                          'rintegration_dir': record.rintegration_dir})
+    pro_link = _pro_package_link()
+
+    lock = {
+        'format': FORMAT_VERSION,
+        'created': time.time(),
+        'r': {'version': r_version(), 'home': r_path()},
+        'libraries': r_all_lib_paths(),
+        'library': _library_spec(library),
+        'package': {
+            'name': PACKAGE_NAME,
+            'version': version,
+            'layout': 'versioned' if versions.active_version(library)
+                      else 'in_place',
+            'artifact': _artifact(version, artifact_dir),
+        },
+        'links': {
+            'arcmap': links,
+            # whether ArcGIS Pro is pointed at the package in the library
+            'pro_registry': pro_link is not None and
+                            _same_path(pro_link, package_dir),
+        },
+    }
+    if path:
+        with open(path, 'w') as f:
+            json.dump(lock, f, indent=2, sort_keys=True)
+    return lock
+
+
+def read_lockfile(path):
+    with open(path) as f:
+        lock = json.load(f)
+    if lock.get('format') != FORMAT_VERSION:
+        raise ValueError("Unsupported lockfile format: {}".format(
+            lock.get('format')))
+    return lock
+
+
+def find_artifact(artifact, artifact_dirs=(), mirror=None):
+    """Find the release zip described by a lockfile: in the given
+    directories, the release cache, next to the toolbox, and last, on a
+    mirror, downloaded into the release cache. A zip with the recorded
+    name but another size or digest, such as a rebuilt release, is passed
+    over.
+
+    Returns: path of the zip, or None."""
+    cache_dir = os.path.join(user_data_dir(), ARTIFACT_DIR)
+    search = list(artifact_dirs) + [cache_dir]
+    local_zip = local_package_zip()
+    if local_zip:
+        search.append(os.path.dirname(local_zip))
+    for directory in search:
+        zip_path = os.path.join(directory, artifact['name'])
+        # a size mismatch rules a candidate out without hashing it
+        if not os.path.exists(zip_path) or (
+                artifact['size'] is not None and
+                os.path.getsize(zip_path) != artifact['size']):
+            continue
+        if artifact['sha256']:
+            try:
+                digest = sha256_file(zip_path)
+            except (IOError, OSError):
+                continue
+            if digest != normalize_digest(artifact['sha256']):
+                add_warning("Skipping {}, its SHA-256 doesn't match the "
+                            "lockfile.".format(zip_path))
+                continue
+        return zip_path
+
+    urls = []
+    if mirror:
+        urls.append("{}/{}".format(mirror.rstrip('/'), artifact['name']))
+    if artifact.get('url'):
+        urls.append(artifact['url'])
+    for url in urls:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        zip_path = os.path.join(cache_dir, artifact['name'])
+        if save_url(url, zip_path, sha256=artifact['sha256']):
+            return zip_path
+    return None
+
+
+def _r_satisfied(context):
+    r = context['lock']['r']
+    return _same_path(r_path(), r['home']) and r_version() == r['version']
+
+
+def _step_r(context):
+    r = context['lock']['r']
+    home = r['home']
+    if not home or not os.path.exists(os.path.join(home, 'bin')):
+        add_error("R {} isn't installed at {}. Install it before replaying "
+                  "the lockfile.".format(r['version'], home))
+        return False
+    add_message("Making R {} in {} the default.".format(r['version'], home))
+    written = r_set_install(home, r['version'])
+    invalidate()
+    if written is None:
+        add_error("Unable to make R {} the default in the registry.".format(
+            r['version']))
+        return False
+
+
+def _step_library(context):
+    library = resolve_library(context['lock']['library'])
+    if library is None:
+        add_error("Unable to resolve the R library to install into.")
+        return False
+    return {'library': library}
+
+
+def _package_satisfied(context):
+    package = context['lock']['package']
+    package_dir = os.path.join(context['library'], PACKAGE_NAME)
+    return os.path.isdir(package_dir) and \
+        package_description_version(package_dir) == package['version']
+
+
+def _step_package(context):
+    library = context['library']
+    package = context['lock']['package']
+    version = package['version']
+    if not os.path.exists(library):
+        os.makedirs(library)
+
+    with install_lock(library) as lock_state:
+        if lock_state['timed_out']:
+            return False
+        if versions.enabled(library) and \
+                version in versions.installed_versions(library):
+            add_message("Version {} is kept side by side, switching to "
+                        "it.".format(version))
+            versions.activate(library, version)
+            record_install(library, version)
+            return
+
+        zip_path = find_artifact(package['artifact'],
+                                 context['artifact_dirs'], context['mirror'])
+        if zip_path is None:
+            add_error("Unable to find {}, pass a directory holding it, or "
+                      "a mirror.".format(package['artifact']['name']))
+            return False
+        add_message("Installing {} from {}.".format(version, zip_path))
+        installed = _install_release(
+            os.path.basename(zip_path), zip_path, None, True,
+            not is_remote(r_path()), library=library,
+            sha256=package['artifact']['sha256'], from_zip=True)
+        if not installed:
+            return False
+        record_install(library, version)
+    if not _package_satisfied(context):
+        add_error("Version {} wasn't installed into {}.".format(
+            version, library))
+        return False
+
+
+def _arcmap_links_satisfied(context):
+    package_dir = os.path.join(context['library'], PACKAGE_NAME)
+    for link in context['lock']['links']['arcmap']:
+        link_dir = os.path.join(link['rintegration_dir'], PACKAGE_NAME)
+        if not os.path.exists(link_dir) or \
+                os.path.realpath(link_dir) != os.path.realpath(package_dir):
+            return False
+    return True
+
+
+def _step_arcmap_links(context):
+    for link in context['lock']['links']['arcmap']:
+        if not os.path.isdir(link['rintegration_dir']):
+            add_warning("ArcGIS {} isn't installed here, skipping its "
+                        "link.".format(link['arcgis_version']))
+            continue
+        if link_arcmap(link['rintegration_dir']) is False:
+            return False
+
+
+def _pro_link_satisfied(context):
+    return not context['lock']['links']['pro_registry'] or _same_path(
+        _pro_package_link(),
+        os.path.join(context['library'], PACKAGE_NAME))
+
+
+def _step_pro_link(context):
+    binding_path = os.path.join(context['library'], PACKAGE_NAME)
+    if not create_registry_entry('Pro', None, binding_path):
+        add_warning("Unable to point ArcGIS Pro at {}.".format(binding_path))
+
+
+def replay_plan():
+    """The steps to bring this machine to the state of a lockfile. Expects
+    a context with 'lock', 'artifact_dirs' and 'mirror' values.
+
+    Returns: `rtools.plan.Plan`."""
+    plan = Plan('replay')
+    plan.add('r', _step_r, provides=('r_ready',), satisfied=_r_satisfied,
+             description="Make the locked R installation the default")
+    plan.add('library', _step_library, probe=True, requires=('r_ready',),
+             provides=('library',),
+             description="Resolve the library to install into")
+    plan.add('package', _step_package, requires=('library',),
+             provides=('package_ready',), satisfied=_package_satisfied,
+             description="Install the locked package version")
+    plan.add('arcmap_links', _step_arcmap_links, requires=('package_ready',),
+             provides=('arcmap_linked',), satisfied=_arcmap_links_satisfied,
+             description="Link the package into ArcMap Rintegration")
+    plan.add('pro_link', _step_pro_link, requires=('package_ready',),
+             provides=('pro_linked',), satisfied=_pro_link_satisfied,
+             description="Point ArcGIS Pro at the package")
+    return plan
+
+
+def replay_lockfile(lock, artifact_dirs=(), mirror=None, dry_run=False):
+    """Bring this machine to the bridge environment of a lockfile,
+    skipping whatever already matches.
+
+    Parameters
+    ----------
+    lock: dict or str, lockfile, or path to one. Its directory is also
+          searched for the release zip.
+    artifact_dirs: list, directories holding release zips.
+    mirror: str, base URL serving release zips by name, defaults to
+            config.ARTIFACT_MIRROR.
+    dry_run: bool, only report the steps that would run.
+
+    Returns
+    -------
+    list of (step, status) tuples, see `rtools.plan.Plan.run`.
+    """
+    artifact_dirs = list(artifact_dirs)
+    if not isinstance(lock, dict):
+        artifact_dirs.append(os.path.dirname(os.path.abspath(lock)))
+        lock = read_lockfile(lock)
+    context = {'lock': lock, 'artifact_dirs': artifact_dirs,
+               'mirror': mirror or config.ARTIFACT_MIRROR}
+    plan = replay_plan()
+    report = plan.run(context, dry_run=dry_run)
+    if dry_run:
+        add_message("Replay plan:\n{}".format(
+            "\n".join(plan.describe(report))))
+    return report
@@ -0,0 +1,140 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import tempfile
+
+from . import config
+
+# the logger all rtools modules log beneath
+_root = logging.getLogger('rtools')
+# handlers added by `configure`, replaced when it is called again
+_handlers = []
+_buffer = None
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+FAILURE_LOG_NAME = 'rtools-failure.log'
+
+
+def _level(value):
+    """Convert a LOGGING setting into a logging level, or None when
+    logging is off. Accepts booleans, level numbers and level names."""
+    if value is None or value is False:
+        return None
+    if value is True:
+        return logging.DEBUG
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().upper()
+    if value in ('', '0', 'FALSE', 'OFF', 'NO'):
+        return None
+    if value in ('1', 'TRUE', 'ON', 'YES'):
+        return logging.DEBUG
+    level = logging.getLevelName(value)
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level: {}".format(value))
+    return level
+
+
+class RingBufferHandler(logging.Handler):
+    """Keep the most recent records in memory. Records are only formatted
+    when written out by `dump`, so keeping them is cheap."""
+
+    def __init__(self, capacity):
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, path):
+        """Append the buffered records to a file, and empty the buffer.
+
+        Returns: number of records written."""
+        self.acquire()
+        try:
+            records = list(self.records)
+            self.records.clear()
+        finally:
+            self.release()
+        if records:
+            with open(path, 'a') as f:
+                for record in records:
+                    f.write(self.format(record) + '\n')
+        return len(records)
+
+
+def configure(level=None, filename=None, buffer_size=None):
+    """Set up rtools logging. Called on import with the settings from
+    rtools.config, call it again after changing them at runtime.
+
+    Parameters
+    ----------
+    level: bool, int or str, defaults to config.LOGGING. True logs
+           everything, a level name such as 'INFO' only that level and
+           above, False nothing.
+    filename: str, log file, defaults to config.LOG_FILE, or rtools.log
+              beside this module.
+    buffer_size: int, defaults to config.LOG_BUFFER. Number of recent
+                 records kept in memory at debug level, and written out by
+                 `dump_recent` when an installation fails. 0 disables.
+    """
+    global _buffer
+    level = _level(config.LOGGING if level is None else level)
+    filename = filename or config.LOG_FILE
+    if buffer_size is None:
+        buffer_size = config.LOG_BUFFER
+
+    for handler in _handlers:
+        _root.removeHandler(handler)
+        handler.close()
+    del _handlers[:]
+    _buffer = None
+
+    formatter = logging.Formatter(FORMAT)
+    levels = []
+    if level is not None:
+        if not filename:
+            filename = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "rtools.log")
+        handler = logging.FileHandler(filename)
+        handler.setLevel(level)
+        _handlers.append(handler)
+        levels.append(level)
+    if buffer_size:
+        _buffer = RingBufferHandler(buffer_size)
+        _handlers.append(_buffer)
+        levels.append(logging.DEBUG)
+
+    for handler in _handlers:
+        handler.setFormatter(formatter)
+        _root.addHandler(handler)
+    # when unconfigured, defer to the application's logging setup, which
+    # by default drops debug and info records after a single level check.
+    _root.setLevel(min(levels) if levels else logging.NOTSET)
+
+
+def dump_recent(path=None):
+    """Write the in-memory buffer of recent records to disk, for use when
+    something failed. Does nothing when the buffer is disabled or empty.
+
+    Parameters
+    ----------
+    path: str, output file. Defaults to rtools-failure.log in the
+          temporary directory.
+
+    Returns: path written to, or None."""
+    if _buffer is None:
+        return None
+    path = path or os.path.join(
+        tempfile.gettempdir(), FAILURE_LOG_NAME)
+    if _buffer.dump(path):
+        return path
+    return None
+
+
+configure()
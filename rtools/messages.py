@@ -0,0 +1,106 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+import logging
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+# messages gathered by `collect`, e.g. for JSON output from the CLI
+_collected = None
+# messages held by `buffered`, per thread
+_local = threading.local()
+
+
+def _arcpy():
+    """The arcpy module, if the host process has already loaded it. When
+    run from a toolbox or the Python window it has; we never import it
+    ourselves, as that costs seconds and requires a licensed ArcGIS."""
+    return sys.modules.get('arcpy')
+
+
+def _emit(level, msg):
+    held = getattr(_local, 'held', None)
+    if held is not None:
+        held.append((level, msg))
+        return
+
+    if _collected is not None:
+        _collected.append({'level': level, 'message': msg})
+
+    arcpy = _arcpy()
+    if arcpy is not None:
+        if level == 'error':
+            arcpy.AddError(msg)
+        elif level == 'warning':
+            arcpy.AddWarning(msg)
+        else:
+            arcpy.AddMessage(msg)
+    else:
+        if level == 'error':
+            log.error(msg)
+        elif level == 'warning':
+            log.warning(msg)
+        else:
+            log.info(msg)
+        if _collected is None:
+            print(msg, file=sys.stderr)
+
+
+def add_message(msg):
+    """Report progress, as arcpy.AddMessage."""
+    _emit('message', msg)
+
+
+def add_warning(msg):
+    """Report a warning, as arcpy.AddWarning."""
+    _emit('warning', msg)
+
+
+def add_error(msg):
+    """Report an error, as arcpy.AddError."""
+    _emit('error', msg)
+
+
+@contextmanager
+def collect():
+    """Gather messages instead of printing them, when running outside of
+    ArcGIS.
+
+    Yields: list of {'level', 'message'} dictionaries."""
+    global _collected
+    previous = _collected
+    _collected = []
+    try:
+        yield _collected
+    finally:
+        _collected = previous
+
+
+@contextmanager
+def buffered(held=None):
+    """Hold the messages sent from the current thread rather than sending
+    them, so a worker thread doesn't call arcpy, and messages of concurrent
+    work can be sent in a fixed order with `replay`.
+
+    Parameters
+    ----------
+    held: list, to append the messages to, as they are sent.
+
+    Yields: list of (level, message) tuples."""
+    previous = getattr(_local, 'held', None)
+    _local.held = held if held is not None else []
+    try:
+        yield _local.held
+    finally:
+        _local.held = previous
+
+
+def replay(messages):
+    """Send messages held by `buffered`, from the current thread."""
+    for (level, msg) in messages:
+        _emit(level, msg)
@@ -0,0 +1,172 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import logging
+
+from .messages import buffered, replay
+from .trace import span
+from .utils import parallel_map
+
+log = logging.getLogger(__name__)
+
+
+class Step(object):
+    """A unit of work within a plan.
+
+    Parameters
+    ----------
+    name: str, unique name of the step.
+    action: callable, takes the plan context dictionary. Returns a
+            dictionary of the values it provides, which are merged into
+            the context, or False if the step failed.
+    requires: list, names of context values needed before running.
+    provides: list, names of context values the action produces.
+    satisfied: callable, takes the context and returns True when the
+               outputs of this step are already in place, so it can be
+               skipped.
+    probe: bool, whether the step only inspects the machine. Probes run
+           even in a dry run, so later steps can be previewed.
+    description: str, shown when the plan is printed.
+    """
+
+    def __init__(self, name, action, requires=(), provides=(),
+                 satisfied=None, probe=False, description=''):
+        self.name = name
+        self.action = action
+        self.requires = tuple(requires)
+        self.provides = tuple(provides)
+        self.satisfied = satisfied
+        self.probe = probe
+        self.description = description
+
+
+class Plan(object):
+    """A set of steps run in dependency order. Steps whose requirements
+    are met at the same time run concurrently, and their messages are
+    sent from the calling thread, in the order the steps were added."""
+
+    def __init__(self, name='plan'):
+        self.name = name
+        self.steps = OrderedDict()
+
+    def add(self, name, action, **kwargs):
+        """Add a step, see `Step` for the accepted keywords."""
+        self.steps[name] = Step(name, action, **kwargs)
+        return self.steps[name]
+
+    def levels(self, available=()):
+        """Group the steps into levels. Each level only requires values
+        provided by earlier levels, or initially available.
+
+        Returns: list of lists of steps."""
+        provided = set(available)
+        pending = list(self.steps.values())
+        levels = []
+        while pending:
+            ready = [step for step in pending
+                     if all(req in provided for req in step.requires)]
+            if not ready:
+                missing = dict((step.name, [r for r in step.requires
+                                            if r not in provided])
+                               for step in pending)
+                raise ValueError("Unsatisfiable plan requirements: {}".format(
+                    missing))
+            for step in ready:
+                pending.remove(step)
+                provided.update(step.provides)
+            levels.append(ready)
+        return levels
+
+    def _run_step(self, step, context, dry_run):
+        if step.satisfied is not None and step.satisfied(context):
+            return 'satisfied'
+        if dry_run and not step.probe:
+            # assume it would work, so dependent steps can be previewed
+            return 'would run'
+        with span('{}.{}'.format(self.name, step.name)):
+            result = step.action(context)
+        if result is False:
+            return 'failed'
+        if result:
+            context.update(result)
+        return 'ran'
+
+    def _run_buffered(self, step, context, dry_run):
+        """Run a step holding its messages.
+
+        Returns: (status, messages, exception) tuple."""
+        with buffered() as messages:
+            try:
+                return (self._run_step(step, context, dry_run), messages,
+                        None)
+            except Exception as e:
+                return (None, messages, e)
+
+    def run(self, context, dry_run=False, workers=4):
+        """Run the plan.
+
+        Parameters
+        ----------
+        context: dict, initial values; updated with what steps provide.
+        dry_run: bool, only run probes, and report what would happen.
+        workers: int, maximum number of steps run concurrently.
+
+        Returns
+        -------
+        list of (step, status) tuples, where status is one of 'ran',
+        'satisfied', 'would run', 'failed' or 'blocked'.
+        """
+        report = []
+        failed = False
+        for level in self.levels(context.keys()):
+            if failed:
+                report.extend((step, 'blocked') for step in level)
+                continue
+            if len(level) == 1:
+                statuses = [self._run_step(level[0], context, dry_run)]
+            else:
+                # concurrent steps hold their messages, which are sent
+                # from this thread in step order once the level is done
+                outcomes = parallel_map(
+                    lambda step: self._run_buffered(step, context, dry_run),
+                    level, workers)
+                for (status, messages, error) in outcomes:
+                    replay(messages)
+                errors = [error for (_, _, error) in outcomes if error]
+                if errors:
+                    raise errors[0]
+                statuses = [status for (status, _, _) in outcomes]
+            for (step, status) in zip(level, statuses):
+                log.debug("%s step %s: %s", self.name, step.name, status)
+                report.append((step, status))
+                if status == 'failed':
+                    failed = True
+        return report
+
+    def describe(self, report=None):
+        """Format the plan, with the outcome of each step if a run report
+        is given.
+
+        Returns: list of lines."""
+        statuses = dict((step.name, status) for (step, status) in report or [])
+        lines = []
+        pos = 0
+        for (depth, level) in enumerate(self.levels(self._initial())):
+            for step in level:
+                pos += 1
+                lines.append("{:>2}. [{}] {:<18} {:<10} {}".format(
+                    pos, depth, step.name,
+                    statuses.get(step.name, ''), step.description).rstrip())
+        return lines
+
+    def _initial(self):
+        """Values required by steps, but provided by none of them."""
+        provided = set()
+        required = set()
+        for step in self.steps.values():
+            provided.update(step.provides)
+            required.update(step.requires)
+        return required - provided
@@ -0,0 +1,198 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import stat
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    # py 2, use the backport when available
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Cached filesystem probes for library and package resolution.
+#
+# Discovery checks the same handful of paths many times: R homes, library
+# directories and the package folder within each. Results are cached for
+# a few seconds. On network drives, where each stat is a round trip to the
+# server, a path is answered from a single listing of its parent
+# directory, shared by all of its siblings.
+
+# seconds to trust cached results for local and network paths
+LOCAL_TTL = 2.0
+REMOTE_TTL = 30.0
+# seconds to trust cached results for paths a change watcher covers,
+# see rtools.watch
+WATCHED_TTL = 600.0
+
+# GetDriveTypeW result for mapped network drives
+DRIVE_REMOTE = 4
+
+_clock = getattr(time, 'monotonic', time.time)
+_lock = threading.Lock()
+# normalized path: (expiry, 'dir', 'file' or None when missing)
+_kinds = {}
+# normalized directory: (expiry, {normalized name: kind}, or None)
+_listings = {}
+# drive: whether it is a network drive
+_remote_drives = {}
+# functions dropping other discovery caches, run by invalidate()
+_invalidate_callbacks = []
+# DiscoveryWatcher in use, see rtools.watch
+_watcher = None
+
+
+def _key(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def _drive_type(drive):
+    try:
+        import ctypes
+        return ctypes.windll.kernel32.GetDriveTypeW(drive + '\\')
+    except (ImportError, AttributeError):
+        return None
+
+
+def is_remote(path):
+    """Whether a path is on a network share, either as a UNC path or on a
+    mapped network drive."""
+    if not path:
+        return False
+    if path[0:2] in ('\\\\', '//'):
+        return True
+    drive = os.path.splitdrive(path)[0].upper()
+    if not drive:
+        return False
+    if drive not in _remote_drives:
+        _remote_drives[drive] = _drive_type(drive) == DRIVE_REMOTE
+    return _remote_drives[drive]
+
+
+def _ttl(path):
+    watcher = _watcher
+    if watcher is not None and watcher.covers(path):
+        return WATCHED_TTL
+    return REMOTE_TTL if is_remote(path) else LOCAL_TTL
+
+
+def check():
+    """Drop cached results if the change watcher saw a change. Called
+    before answering from a cache."""
+    watcher = _watcher
+    if watcher is not None:
+        watcher.check()
+
+
+def _cached(cache, key):
+    check()
+    with _lock:
+        entry = cache.get(key)
+    if entry and entry[0] > _clock():
+        return entry
+    return None
+
+
+def _store(cache, key, value, ttl):
+    with _lock:
+        cache[key] = (_clock() + ttl, value)
+
+
+def _stat_kind(path):
+    try:
+        mode = os.stat(path).st_mode
+    except (OSError, ValueError):
+        return None
+    return 'dir' if stat.S_ISDIR(mode) else 'file'
+
+
+def listdir(path):
+    """List a directory with a single scan, noting which entries are
+    directories without a stat of each.
+
+    Returns: dictionary of {normalized name: 'dir' or 'file'}, or None if
+    the path isn't a readable directory."""
+    key = _key(path)
+    cached = _cached(_listings, key)
+    if cached:
+        return cached[1]
+
+    listing = None
+    try:
+        if scandir is not None:
+            listing = {}
+            for entry in scandir(path):
+                listing[os.path.normcase(entry.name)] = \
+                    'dir' if entry.is_dir() else 'file'
+        else:
+            listing = dict(
+                (os.path.normcase(name),
+                 _stat_kind(os.path.join(path, name)))
+                for name in os.listdir(path))
+    except (OSError, ValueError):
+        listing = None
+
+    _store(_listings, key, listing, _ttl(path))
+    return listing
+
+
+def _kind(path):
+    key = _key(path)
+    cached = _cached(_kinds, key)
+    if cached:
+        return cached[1]
+
+    (parent, name) = os.path.split(os.path.normpath(path))
+    if name and is_remote(path):
+        # one listing answers for every sibling
+        listing = listdir(parent)
+        if listing is not None:
+            kind = listing.get(os.path.normcase(name))
+        else:
+            # parent can't be listed, e.g. no permission on the share root
+            kind = _stat_kind(path)
+    else:
+        kind = _stat_kind(path)
+
+    _store(_kinds, key, kind, _ttl(path))
+    return kind
+
+
+def exists(path):
+    """Cached os.path.exists."""
+    return bool(path) and _kind(path) is not None
+
+
+def isdir(path):
+    """Cached os.path.isdir."""
+    return bool(path) and _kind(path) == 'dir'
+
+
+def invalidate():
+    """Drop all cached results, e.g. after installing into a library."""
+    with _lock:
+        _kinds.clear()
+        _listings.clear()
+    for callback in _invalidate_callbacks:
+        callback()
+
+
+def on_invalidate(callback):
+    """Have `invalidate` also call **callback**, which drops a discovery
+    cache kept outside this module."""
+    _invalidate_callbacks.append(callback)
+
+
+def set_watcher(watcher):
+    """Use a change watcher, or None to stop, see rtools.watch. Cached
+    results are dropped, as they were kept without it."""
+    global _watcher
+    _watcher = watcher
+    invalidate()
@@ -0,0 +1,406 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import time
+import zlib
+try:
+    import urllib.request as request
+except ImportError:
+    import urllib2 as request
+
+from . import config
+from .bootstrap_r import execute_r
+from .compat import parse_version
+from .probe import invalidate
+from .rpath import package_description_version
+from .trace import traced
+from .utils import parallel_map, user_data_dir
+
+# Installs from CRAN-style repositories without R resolving dependencies:
+# the PACKAGES index of each repository is read and cached, the packages
+# missing from the libraries R searches are worked out, their binaries
+# downloaded at once into a cache, and all of them installed by one
+# `Rcmd INSTALL` per library, dependencies first.
+
+log = logging.getLogger(__name__)
+
+INDEX_DIR = 'repositories'
+PACKAGE_DIR = 'packages'
+INDEX_STATE = 'index.json'
+
+# fields naming the packages a binary package needs at run time
+DEPENDENCY_FIELDS = ('Depends', 'Imports')
+
+# packages shipped with R, installed in every R_HOME/library
+BASE_PACKAGES = frozenset((
+    'base', 'compiler', 'datasets', 'graphics', 'grDevices', 'grid',
+    'methods', 'parallel', 'splines', 'stats', 'stats4', 'tcltk', 'tools',
+    'translations', 'utils'))
+
+REQUIREMENT_PATTERN = re.compile(
+    r'^\s*([A-Za-z][A-Za-z0-9.]*)\s*(?:\(\s*([<>=!]+)\s*([^)\s]+)\s*\))?\s*$')
+
+# read downloads in 1MB chunks
+CHUNK_SIZE = 1024 * 1024
+
+
+class RepositoryError(Exception):
+    """Packages can't be resolved or fetched from the repositories. R's
+    install.packages() may still manage it."""
+
+
+def r_minor_version(version):
+    """The 'x.y' of an R version, which names its binary repositories."""
+    parsed = parse_version(version)
+    if parsed is None or len(parsed.numbers) < 2:
+        raise RepositoryError("Unknown R version {!r}.".format(version))
+    return '{}.{}'.format(parsed.numbers[0], parsed.numbers[1])
+
+
+def contrib_url(repository, r_version):
+    """URL of the Windows binary packages built for an R version."""
+    return '{}/bin/windows/contrib/{}'.format(
+        repository.rstrip('/'), r_minor_version(r_version))
+
+
+def package_version(raw):
+    """Version of an R package, where '1.0-3' is 1.0.3."""
+    if raw is None:
+        return None
+    return parse_version(raw.replace('-', '.'))
+
+
+def parse_dcf(text):
+    """Records of a Debian control file, as used by the PACKAGES index and
+    DESCRIPTION files. Indented lines continue the previous field.
+
+    Returns: list of dictionaries."""
+    records = []
+    record = {}
+    field = None
+    for line in text.splitlines():
+        if not line.strip():
+            if record:
+                records.append(record)
+            record = {}
+            field = None
+        elif line[0] in ' \t':
+            if field is not None:
+                record[field] += ' ' + line.strip()
+        else:
+            (field, _, value) = line.partition(':')
+            field = field.strip()
+            record[field] = value.strip()
+    if record:
+        records.append(record)
+    return records
+
+
+def parse_requirements(field):
+    """Parse a dependency field such as 'R (>= 3.5), sp (>= 1.0), methods'.
+
+    Returns: list of (package, operator, version) tuples, with None for
+    the operator and version of an unversioned dependency."""
+    requirements = []
+    for entry in (field or '').split(','):
+        match = REQUIREMENT_PATTERN.match(entry)
+        if match:
+            requirements.append(match.groups())
+    return requirements
+
+
+def satisfies(version, operator, required):
+    """Whether an installed version meets a requirement."""
+    if operator is None:
+        return True
+    installed = package_version(version)
+    required = package_version(required)
+    if installed is None or required is None:
+        return False
+    return {'>=': installed >= required, '>': installed > required,
+            '==': installed == required, '<=': installed <= required,
+            '<': installed < required,
+            '!=': installed != required}.get(operator, False)
+
+
+def _index_dir(repository, r_version):
+    name = re.sub(r'[^A-Za-z0-9.]+', '_', repository.split('://')[-1])
+    return os.path.join(user_data_dir(), INDEX_DIR, name.strip('_'),
+                        r_minor_version(r_version))
+
+
+def _read_index_state(index_dir):
+    try:
+        with open(os.path.join(index_dir, INDEX_STATE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _download_index(url, state):
+    """Fetch a PACKAGES.gz index, only if it changed since **state** was
+    recorded.
+
+    Returns: (index text or None when unchanged, validators) tuple."""
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    try:
+        r = request.urlopen(request.Request(url + '/PACKAGES.gz',
+                                            headers=headers))
+    except request.HTTPError as e:
+        if e.code == 304:
+            return (None, state)
+        raise
+    try:
+        data = r.read()
+        validators = {'etag': r.headers.get('ETag'),
+                      'last_modified': r.headers.get('Last-Modified')}
+    finally:
+        r.close()
+    # gzip framing
+    text = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return (text.decode('utf-8', 'replace'), validators)
+
+
+@traced(args=True)
+def read_index(repository, r_version, max_age=None):
+    """The packages a repository has for an R version, from its
+    PACKAGES index. The index is cached, and only downloaded again once
+    it is older than **max_age** seconds, by default
+    config.REPOSITORY_INDEX_TTL, and has changed on the server.
+
+    Returns: dictionary of package name: index record, with the
+    'Repository' URL its binary is found in added."""
+    if max_age is None:
+        max_age = config.REPOSITORY_INDEX_TTL
+    url = contrib_url(repository, r_version)
+    index_dir = _index_dir(repository, r_version)
+    index_path = os.path.join(index_dir, 'PACKAGES')
+    state = _read_index_state(index_dir)
+    cached = os.path.exists(index_path)
+
+    if not cached or time.time() - state.get('checked', 0) >= max_age:
+        try:
+            (text, validators) = _download_index(
+                url, state if cached else {})
+        except (request.URLError, IOError, OSError, zlib.error) as e:
+            if not cached:
+                raise RepositoryError("Unable to read the index of {}: "
+                                      "{}".format(url, e))
+            log.debug("Using the cached index of %s: %s", url, e)
+        else:
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            if text is not None:
+                with io.open(index_path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+            validators['checked'] = time.time()
+            with open(os.path.join(index_dir, INDEX_STATE), 'w') as f:
+                json.dump(validators, f)
+
+    with io.open(index_path, encoding='utf-8') as f:
+        records = parse_dcf(f.read())
+    index = {}
+    for record in records:
+        if 'Package' in record and 'Version' in record:
+            record['Repository'] = url
+            index[record['Package']] = record
+    return index
+
+
+def merged_index(repositories, r_version, workers=4):
+    """Indexes of several repositories, read at once. Where more than one
+    has a package, the highest version is used, or the first repository's
+    for equal versions, as R does."""
+    indexes = parallel_map(lambda repository: read_index(
+        repository, r_version), repositories, workers)
+    merged = {}
+    for index in indexes:
+        for (name, record) in index.items():
+            current = merged.get(name)
+            if current is None or package_version(record['Version']) > \
+                    package_version(current['Version']):
+                merged[name] = record
+    return merged
+
+
+def installed_version(name, libraries):
+    """Version of a package in the first of **libraries** that has it,
+    as R would load it.
+
+    Returns: version string, or None."""
+    for library in libraries:
+        version = package_description_version(os.path.join(library, name))
+        if version is not None:
+            return version
+    return None
+
+
+def resolve(packages, index, libraries):
+    """Work out what to install for **packages**: the packages themselves,
+    and those they depend on which are missing from **libraries** or too
+    old for the version needed. Installed packages that meet every
+    requirement are left alone, as install.packages() does.
+
+    Returns: list of index records, each after its dependencies."""
+    order = []
+    visited = set()
+
+    def visit(name, chain):
+        if name in visited:
+            return
+        if name in chain:
+            raise RepositoryError("Circular dependency: {}".format(
+                " -> ".join(chain + [name])))
+        record = index.get(name)
+        if record is None:
+            raise RepositoryError("Package {} isn't available from the "
+                                  "repositories.".format(name))
+        requirements = []
+        for field in DEPENDENCY_FIELDS:
+            requirements.extend(parse_requirements(record.get(field)))
+        for (dependency, operator, version) in requirements:
+            if dependency == 'R' or dependency in BASE_PACKAGES:
+                continue
+            if dependency not in visited:
+                installed = installed_version(dependency, libraries)
+                if installed is not None and \
+                        satisfies(installed, operator, version):
+                    continue
+            if dependency in index and not satisfies(
+                    index[dependency]['Version'], operator, version):
+                raise RepositoryError(
+                    "{} needs {} ({} {}), the repositories have {}.".format(
+                        name, dependency, operator, version,
+                        index[dependency]['Version']))
+            visit(dependency, chain + [name])
+        visited.add(name)
+        order.append(record)
+
+    for name in packages:
+        visit(name, [])
+    return order
+
+
+def _md5_file(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fetch_package(record, r_version):
+    """Binary zip of a package, downloaded into the package cache unless
+    already there. Checked against the MD5sum in the index, when given.
+
+    Returns: path to the zip."""
+    file_name = '{}_{}.zip'.format(record['Package'], record['Version'])
+    cache_dir = os.path.join(user_data_dir(), PACKAGE_DIR,
+                             r_minor_version(r_version))
+    zip_path = os.path.join(cache_dir, file_name)
+    expected = (record.get('MD5sum') or '').lower() or None
+    if os.path.exists(zip_path) and \
+            (expected is None or _md5_file(zip_path) == expected):
+        return zip_path
+
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created by another download
+            if not os.path.isdir(cache_dir):
+                raise
+    url = '{}/{}'.format(record['Repository'], file_name)
+    partial_path = '{}.{}.part'.format(zip_path, os.getpid())
+    digest = hashlib.md5()
+    try:
+        r = request.urlopen(url)
+        try:
+            with open(partial_path, 'wb') as f:
+                for chunk in iter(lambda: r.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+        finally:
+            r.close()
+    except (request.URLError, IOError, OSError) as e:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise RepositoryError("Unable to download {}: {}".format(url, e))
+    if expected is not None and digest.hexdigest() != expected:
+        os.remove(partial_path)
+        raise RepositoryError("Checksum mismatch for {}: expected MD5 {}, "
+                              "got {}.".format(file_name, expected,
+                                               digest.hexdigest()))
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+    os.rename(partial_path, zip_path)
+    return zip_path
+
+
+@traced(args=True)
+def install_from_repositories(packages, library, r_version, libraries,
+                              target=None, repositories=None, workers=None):
+    """Install packages and their missing dependencies from binary
+    repositories, without R resolving them.
+
+    Parameters
+    ----------
+    packages: list of str, packages to install.
+    library: str, R library dependencies are installed into.
+    r_version: str, version of the R installing them.
+    libraries: list of str, libraries R searches, for the packages
+               already installed.
+    target: str, library **packages** themselves are installed into,
+            such as a staging directory. Defaults to **library**.
+    repositories: list of str, repository URLs, by default
+                  config.R_REPOSITORIES.
+    workers: int, downloads at once, by default config.DOWNLOAD_WORKERS.
+
+    Returns
+    -------
+    list of the names installed, dependencies first, or None if
+    `Rcmd INSTALL` failed. Raises RepositoryError if the packages can't be
+    resolved or downloaded, before anything is installed.
+    """
+    repositories = repositories or config.R_REPOSITORIES
+    workers = workers or config.DOWNLOAD_WORKERS
+    index = merged_index(repositories, r_version, workers)
+    records = resolve(packages, index, libraries)
+    zips = parallel_map(lambda record: fetch_package(record, r_version),
+                        records, workers)
+
+    names = [record['Package'] for record in records]
+    target = target or library
+    if target == library:
+        batches = [(library, zips)]
+    else:
+        batches = [
+            (library, [zip_path for (name, zip_path) in zip(names, zips)
+                       if name not in packages]),
+            (target, [zip_path for (name, zip_path) in zip(names, zips)
+                      if name in packages])]
+    log.info("Installing from the repositories: %s", ", ".join(names))
+    # one R process per library, installing in the order given
+    for (batch_library, batch) in batches:
+        if not batch:
+            continue
+        if not os.path.exists(batch_library):
+            os.makedirs(batch_library)
+        rcmd_return = execute_r('Rcmd', 'INSTALL', '--library={}'.format(
+            batch_library), *batch)
+        invalidate()
+        if rcmd_return != 0:
+            return None
+    return names
@@ -4,7 +4,7 @@ from __future__ import division
 from __future__ import unicode_literals
 
 from contextlib import contextmanager
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from sys import version_info
 import ctypes.wintypes
 import datetime
@@ -13,7 +13,14 @@ import getpass
 import locale
 import logging
 import os
-from .utils import platform
+import re
+import sys
+from . import config
+from . import probe
+from . import snapshot
+from .compat import parse_version
+from .trace import traced
+from .utils import platform, versiontuple
 
 if version_info[0] < 3:
     PYVER = 2
@@ -36,6 +43,22 @@ SHGFP_TYPE_CURRENT = 0
 READ_ACCESS = (winreg.KEY_WOW64_64KEY + winreg.KEY_READ)
 FULL_ACCESS = (winreg.KEY_WOW64_64KEY + winreg.KEY_ALL_ACCESS)
 
+# only work with the R and R64 hives, ArcGIS doesn't examine R32
+R_REG_PATHS = ("SOFTWARE\\R-core\\R",
+               "SOFTWARE\\R-core\\R64",
+               "SOFTWARE\\Wow6432Node\\R-Core\\R",
+               "SOFTWARE\\Wow6432Node\\R-Core\\R64")
+PROFILE_LIST_PATH = \
+    "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion\\ProfileList"
+ESRI_KEYS = (
+    (winreg.HKEY_LOCAL_MACHINE, "SOFTWARE\\ESRI"),
+    (winreg.HKEY_LOCAL_MACHINE, "SOFTWARE\\Wow6432Node\\ESRI"),
+    (winreg.HKEY_CURRENT_USER, "SOFTWARE\\ESRI"),
+)
+# environment variables that steer discovery, see rtools.snapshot
+SNAPSHOT_ENVIRONMENT = ('R_HOME', 'R_USER', 'R_LIBS', 'R_LIBS_USER',
+                        'R_LIBS_SITE', 'HOME', 'USERNAME')
+
 
 # TODO re-intergrate this.
 @contextmanager
@@ -55,9 +78,7 @@ fnf_exception = getattr(__builtins__,
 
 def handle_fnf(exception):
     log_exception(exception)
-    if exception.errno == errno.ENOENT:
-        pass
-    else:
+    if exception.errno != errno.ENOENT:
         raise
 
 
@@ -65,16 +86,42 @@ def log_exception(err):
     """Make sure we can properly decode the exception,
        otherwise non-ASCII characters will cause a
        crash in the exception despite our intent to
-       only log the results."""
+       only log the results. Not-found errors are common in
+       registry walks, skip the decoding unless debug logging is on."""
+    if not log.isEnabledFor(logging.DEBUG):
+        return
 
     if PYVER == 2:
         enc = locale.getpreferredencoding() or 'ascii'
         try:
-            log.debug("Exception generated: {}".format(str(err).decode(enc, 'ignore')))
+            log.debug("Exception generated: %s", str(err).decode(enc, 'ignore'))
         except UnicodeDecodeError as e:
             log.debug("Exception generated, but can't decode it.")
     else:
-        log.debug("Exception generated: {}".format(err))
+        log.debug("Exception generated: %s", err)
+
+
+@contextmanager
+def registry_key(parent, reg_path, access=READ_ACCESS, create=False):
+    """ Open a registry key for the duration of a with block, and close
+        it on the way out. **parent** is a root key such as
+        HKEY_LOCAL_MACHINE, or an open key, to reuse it for reading a
+        subkey rather than opening the full path again.
+
+        Yields: the key, or None if it doesn't exist."""
+    key = None
+    try:
+        if create:
+            key = winreg.CreateKeyEx(parent, reg_path, 0, access)
+        else:
+            key = winreg.OpenKey(parent, reg_path, 0, access)
+    except fnf_exception as error:
+        handle_fnf(error)
+    try:
+        yield key
+    finally:
+        if key is not None:
+            winreg.CloseKey(key)
 
 
 def _documents_folder():
@@ -86,11 +133,11 @@ def _documents_folder():
     # first, check if the user has an R_USER variable initialized.
     documents_folder = _environ_path("R_USER")
 
-    if not documents_folder or not os.path.exists(documents_folder):
+    if not documents_folder or not probe.exists(documents_folder):
         # next, check if the user has the HOME variable set
         documents_folder = _environ_path("HOME")
 
-    if not documents_folder or not os.path.exists(documents_folder):
+    if not documents_folder or not probe.exists(documents_folder):
         # Call SHGetFolderPath using ctypes.
         ctypes_buffer = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
         ctypes.windll.shell32.SHGetFolderPathW(
@@ -99,7 +146,7 @@ def _documents_folder():
 
     # if we can't get the CSIDL_PERSONAL directory, fall back on manual
     # construction of the path.
-    if not documents_folder or not os.path.exists(documents_folder):
+    if not documents_folder or not probe.exists(documents_folder):
         ctypes_buffer = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
         ctypes.windll.shell32.SHGetFolderPathW(
             0, CSIDL_PROFILE, 0, SHGFP_TYPE_CURRENT, ctypes_buffer)
@@ -109,43 +156,83 @@ def _documents_folder():
     return documents_folder
 
 
-def _user_sids():
-    """Map between usernames and the related SID."""
-    user_sids = {}
+@traced()
+def _user_profiles():
+    """Map between usernames and their (SID, profile path) pair."""
+    cached = snapshot.get('user_profiles')
+    if cached is not snapshot.MISSING:
+        return dict((username, tuple(profile))
+                    for (username, profile) in cached.items())
+    user_profiles = _read_user_profiles()
+    snapshot.put('user_profiles', user_profiles)
+    return user_profiles
 
-    root_key = winreg.HKEY_LOCAL_MACHINE
-    reg_path = "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion\\ProfileList"
 
-    try:
-        log.info("OpenKey on {}, with READ + WOW64".format(reg_path))
-        sid_reg = winreg.OpenKey(root_key, reg_path,
-                                 0, READ_ACCESS)
+def _read_user_profiles():
+    user_profiles = {}
 
-    except fnf_exception as error:
-        handle_fnf(error)
+    root_key = winreg.HKEY_LOCAL_MACHINE
+    reg_path = PROFILE_LIST_PATH
 
-    if sid_reg:
+    log.info("OpenKey on %s, with READ + WOW64", reg_path)
+    with registry_key(root_key, reg_path) as sid_reg:
+        if not sid_reg:
+            return user_profiles
         subkey_count = winreg.QueryInfoKey(sid_reg)[0]
         for pos in range(subkey_count):
+            sid = None
             try:
                 sid = winreg.EnumKey(sid_reg, pos)
             except:
                 pass
             if sid:
-                profile_path_key = "{}\\{}".format(reg_path, sid)
                 try:
-                    profile_path_reg = winreg.OpenKey(
-                        root_key, profile_path_key, 0, READ_ACCESS)
-
-                    profile_path = winreg.QueryValueEx(
-                        profile_path_reg, "ProfileImagePath")[0]
+                    # open the profile from the list key, not the full path
+                    with registry_key(sid_reg, sid) as profile_path_reg:
+                        profile_path = winreg.QueryValueEx(
+                            profile_path_reg, "ProfileImagePath")[0]
 
                     username = profile_path.split("\\")[-1]
-                    user_sids[username] = sid
+                    user_profiles[username] = (sid, profile_path)
                 except:
                     pass
 
-    return user_sids
+    return user_profiles
+
+
+@traced()
+def _user_sids():
+    """Map between usernames and the related SID."""
+    return dict((username, sid) for (username, (sid, _)) in
+                _user_profiles().items())
+
+
+def _profile_documents_folder(sid, profile_path):
+    """ Get the documents folder of another user's profile. Uses the
+        'Personal' shell folder from the user's hive when it is loaded,
+        so that redirected documents folders are honored.
+
+        Returns: full path of the user's documents folder."""
+    documents_folder = None
+    reg_path = "{}\\{}".format(
+        sid, "Software\\Microsoft\\Windows\\CurrentVersion"
+             "\\Explorer\\User Shell Folders")
+    with registry_key(winreg.HKEY_USERS, reg_path) as shell_reg:
+        if shell_reg:
+            try:
+                documents_raw = winreg.QueryValueEx(shell_reg, "Personal")[0]
+                # REG_EXPAND_SZ values reference the profile of their
+                # owner, not of the calling user.
+                documents_folder = documents_raw.replace(
+                    "%USERPROFILE%", profile_path)
+            except fnf_exception as error:
+                handle_fnf(error)
+
+    if not documents_folder or '%' in documents_folder:
+        documents_folder = os.path.join(profile_path, "Documents")
+
+    return documents_folder
+
 
 def _user():
     """Get currently logged in user name."""
@@ -166,9 +253,9 @@ def _user_hive(username=None):
         sid = sids[username]
         root_key = winreg.HKEY_USERS
         try:
-            hive_reg = winreg.OpenKey(root_key, sid, 0, READ_ACCESS)
-            if hive_reg:
-                hive_base = sid
+            with registry_key(root_key, sid) as hive_reg:
+                if hive_reg:
+                    hive_base = sid
         except:
             pass
     return hive_base
@@ -179,24 +266,98 @@ def _environ_path(var=None):
     path = None
     if var and var in os.environ:
         var_path = os.environ[var]
-        if os.path.exists(var_path):
+        if probe.exists(var_path):
             path = var_path
 
     return path
 
 
+def _r_reg_lookup(r_reg, r_path, lookup_key, r_reg_value, verbose):
+    """Look up a value within an open R-core key, such as
+       SOFTWARE\\R-core\\R, or failing that in its version subkeys, which
+       are opened through it.
+
+       Returns: the value found, or **r_reg_value** as passed in."""
+    # set an epoch for a Windows FILETIME object
+    epoch = datetime.datetime(1601, 1, 1)
+
+    if verbose:
+        log.info("Successfully found %s", r_path)
+
+    try:
+        if verbose:
+            log.info("Looking for %s.", lookup_key)
+        r_reg_value = winreg.QueryValueEx(r_reg, lookup_key)[0]
+    except fnf_exception as error:
+        handle_fnf(error)
+
+    if r_reg_value:
+        return r_reg_value
+
+    log.debug("Top-level value not defined. "
+              "Checking version-specific locations.")
+    # Can't find the install path as a top-level value.
+    # Inspect the children keys for versions, and use the most
+    # recently installed one as the correct R installation.
+
+    if lookup_key == 'dict':
+        # version: install path
+        r_reg_value = {}
+
+    max_time = epoch
+    try:
+        subkey_count = winreg.QueryInfoKey(r_reg)[0]
+    except:
+        subkey_count = 10
+    for pos in range(subkey_count):
+        # TODO ensure this is robust to errors
+        with ignored(WindowsError):
+            if verbose:
+                log.info("checking EnumKey pos %d", pos)
+            r_base_key = winreg.EnumKey(r_reg, pos)
+
+            if r_base_key:
+                # in the case that we've asked for dict,
+                # return all instances of desired key
+                if lookup_key == 'dict':
+                    r_reg_value[r_base_key] = None
+
+                with registry_key(r_reg, r_base_key) as r_version_reg:
+                    version_path = winreg.QueryValueEx(
+                        r_version_reg, "InstallPath")[0]
+                    r_version_info = winreg.QueryInfoKey(r_version_reg)
+                if lookup_key == 'path':
+                    r_reg_value = version_path
+                if lookup_key == 'dict':
+                    # check that the versions have valid R DLLs.
+                    rdll_path = os.path.join(version_path, 'bin',
+                                             platform(), "R.dll")
+                    if probe.exists(rdll_path):
+                        r_reg_value[r_base_key] = version_path
+
+                r_install_time = epoch + datetime.timedelta(
+                    microseconds=r_version_info[2] / 10)
+                if max_time < r_install_time:
+                    max_time = r_install_time
+    return r_reg_value
+
+
+@traced(args=True)
 def r_reg_value(lookup_key='path'):
     """Find R related registry values."""
 
     lookup_keys = ['InstallPath', 'Current Version', 'dict']
     if lookup_key not in lookup_keys:
-        log.warn("Looking up invalid key {}".format(lookup_key))
+        log.warn("Looking up invalid key %s", lookup_key)
         return None
 
-    r_reg_value = None
+    cached = snapshot.get('r_reg_value', lookup_key)
+    if cached is not snapshot.MISSING:
+        return cached
 
-    # set an epoch for a Windows FILETIME object
-    epoch = datetime.datetime(1601, 1, 1)
+    r_reg_value = None
+    # checked once, rather than for each key visited
+    verbose = log.isEnabledFor(logging.INFO)
 
     root_keys = OrderedDict((
         # if we have a user hive, also check that first.
@@ -204,100 +365,58 @@ def r_reg_value(lookup_key='path'):
         ('HKCU', winreg.HKEY_CURRENT_USER),
         ('HKLM', winreg.HKEY_LOCAL_MACHINE),
     ))
-    # only work with the R and R64 hives, ArcGIS doesn't examine R32
-    r_reg_paths = ["SOFTWARE\\R-core\\R",
-                   "SOFTWARE\\R-core\\R64",
-                   "SOFTWARE\\Wow6432Node\\R-Core\\R",
-                   "SOFTWARE\\Wow6432Node\\R-Core\\R64"]
 
-    for (key_name, root_key) in list(root_keys.items()):
-        for r_path in r_reg_paths:
-            r_reg = None
+    # the current user's hive within HKU, looked up once
+    user_hive = None
+    user = _user()
+    if user:
+        user_hive = _user_hive(user)
 
-            try:
-                log.info("OpenKey on {}, with READ + WOW64".format(r_path))
-                # HKU hive should be prepended to search
-                if key_name is 'HKU':
-                    user = _user()
-                    # if we can't identify the user, skip this key
-                    if not user:
-                        continue
+    for (key_name, root_key) in list(root_keys.items()):
+        for r_path in R_REG_PATHS:
+            # HKU hive should be prepended to search
+            if key_name is 'HKU':
+                # if we can't identify the user or their hive, skip this key
+                if not user_hive:
+                    continue
+                r_path = "{}\\{}".format(user_hive, r_path)
+
+            if verbose:
+                log.info("OpenKey on %s, with READ + WOW64", r_path)
+            with registry_key(root_key, r_path) as r_reg:
+                if r_reg:
+                    r_reg_value = _r_reg_lookup(
+                        r_reg, r_path, lookup_key, r_reg_value, verbose)
+    snapshot.put('r_reg_value', r_reg_value, lookup_key)
+    return r_reg_value
 
-                    r_path = "{}\\{}".format(_user_hive(user), r_path)
 
-                r_reg = winreg.OpenKey(root_key, r_path, 0, READ_ACCESS)
-            except fnf_exception as error:
-                handle_fnf(error)
+# R values written to the registry
+R_WRITE_KEYS = ('InstallPath', 'Current Version')
 
-            if r_reg:
-                log.info("Successfully found {}".format(r_path))
 
-                try:
-                    log.info("Looking for {}.".format(lookup_key))
-                    r_reg_value = winreg.QueryValueEx(r_reg, lookup_key)[0]
-                except fnf_exception as error:
-                    handle_fnf(error)
-
-                if not r_reg_value:
-                    log.debug("Top-level value not defined. " +
-                              "Checking version-specific locations.")
-                    # Can't find the install path as a top-level value.
-                    # Inspect the children keys for versions, and use the most
-                    # recently installed one as the correct R installation.
-
-                    if lookup_key == 'dict':
-                        # version: install path
-                        r_reg_value = {}
-
-                    max_time = epoch
-                    try:
-                        subkey_count = winreg.QueryInfoKey(r_reg)[0]
-                    except:
-                        subkey_count = 10
-                    for pos in range(subkey_count):
-                        # TODO ensure this is robust to errors
-                        with ignored(WindowsError):
-                            log.info("checking EnumKey pos {}".format(pos))
-                            r_base_key = winreg.EnumKey(r_reg, pos)
-
-                            if r_base_key:
-                                # in the case that we've asked for dict,
-                                # return all instances of desired key
-                                if lookup_key == 'dict':
-                                    r_reg_value[r_base_key] = None
-
-                                r_version_key = "{}\\{}".format(
-                                    r_path, r_base_key)
-                                r_version_reg = winreg.OpenKey(
-                                    root_key, r_version_key, 0,
-                                    READ_ACCESS)
-
-                                version_path = winreg.QueryValueEx(
-                                    r_version_reg, "InstallPath")[0]
-                                if lookup_key == 'path':
-                                    r_reg_value = version_path
-                                if lookup_key == 'dict':
-                                    # check that the versions have valid R DLLs.
-                                    rdll_path = os.path.join(version_path, 'bin',
-                                                             platform(), "R.dll")
-                                    if os.path.exists(rdll_path):
-                                        r_reg_value[r_base_key] = version_path
-
-                                r_version_info = winreg.QueryInfoKey(
-                                    r_version_reg)
-                                r_install_time = epoch + datetime.timedelta(
-                                    microseconds=r_version_info[2] / 10)
-                                if max_time < r_install_time:
-                                    max_time = r_install_time
-    return r_reg_value
+def r_reg_write_values(values):
+    """ Write R registry values together: each R-core key of a hive is
+        created once and every value set in it, then read back to verify
+        it. HKLM is tried first, then HKCU, and the values are only
+        entered into one hive.
 
+        Parameters
+        ----------
+        values: dictionary of value name: string, names from
+                R_WRITE_KEYS.
 
-def r_reg_write_value(r_key=None, r_value=None):
-    """Write R registry values."""
-    # keys to write
-    r_write_keys = ('InstallPath', 'Current Version')
-    if r_key not in r_write_keys:
-        log.warn("asked to write an invalid key, {}".format(r_key))
+        Returns
+        -------
+        str, the hive written, 'HKLM' or 'HKCU', or None if no hive could
+        be written."""
+    invalid = [name for name in values if name not in R_WRITE_KEYS]
+    if invalid:
+        log.warn("asked to write invalid keys, %s", ", ".join(invalid))
+        return None
+    values = dict((name, value) for (name, value) in values.items()
+                  if value)
+    if not values:
         return None
 
     root_keys = OrderedDict((
@@ -305,50 +424,67 @@ def r_reg_write_value(r_key=None, r_value=None):
         ('HKLM', winreg.HKEY_LOCAL_MACHINE),
         ('HKCU', winreg.HKEY_CURRENT_USER)
     ))
-    # only work with the R and R64 hives, ArcGIS doesn't examine R32
-    r_reg_paths = ["SOFTWARE\\R-core\\R",
-                   "SOFTWARE\\R-core\\R64",
-                   "SOFTWARE\\Wow6432Node\\R-Core\\R",
-                   "SOFTWARE\\Wow6432Node\\R-Core\\R64"]
 
     for (key_name, root_key) in list(root_keys.items()):
         wrote = False
-        for r_path in r_reg_paths:
-            r_reg = None
-
+        for r_path in R_REG_PATHS:
+            log.info("CreateKeyEx on %s\\%s, with write", key_name, r_path)
             try:
-                log.info("CreateKeyEx on {}\\{}, with write".format(
-                    key_name, r_path))
-                r_reg = winreg.CreateKeyEx(root_key, r_path, 0, FULL_ACCESS)
+                with registry_key(root_key, r_path, FULL_ACCESS,
+                                  create=True) as r_reg:
+                    if r_reg and _set_values(r_reg, values):
+                        wrote = True
             except WindowsError as error:
-                if error.errno == errno.ENOENT:
-                    pass
                 # permission denied, skip
                 if error.errno == errno.EACCES:
                     log.debug("permission denied.")
-                    continue
-
-            if r_reg:
-                try:
-                    log.info('setting "{}" to "{}"'.format(r_key, r_value))
-                    winreg.SetValueEx(r_reg, r_key, 0,
-                                      winreg.REG_SZ, r_value)
-                    wrote = True
-                except fnf_exception as error:
-                    handle_fnf(error)
+                else:
+                    log_exception(error)
         # only enter the keys into one hive
         if wrote:
-            break
+            return key_name
+    return None
+
+
+def _set_values(r_reg, values):
+    """Set string values in an open key, and check they read back.
+
+    Returns: True if every value was written."""
+    for (name, value) in values.items():
+        log.info('setting "%s" to "%s"', name, value)
+        winreg.SetValueEx(r_reg, name, 0, winreg.REG_SZ, value)
+    for (name, value) in values.items():
+        try:
+            written = winreg.QueryValueEx(r_reg, name)[0]
+        except fnf_exception as error:
+            handle_fnf(error)
+            written = None
+        if written != value:
+            log.warn('"%s" reads back as "%s", not "%s"', name, written,
+                     value)
+            return False
+    return True
+
+
+def r_reg_write_value(r_key=None, r_value=None):
+    """Write R registry values."""
+    # keys to write
+    if r_key not in R_WRITE_KEYS:
+        log.warn("asked to write an invalid key, %s", r_key)
+        return None
+    return r_reg_write_values({r_key: r_value})
 
 
 def r_set_install(install_path=None, current_version=None):
-    """Set default install for R."""
+    """Set default install for R, writing both values in one pass.
+
+    Returns: the hive written, see `r_reg_write_values`."""
     if install_path:
-        log.info("writing 'InstallPath' value {}".format(install_path))
-        r_reg_write_value("InstallPath", install_path)
+        log.info("writing 'InstallPath' value %s", install_path)
     if current_version:
-        log.info("writing 'Current Version' value {}".format(current_version))
-        r_reg_write_value("Current Version", current_version)
+        log.info("writing 'Current Version' value %s", current_version)
+    return r_reg_write_values({'InstallPath': install_path,
+                               'Current Version': current_version})
 
 
 def r_path():
@@ -358,15 +494,133 @@ def r_path():
     r_home = _environ_path("R_HOME")
     if r_home:
         r_home_bin_path = os.path.join(r_home, "bin")
-        if os.path.exists(r_home_bin_path):
+        if probe.exists(r_home_bin_path):
             r_install_path = r_home
 
     if not r_install_path:
         r_install_path = r_reg_value("InstallPath")
-    log.info("Final R install path: {}".format(r_install_path))
+    log.info("Final R install path: %s", r_install_path)
     return r_install_path
 
 
+# major.minor.patch, ignoring suffixes such as 'revised' or 'Patched'
+VERSION_PATTERN = re.compile(r'(\d+)\.(\d+)(?:\.(\d+))?')
+# a version as R-core names registry keys, with a lower case patch level
+# such as 'revised' written after it, within a VERSION file's
+# '3.2.4 revised'. Statuses such as 'Patched' aren't part of it.
+RAW_VERSION_PATTERN = re.compile(r'(\d+\.\d+(?:\.\d+)?)(?:\s*([a-z]+)\b)?')
+# the version within an R home directory name, e.g. R-3.2.4revised
+DIR_VERSION_PATTERN = re.compile(r'\d+\.\d+[\w.]*')
+# R_MAJOR and R_MINOR definitions in include/Rversion.h
+RVERSION_H_PATTERN = re.compile(r'#define\s+R_(MAJOR|MINOR)\s+"([^"]*)"')
+# the FileVersion string of a version resource, in UTF-16
+FILE_VERSION_KEY = 'FileVersion\0'.encode('utf-16-le')
+
+# R home: version read from its files
+_r_home_versions = {}
+
+
+def _clean_version(raw):
+    """Normalize a version string to major.minor.patch.
+
+    Returns: version string, or None if raw doesn't hold a version."""
+    match = VERSION_PATTERN.search(raw or '')
+    if not match:
+        return None
+    (major, minor, patch) = match.groups()
+    return "{}.{}.{}".format(major, minor, patch or '0')
+
+
+def _raw_version(raw):
+    """The version in the first line of a version string, in the form
+    R-core uses for registry keys: '3.2.4 revised' becomes
+    '3.2.4revised', keeping the suffix for the checks that need it.
+
+    Returns: version string, or None if raw doesn't hold a version."""
+    raw = (raw or '').strip().split('\n')[0]
+    match = RAW_VERSION_PATTERN.search(raw)
+    if not match:
+        return None
+    return match.group(1) + (match.group(2) or '')
+
+
+def _read_file(path, mode='r'):
+    try:
+        with open(path, mode) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _version_from_header(r_home):
+    """Version from include/Rversion.h, which defines e.g. R_MAJOR "4"
+    and R_MINOR "1.2", or "2.4revised" with the patch level."""
+    text = _read_file(os.path.join(r_home, 'include', 'Rversion.h'))
+    if not text:
+        return None
+    parts = dict(RVERSION_H_PATTERN.findall(text))
+    if 'MAJOR' not in parts or 'MINOR' not in parts:
+        return None
+    return _raw_version("{}.{}".format(parts['MAJOR'], parts['MINOR']))
+
+
+def _version_from_file(r_home):
+    """Version from the VERSION file, e.g. '4.1.2' or '3.2.4 revised'."""
+    return _raw_version(_read_file(os.path.join(r_home, 'VERSION')))
+
+
+def _version_from_dll(r_home):
+    """Version from the FileVersion string of the R.dll version resource,
+    read from the file rather than by loading the library."""
+    for rdll_path in (os.path.join(r_home, 'bin', platform(), 'R.dll'),
+                      os.path.join(r_home, 'bin', 'R.dll')):
+        data = _read_file(rdll_path, 'rb')
+        if not data:
+            continue
+        pos = data.rfind(FILE_VERSION_KEY)
+        if pos == -1:
+            continue
+        # the value follows the key, aligned to 32 bits
+        start = pos + len(FILE_VERSION_KEY)
+        start += (4 - start % 4) % 4
+        end = data.find(b'\0\0', start)
+        while end != -1 and (end - start) % 2:
+            end = data.find(b'\0\0', end + 1)
+        if end == -1:
+            continue
+        raw = data[start:end].decode('utf-16-le', 'ignore')
+        version = _clean_version(raw)
+        if version:
+            return version
+    return None
+
+
+@traced(args=True)
+def r_home_version(r_home):
+    """ Version of the R installed in **r_home**, read from its files:
+        include/Rversion.h, VERSION, or the R.dll version resource.
+        Doesn't need the registry or start R, and is cached per R home.
+
+        Returns: version string, as R-core names its registry key, e.g.
+        '3.2.4revised', or None. Use `_clean_version` where a numeric version is needed."""
+    if not r_home:
+        return None
+    probe.check()
+    key = os.path.normcase(os.path.normpath(r_home))
+    if key not in _r_home_versions:
+        version = snapshot.get('r_home_version', key)
+        if version is snapshot.MISSING:
+            version = None
+            for reader in (_version_from_header, _version_from_file,
+                           _version_from_dll):
+                version = reader(r_home)
+                if version:
+                    break
+            snapshot.put('r_home_version', version, key)
+        _r_home_versions[key] = version
+    return _r_home_versions[key]
+
+
 def r_version(current_only=False):
     """Find current R version."""
 
@@ -376,8 +630,12 @@ def r_version(current_only=False):
     if not current_only and not r_version:
         r_path_l = r_path()
         if r_path_l is not None:
-            if '-' in r_path_l:
-                r_version = r_path_l.split('-')[1]
+            r_version = r_home_version(r_path_l)
+            # last resort, a path such as C:\Program Files\R\R-4.1.2
+            if not r_version:
+                match = DIR_VERSION_PATTERN.search(os.path.basename(
+                    os.path.normpath(r_path_l)))
+                r_version = _raw_version(match.group(0)) if match else None
     return r_version
 
 
@@ -387,58 +645,134 @@ def r_version_dict():
     return r_versions
 
 
-def r_user_lib_path():
+def r_user_lib_path(username=None, version=None):
+    """ Per-user R library, Documents/R/win-library/R-x.x/. By default
+        this is the library of the calling user, pass **username** to
+        resolve the library of another profile on this machine. Uses the
+        current R version, unless another **version** is given."""
     r_user_library_path = None
-    if r_version():
+    version = _clean_version(version or r_version())
+    if version:
         # user's R library in Documents/R/win-library/R-x.x/
-        (r_major, r_minor, r_patch) = r_version().split(".")[0:3]
+        (r_major, r_minor, r_patch) = version.split(".")[0:3]
+
+        if username:
+            profiles = _user_profiles()
+            if username not in profiles:
+                log.warn("No profile found for user %s", username)
+                return None
+            (sid, profile_path) = profiles[username]
+            documents_folder = _profile_documents_folder(sid, profile_path)
+        else:
+            documents_folder = _documents_folder()
 
         r_user_library_path = os.path.join(
-            _documents_folder(), "R", "win-library",
+            documents_folder, "R", "win-library",
             "{}.{}".format(r_major, r_minor))
     return r_user_library_path
 
 
+@traced()
 def r_all_lib_paths():
     """ Package library, locates all known library
         paths used for R packages."""
+    cached = snapshot.get('r_all_lib_paths')
+    if cached is not snapshot.MISSING:
+        return list(cached)
+    with snapshot.batch():
+        return _find_lib_paths()
+
 
+def _find_lib_paths():
     libs_path = []
     # check R_LIBS_USER first
-    if _environ_path("R_LIBS_USER"):
-        libs_path.append(_environ_path("R_LIBS_USER"))
+    r_libs_user = _environ_path("R_LIBS_USER")
+    if r_libs_user:
+        libs_path.append(r_libs_user)
 
     r_user_library_path = r_user_lib_path()
-    if r_user_library_path is not None and os.path.exists(r_user_library_path):
+    if r_user_library_path is not None and probe.exists(r_user_library_path):
         libs_path.append(r_user_library_path)
 
     # Next, check the value of R_LIBS -- users may set this
     # instead of the (more specific) R_LIBS_USER
-    if _environ_path("R_LIBS"):
-        libs_path.append(_environ_path("R_LIBS"))
+    r_libs = _environ_path("R_LIBS")
+    if r_libs:
+        libs_path.append(r_libs)
 
     # lastly, check for possible site libraries.
     # NOTE: Requires elevated privileges to write to
 
-    if _environ_path("R_LIBS_SITE"):
-        libs_path.append(_environ_path("R_LIBS_SITE"))
+    r_libs_site = _environ_path("R_LIBS_SITE")
+    if r_libs_site:
+        libs_path.append(r_libs_site)
 
-    if _environ_path("R_HOME"):
-        r_home = _environ_path("R_HOME")
+    r_home = _environ_path("R_HOME")
+    if r_home:
         r_home_lib_path = os.path.join(r_home, "library")
-        if os.path.exists(r_home_lib_path):
+        if probe.exists(r_home_lib_path):
             libs_path.append(r_home_lib_path)
 
     # R library in Program Files/R-x.xx/library
-    if r_path() is not None:
-        r_install_lib_path = os.path.join(
-            r_path(), "library")
+    r_install_path = r_path()
+    if r_install_path is not None:
+        r_install_lib_path = os.path.join(r_install_path, "library")
 
-        if os.path.exists(r_install_lib_path):
+        if probe.exists(r_install_lib_path):
             libs_path.append(r_install_lib_path)
 
     libs_path = [os.path.normpath(p) for p in libs_path]
-    return libs_path
+    # the per-user library validates the result, even while missing
+    snapshot.put('r_user_lib_path', r_user_library_path)
+    snapshot.put('r_all_lib_paths', libs_path)
+    return list(libs_path)
+
+
+def r_home_lib_paths(r_home, version=None):
+    """ Libraries searched by the R installed in **r_home**, which need
+        not be the current R, in priority order. **version** defaults to
+        the version read from its files, see `r_home_version`."""
+    libs_path = []
+    version = version or r_home_version(r_home)
+
+    r_libs_user = _environ_path("R_LIBS_USER")
+    if r_libs_user:
+        libs_path.append(r_libs_user)
+
+    r_user_library_path = r_user_lib_path(version=version)
+    if r_user_library_path is not None and probe.exists(r_user_library_path):
+        libs_path.append(r_user_library_path)
+
+    for var in ("R_LIBS", "R_LIBS_SITE"):
+        env_path = _environ_path(var)
+        if env_path:
+            libs_path.append(env_path)
+
+    r_install_lib_path = os.path.join(r_home, "library")
+    if probe.exists(r_install_lib_path):
+        libs_path.append(r_install_lib_path)
+
+    return [os.path.normpath(p) for p in libs_path]
+
+
+def r_site_lib_path():
+    """ Site library, shared by all users of this R installation. Uses
+        R_LIBS_SITE when set, otherwise the library within R_HOME.
+        NOTE: Requires elevated privileges to write to."""
+    site_lib_path = None
+    r_libs_site = os.environ.get("R_LIBS_SITE")
+    if r_libs_site:
+        # R_LIBS_SITE can hold multiple paths; R uses the first.
+        site_lib_path = r_libs_site.split(";")[0]
+
+    if not site_lib_path:
+        r_install_path = r_path()
+        if r_install_path is not None:
+            site_lib_path = os.path.join(r_install_path, "library")
+
+    if site_lib_path:
+        site_lib_path = os.path.normpath(site_lib_path)
+    return site_lib_path
 
 
 def r_lib_path():
@@ -451,6 +785,7 @@ def r_lib_path():
     return lib_path
 
 
+@traced()
 def r_pkg_path():
     """
     Package path search. Locations searched:
@@ -464,131 +799,292 @@ def r_pkg_path():
     root_key = winreg.HKEY_CURRENT_USER
     reg_path = "SOFTWARE\\Esri\\ArcGISPro"
     package_key = 'RintegrationProPackagePath'
-    pro_reg = None
+    package_path_raw = None
 
-    try:
-        # find the key, 64- or 32-bit we want it all
-        pro_reg = winreg.OpenKey(root_key, reg_path, 0, READ_ACCESS)
-    except fnf_exception as error:
-        handle_fnf(error)
-
-    if pro_reg:
-        try:
-            # returns a tuple of (value, type)
-            package_path_key = winreg.QueryValueEx(pro_reg, package_key)
-            package_path_raw = package_path_key[0]
-            if os.path.exists(package_path_raw):
-                package_path = package_path_raw
-        except fnf_exception as error:
-            handle_fnf(error)
+    # find the key, 64- or 32-bit we want it all
+    with registry_key(root_key, reg_path) as pro_reg:
+        if pro_reg:
+            try:
+                # returns a tuple of (value, type)
+                package_path_key = winreg.QueryValueEx(pro_reg, package_key)
+                package_path_raw = package_path_key[0]
+            except fnf_exception as error:
+                handle_fnf(error)
+    if package_path_raw and probe.exists(package_path_raw):
+        package_path = package_path_raw
 
     # iterate over all known library path locations,
     # and check for our package in each.
     for lib_path in r_all_lib_paths():
         possible_package_path = os.path.join(lib_path, package_name)
-        if os.path.exists(possible_package_path):
+        if probe.exists(possible_package_path):
             package_path = possible_package_path
             # we want the highest-priority library, stop here
             break
 
     # fallback -- <ArcGIS Install>/Rintegration/arcgisbinding
+    arc_install_info = None
     if not package_path:
-        import arcpy
-        arc_install_dir = arcpy.GetInstallInfo()['InstallDir']
+        arc_install_info = arcgis_install_info()
+    if arc_install_info and arc_install_info.get('InstallDir'):
+        arc_install_dir = arc_install_info['InstallDir']
         arc_package_dir = os.path.join(
             arc_install_dir, 'Rintegration', package_name)
-        if os.path.exists(arc_package_dir):
+        if probe.exists(arc_package_dir):
             package_path = arc_package_dir
 
     return package_path
 
 
+def package_description_version(package_path):
+    """Version field from the DESCRIPTION file of an installed package.
+
+    Returns: version string, or None."""
+    version = None
+    desc_path = os.path.join(package_path, 'DESCRIPTION')
+    if probe.exists(desc_path):
+        with open(desc_path) as desc_f:
+            for line in desc_f:
+                (key, sep, value_raw) = line.strip().partition(':')
+                if sep and key == 'Version':
+                    version = value_raw.strip()
+    return version
+
+
 def r_pkg_version():
     version = None
     r_package_path = r_pkg_path()
     if r_package_path:
-        desc_path = os.path.join(r_package_path, 'DESCRIPTION')
-        if os.path.exists(desc_path):
-            with open(desc_path) as desc_f:
-                for line in desc_f:
-                    try:
-                        (key, value_raw) = line.strip().split(':')
-                    except:
-                        # gulp
-                        pass
-                    if key == 'Version':
-                        version = value_raw.strip()
+        version = package_description_version(r_package_path)
     return version
 
 
-def arcmap_exists(version=None):
-    """Check for the existence of the specified version of ArcMap.
+ArcGISProduct = namedtuple('ArcGISProduct', (
+    'product', 'product_name', 'version', 'install_dir', 'rintegration_dir'))
 
-    Returns: True or False"""
-    root_key = winreg.HKEY_LOCAL_MACHINE
-    if not version:
-        version = "10.3"
-    package_key = "Desktop{}".format(version)
+# ArcGIS products found by `arcgis_products`, None until discovered
+_arcgis_products = None
 
-    arc_reg_paths = [
-        "SOFTWARE\\ESRI\\{}".format(package_key),
-        "SOFTWARE\\Wow6432Node\\ESRI\\{}".format(package_key)
-    ]
 
-    installed = False
-    for reg_path in arc_reg_paths:
-        arcmap_reg = None
-        try:
-            # find the key, 64- or 32-bit we want it all
-            arcmap_reg = winreg.OpenKey(root_key, reg_path, 0, READ_ACCESS)
-        except fnf_exception as error:
-            handle_fnf(error)
+def _arcgis_product(esri_reg, key_name):
+    """Read the installation of one product key under SOFTWARE\\ESRI.
 
-        if arcmap_reg:
-            installed = True
+    Returns: ArcGISProduct, or None if the key isn't an installed
+    Pro or Desktop product."""
+    if key_name == 'ArcGISPro':
+        (product, product_name) = ('Pro', 'ArcGISPro')
+    elif re.match(r'Desktop\d', key_name):
+        (product, product_name) = ('ArcMap', 'Desktop')
+    else:
+        return None
 
-    return installed
+    values = {}
+    with registry_key(esri_reg, key_name) as product_reg:
+        if not product_reg:
+            return None
+        for value_name in ('InstallDir', 'RealVersion', 'Version'):
+            try:
+                values[value_name] = winreg.QueryValueEx(
+                    product_reg, value_name)[0]
+            except fnf_exception as error:
+                handle_fnf(error)
 
+    install_dir = (values.get('InstallDir') or '').rstrip('\\')
+    if not install_dir or not probe.exists(install_dir):
+        return None
 
-def arcmap_path(version=None):
-    """Path to ArcGIS Installation. By default, attempts to look up all
-       possible versions that can be connected to R, or can optionally
-       check only a specific version passed with the **version** keyword.
+    # RealVersion includes the build number, e.g. 10.3.1.4959
+    version = None
+    real_version = parse_version(values.get('RealVersion'))
+    if real_version is not None:
+        version = ".".join(str(n) for n in real_version.numbers[0:3])
+    if version is None:
+        version = values.get('Version') or key_name[len('Desktop'):] or None
 
-       Returns: path of installed ArcGIS Desktop installation."""
+    return ArcGISProduct(product, product_name, version, install_dir,
+                         os.path.join(install_dir, 'Rintegration'))
 
-    arcmap_path = None
 
-    # list supported major versions
-    releases = ["10.3", "10.4", "10.5"]
-    if releases and version in releases:
-        releases = [version]
+def _esri_products(esri_reg, products, seen):
+    """Add the products under an open SOFTWARE\\ESRI key to **products**,
+    skipping installation directories in **seen**."""
+    try:
+        subkey_count = winreg.QueryInfoKey(esri_reg)[0]
+    except WindowsError as error:
+        log_exception(error)
+        return
+    for pos in range(subkey_count):
+        try:
+            key_name = winreg.EnumKey(esri_reg, pos)
+        except WindowsError as error:
+            log_exception(error)
+            continue
+        record = _arcgis_product(esri_reg, key_name)
+        if record is not None and record.install_dir.lower() not in seen:
+            seen.add(record.install_dir.lower())
+            products.append(record)
+
+
+@traced()
+def arcgis_products(refresh=False):
+    """ Installed ArcGIS Pro and Desktop products, from one pass over
+        SOFTWARE\\ESRI in both registry views, and for per-user Pro
+        installs, the current user. The result is cached, pass
+        **refresh** to enumerate again.
+
+        Returns: list of ArcGISProduct tuples of product ('Pro' or
+        'ArcMap'), product_name (as in arcpy.GetInstallInfo()), version,
+        install_dir and rintegration_dir. Pro comes first, then the
+        newest versions."""
+    global _arcgis_products
+    probe.check()
+    if _arcgis_products is not None and not refresh:
+        return list(_arcgis_products)
+    if not refresh:
+        cached = snapshot.get('arcgis_products')
+        if cached is not snapshot.MISSING:
+            _arcgis_products = [ArcGISProduct(*record) for record in cached]
+            return list(_arcgis_products)
+
+    products = []
+    seen = set()
+    for (root_key, reg_path) in ESRI_KEYS:
+        with registry_key(root_key, reg_path) as esri_reg:
+            if esri_reg:
+                _esri_products(esri_reg, products, seen)
+
+    products.sort(key=lambda record: (record.product == 'Pro',
+                                      versiontuple(record.version) or ()),
+                  reverse=True)
+    _arcgis_products = products
+    snapshot.put('arcgis_products', [list(record) for record in products])
+    return list(products)
+
+
+def _clear_caches():
+    global _arcgis_products
+    _r_home_versions.clear()
+    _arcgis_products = None
+
+
+def _subkeys(root_key, reg_path):
+    """Names of the subkeys of a registry key, none if it doesn't exist."""
+    names = []
+    with registry_key(root_key, reg_path) as reg:
+        if reg is not None:
+            with ignored(WindowsError):
+                for pos in range(winreg.QueryInfoKey(reg)[0]):
+                    names.append(winreg.EnumKey(reg, pos))
+    return names
+
+
+def _snapshot_validators():
+    """What the discovery results in the snapshot depend on: the R-core
+    keys, including the current user's within HKU, and their version
+    subkeys, the profile list and ESRI keys, the libraries found, with
+    their parents for libraries being created, the R homes read, and the
+    environment."""
+    validators = [('environment', name) for name in SNAPSHOT_ENVIRONMENT]
+    hives = [('HKLM', winreg.HKEY_LOCAL_MACHINE, ''),
+             ('HKCU', winreg.HKEY_CURRENT_USER, '')]
+    profiles = snapshot.peek('user_profiles') or {}
+    user = _user()
+    if user in profiles:
+        hives.append(('HKU', winreg.HKEY_USERS, profiles[user][0] + '\\'))
+    for (hive, root_key, prefix) in hives:
+        for r_path in R_REG_PATHS:
+            validators.append(('registry', hive, prefix + r_path))
+            # changing a value within a version subkey, such as its
+            # InstallPath, leaves the write time of the parent as it was
+            for version in _subkeys(root_key, prefix + r_path):
+                validators.append(
+                    ('registry', hive, prefix + r_path + '\\' + version))
+    validators.append(('registry', 'HKLM', PROFILE_LIST_PATH))
+    for (root_key, reg_path) in ESRI_KEYS:
+        hive = 'HKLM' if root_key == winreg.HKEY_LOCAL_MACHINE else 'HKCU'
+        validators.append(('registry', hive, reg_path))
+
+    directories = []
+    for library in (snapshot.peek('r_all_lib_paths') or []) + \
+            [snapshot.peek('r_user_lib_path')]:
+        if library:
+            directories.extend((library, os.path.dirname(library)))
+    directories.extend(snapshot.peek('r_home_version') or {})
+    for directory in sorted(set(directories)):
+        validators.append(('directory', directory))
+    return validators
+
+
+probe.on_invalidate(_clear_caches)
+probe.on_invalidate(snapshot.reset)
+snapshot.set_provider(_snapshot_validators)
+
+
+def arcgis_install_info():
+    """ArcGIS installation details, as from arcpy.GetInstallInfo(). Uses
+       rtools.config.ARCGIS_INSTALL_INFO when set, then arcpy if the host
+       process has loaded it, then the products registered on this
+       machine, preferring ArcGIS Pro. Only imports arcpy, which is slow
+       and requires a licensed ArcGIS, as a last resort.
+
+       Returns: dictionary with 'InstallDir', 'Version' and 'ProductName',
+       or None if the details aren't available."""
+    info = config.ARCGIS_INSTALL_INFO
+    if info is None and 'arcpy' in sys.modules:
+        # running within ArcGIS, which knows the product in use
+        info = sys.modules['arcpy'].GetInstallInfo()
+    if info is None:
+        products = arcgis_products()
+        pro = [record for record in products if record.product == 'Pro']
+        for record in pro or products:
+            info = {'ProductName': record.product_name,
+                    'Version': record.version,
+                    'InstallDir': record.install_dir}
+            break
+    if info is None and config.ALLOW_ARCPY:
+        try:
+            import arcpy
+            info = arcpy.GetInstallInfo()
+        except ImportError as error:
+            log_exception(error)
+    return info
+
+
+def _arcmap_products(version=None):
+    """Installed ArcMap products, optionally only those of a release such
+    as '10.3', which includes 10.3.1."""
+    release = parse_version(version)
+    records = []
+    for record in arcgis_products():
+        if record.product != 'ArcMap':
+            continue
+        if release is not None:
+            record_version = parse_version(record.version)
+            prefix = release.numbers
+            if record_version is None or \
+                    record_version.numbers[0:len(prefix)] != prefix:
+                continue
+        records.append(record)
+    return records
 
-    root_key = winreg.HKEY_LOCAL_MACHINE
-    for ver in releases:
-        package_key = "Desktop{}".format(ver)
-        arc_reg_paths = [
-            "SOFTWARE\\ESRI\\{}".format(package_key),
-            "SOFTWARE\\Wow6432Node\\ESRI\\{}".format(package_key)
-        ]
-
-        arcmap_reg = None
-        for reg_path in arc_reg_paths:
-            try:
-                # find the key, 64- or 32-bit we want it all
-                arcmap_reg = winreg.OpenKey(
-                    root_key, reg_path, 0, READ_ACCESS)
-            except fnf_exception as error:
-                handle_fnf(error)
 
-            if arcmap_reg:
-                try:
-                    # returns a tuple of (value, type)
-                    arcmap_path_key = winreg.QueryValueEx(arcmap_reg, "InstallDir")
-                    arcmap_path_raw = arcmap_path_key[0]
-                    if os.path.exists(arcmap_path_raw):
-                        arcmap_path = arcmap_path_raw.strip('\\')
-                except fnf_exception as error:
-                    handle_fnf(error)
+def arcmap_exists(version=None):
+    """Check for the existence of the specified version of ArcMap.
+
+    Returns: True or False"""
+    if not version:
+        version = "10.3"
+    return len(_arcmap_products(version)) > 0
 
+
+def arcmap_path(version=None):
+    """Path to ArcGIS Installation. By default, looks up the most recent
+       ArcGIS Desktop installed, or can optionally check only a specific
+       release passed with the **version** keyword.
+
+       Returns: path of installed ArcGIS Desktop installation."""
+    arcmap_path = None
+    records = _arcmap_products(version)
+    if records:
+        arcmap_path = records[0].install_dir
     return arcmap_path
@@ -0,0 +1,282 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import winreg
+except ImportError:
+    # py 2
+    import _winreg as winreg
+
+from . import config
+from . import probe
+from .utils import user_data_dir
+
+# Discovery results shared between processes.
+#
+# The toolbox, the command line and scheduled tasks each start without
+# any of the registry walks and filesystem checks done by the last one.
+# Their results are kept in a per-user snapshot file, along with
+# validators: the last write times of the registry keys they were read
+# from, the modification times of the directories involved, and the
+# environment variables that steer discovery. A new process checks the
+# validators, a handful of calls, and reuses the snapshot when none
+# changed. Any change discards the whole snapshot.
+#
+# Validators are captured when a lookup first misses the snapshot, before
+# its value is computed, so a change made meanwhile is recorded as one.
+# Those only known from the results, such as the libraries found, are
+# captured as the values are recorded. Within a `batch`, such as a
+# discovery pass, the snapshot is written once at the end.
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_NAME = 'discovery.json'
+FORMAT = 3
+
+# seconds between checks of the validators within a process, unless a
+# change watcher is running, see rtools.watch
+REVALIDATE_INTERVAL = 2.0
+
+HIVES = {'HKLM': winreg.HKEY_LOCAL_MACHINE,
+         'HKCU': winreg.HKEY_CURRENT_USER,
+         'HKU': winreg.HKEY_USERS}
+
+# returned by get() for values not in the snapshot
+MISSING = object()
+
+_clock = getattr(time, 'monotonic', time.time)
+_lock = threading.RLock()
+# name: value, None until loaded
+_values = None
+# [(validator, state)] the values were recorded with
+_validators = []
+_checked = 0
+# function returning the validators of the current values
+_provider = None
+# validator: state, captured before the values being looked up were
+# computed
+_captured = {}
+# batch depth and pending writes, per thread
+_local = threading.local()
+
+
+def snapshot_path():
+    """File holding the snapshot: config.DISCOVERY_SNAPSHOT_FILE, or
+    discovery.json in the user's local application data."""
+    if config.DISCOVERY_SNAPSHOT_FILE:
+        return config.DISCOVERY_SNAPSHOT_FILE
+    return os.path.join(user_data_dir(), SNAPSHOT_NAME)
+
+
+def _key_time(hive, path):
+    try:
+        key = winreg.OpenKey(HIVES[hive], path, 0,
+                             winreg.KEY_READ | winreg.KEY_WOW64_64KEY)
+    except (OSError, KeyError):
+        return None
+    try:
+        return winreg.QueryInfoKey(key)[2]
+    finally:
+        winreg.CloseKey(key)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, ValueError):
+        return None
+
+
+def state(validator):
+    """Current state of a validator, one of ['registry', hive, path],
+    ['directory', path] or ['environment', name].
+
+    Returns: last write time, modification time or value, None when the
+    key, directory or variable doesn't exist."""
+    kind = validator[0]
+    if kind == 'registry':
+        return _key_time(validator[1], validator[2])
+    if kind == 'directory':
+        return _mtime(validator[1])
+    if kind == 'environment':
+        return os.environ.get(validator[1])
+    return None
+
+
+def _unchanged(validators):
+    for (validator, recorded) in validators:
+        if state(validator) != recorded:
+            log.debug("Discovery snapshot is stale: %s", validator)
+            return False
+    return True
+
+
+def set_provider(provider):
+    """Set the function listing the validators of the values in the
+    snapshot, called before values are looked up and as they are
+    recorded."""
+    global _provider
+    _provider = provider
+
+
+def _load():
+    global _values, _validators, _checked
+    _values = {}
+    _validators = []
+    _checked = _clock()
+    try:
+        with open(snapshot_path()) as f:
+            record = json.load(f)
+    except (IOError, OSError, ValueError):
+        return
+    if not isinstance(record, dict) or record.get('format') != FORMAT:
+        return
+    validators = [(tuple(validator), recorded) for (validator, recorded)
+                  in record.get('validators') or []]
+    if validators and _unchanged(validators):
+        _values = record.get('values') or {}
+        _validators = validators
+
+
+def _ensure_loaded():
+    global _values, _checked
+    if _values is None:
+        _load()
+    elif _clock() - _checked >= REVALIDATE_INTERVAL and \
+            probe._watcher is None:
+        _checked = _clock()
+        if not _unchanged(_validators):
+            _values = {}
+            _validators[:] = []
+
+
+def get(name, key=None):
+    """A value recorded in the snapshot, by **name**, and **key** for
+    values recorded per key.
+
+    Returns: the value, or MISSING."""
+    if not config.DISCOVERY_SNAPSHOT:
+        return MISSING
+    with _lock:
+        _ensure_loaded()
+        value = _values.get(name, MISSING)
+        if key is not None and value is not MISSING:
+            value = value.get(key, MISSING)
+        if value is MISSING and not _captured:
+            # the caller computes the value next
+            _capture()
+        return value
+
+
+def _capture():
+    if _provider is not None:
+        for validator in _provider():
+            validator = tuple(validator)
+            if validator not in _captured:
+                _captured[validator] = state(validator)
+
+
+def peek(name, default=None):
+    """A value in the snapshot, without loading or checking it. For
+    the validator provider."""
+    with _lock:
+        return (_values or {}).get(name, default)
+
+
+def put(name, value, key=None):
+    """Record a value in the snapshot, and write it out with the state of
+    its validators, at the end of the batch when within one."""
+    if not config.DISCOVERY_SNAPSHOT:
+        return
+    with _lock:
+        _ensure_loaded()
+        if key is None:
+            _values[name] = value
+        else:
+            _values.setdefault(name, {})[key] = value
+        if getattr(_local, 'depth', 0):
+            _local.pending = True
+        else:
+            _flush()
+
+
+@contextmanager
+def batch():
+    """Record the values looked up within a with block together: their
+    validators are checked, and the snapshot written, once on the way
+    out rather than as each value is recorded."""
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+        if not _local.depth and getattr(_local, 'pending', False):
+            _local.pending = False
+            if config.DISCOVERY_SNAPSHOT:
+                with _lock:
+                    if _values is not None:
+                        _flush()
+
+
+def _flush():
+    validators = []
+    for validator in (_provider() if _provider is not None else []):
+        validator = tuple(validator)
+        if validator in _captured:
+            validators.append((validator, _captured[validator]))
+        else:
+            validators.append((validator, state(validator)))
+    _validators[:] = validators
+    _captured.clear()
+    _write()
+
+
+def _write():
+    path = snapshot_path()
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    record = {'format': FORMAT, 'written': time.time(),
+              'validators': [[list(validator), recorded]
+                             for (validator, recorded) in _validators],
+              'values': _values}
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(temp_path, 'w') as f:
+            json.dump(record, f)
+        # replace atomically, so concurrent readers see either snapshot
+        replace = getattr(os, 'replace', None)
+        if replace is None:
+            # py 2 can't rename over an existing file on Windows
+            if os.path.exists(path):
+                os.remove(path)
+            replace = os.rename
+        replace(temp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("Unable to write the discovery snapshot: %s", e)
+
+
+def reset():
+    """Forget the values loaded in this process, so the next lookup
+    checks the snapshot file again, e.g. after an install."""
+    global _values
+    with _lock:
+        _values = None
+        _captured.clear()
+
+
+def clear():
+    """Discard the snapshot, in this process and on disk."""
+    reset()
+    try:
+        os.remove(snapshot_path())
+    except OSError:
+        pass
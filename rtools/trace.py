@@ -0,0 +1,164 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+from . import config
+
+# monotonic clock where available (Python 3), in seconds
+_clock = getattr(time, 'perf_counter', time.time)
+
+_enabled = bool(config.TRACING or os.environ.get('RTOOLS_TRACE'))
+_events = []
+_local = threading.local()
+_epoch = _clock()
+
+
+def enable(enabled=True):
+    """Turn span recording on or off."""
+    global _enabled
+    _enabled = enabled
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    """Drop all recorded spans."""
+    del _events[:]
+
+
+class _NullSpan(object):
+    """Stands in for a span when tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.children = 0.0
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *exc):
+        duration = _clock() - self.start
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].children += duration
+        event = {
+            'name': self.name,
+            'ph': 'X',
+            'ts': (self.start - _epoch) * 1e6,
+            'dur': duration * 1e6,
+            'self': (duration - self.children) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+        }
+        if self.args:
+            event['args'] = self.args
+        _events.append(event)
+        return False
+
+
+def span(name, **args):
+    """A timed span, used as a context manager. Spans opened within
+    another span on the same thread are nested under it.
+
+        with span('download', url=url):
+            ...
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name=None, args=False):
+    """Decorate a function to record a span for each call.
+
+    Parameters
+    ----------
+    name: str, span name. Defaults to the function name.
+    args: bool, record the positional arguments of each call.
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*a, **kw):
+            if not _enabled:
+                return func(*a, **kw)
+            span_args = None
+            if args and a:
+                span_args = {'args': [repr(arg) for arg in a]}
+            with _Span(label, span_args):
+                return func(*a, **kw)
+        return wrapper
+    return decorator
+
+
+def events():
+    """Recorded spans, as Chrome trace-event dictionaries."""
+    return list(_events)
+
+
+def write_chrome_trace(path):
+    """Write the recorded spans in the Chrome trace-event format, which
+    can be loaded in chrome://tracing or Perfetto."""
+    trace_events = []
+    for event in events():
+        event = dict(event)
+        del event['self']
+        trace_events.append(event)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events,
+                   'displayTimeUnit': 'ms'}, f)
+
+
+def summary():
+    """Summarize the recorded spans by name, slowest total first.
+
+    Returns: list of lines, a table of call counts and total, self
+    (excluding nested spans) and maximum times in milliseconds."""
+    totals = {}
+    for event in events():
+        (calls, total, self_time, longest) = totals.get(
+            event['name'], (0, 0.0, 0.0, 0.0))
+        totals[event['name']] = (calls + 1, total + event['dur'],
+                                 self_time + event['self'],
+                                 max(longest, event['dur']))
+    lines = ["{:<32} {:>6} {:>10} {:>10} {:>10}".format(
+        'span', 'calls', 'total ms', 'self ms', 'max ms')]
+    for (name, (calls, total, self_time, longest)) in sorted(
+            totals.items(), key=lambda item: -item[1][1]):
+        lines.append("{:<32} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name, calls, total / 1e3, self_time / 1e3, longest / 1e3))
+    return lines
+
+
+if os.environ.get('RTOOLS_TRACE'):
+    atexit.register(write_chrome_trace, os.environ['RTOOLS_TRACE'])
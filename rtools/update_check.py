@@ -0,0 +1,191 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import threading
+import time
+
+from . import config
+from .compat import parse_version
+from .github_release import release_info
+from .messages import buffered
+from .utils import user_data_dir
+
+log = logging.getLogger(__name__)
+
+CACHE_NAME = 'latest-release.json'
+
+_refresh_lock = threading.Lock()
+_refresh_thread = None
+_schedule_thread = None
+
+
+def cache_path():
+    """File holding the latest known release: config.UPDATE_CHECK_FILE,
+    or latest-release.json in the user's local application data."""
+    if config.UPDATE_CHECK_FILE:
+        return config.UPDATE_CHECK_FILE
+    return os.path.join(user_data_dir(), CACHE_NAME)
+
+
+def cached_release():
+    """The latest release recorded by a previous check.
+
+    Returns: dictionary with 'tag', 'download_url' and 'checked', the
+    time of the check in seconds since the epoch, or None."""
+    try:
+        with open(cache_path()) as f:
+            record = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(record, dict) or not record.get('tag'):
+        return None
+    return record
+
+
+def record_release(release):
+    """Persist a (download_url, tag_name) release as the latest known one.
+    Releases without a tag, from failed lookups, aren't recorded.
+
+    Returns: the record written, or None."""
+    (download_url, tag) = release
+    if not tag:
+        return None
+    record = {'tag': tag, 'download_url': download_url,
+              'checked': time.time()}
+    path = cache_path()
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(temp_path, 'w') as f:
+            json.dump(record, f)
+        # replace atomically, so concurrent readers see either record
+        replace = getattr(os, 'replace', None)
+        if replace is None:
+            # py 2 can't rename over an existing file on Windows
+            if os.path.exists(path):
+                os.remove(path)
+            replace = os.rename
+        replace(temp_path, path)
+    except (IOError, OSError):
+        return None
+    return record
+
+
+def is_fresh(record, max_age=None):
+    """Whether a release record was checked within max_age seconds,
+    config.UPDATE_CHECK_INTERVAL by default."""
+    if max_age is None:
+        max_age = config.UPDATE_CHECK_INTERVAL
+    return record is not None and \
+        time.time() - record.get('checked', 0) < max_age
+
+
+def refresh():
+    """Look up the latest release on GitHub now, and record it.
+
+    Returns: the new record, or the previous one if the lookup failed."""
+    return record_release(release_info()) or cached_release()
+
+
+def _refresh_worker():
+    # a background check mustn't send messages to arcpy from its thread,
+    # nor long after the tool that started it finished: log them instead
+    with buffered() as held:
+        try:
+            refresh()
+        except Exception:
+            # the next check will try again
+            log.debug("Background release check failed", exc_info=True)
+    for (level, msg) in held:
+        log.debug("Background release check %s: %s", level, msg)
+
+
+def refresh_in_background():
+    """Start a refresh on a daemon thread, unless one is running.
+
+    Returns: the refresh thread."""
+    global _refresh_thread
+    with _refresh_lock:
+        if _refresh_thread is None or not _refresh_thread.is_alive():
+            _refresh_thread = threading.Thread(target=_refresh_worker)
+            _refresh_thread.daemon = True
+            _refresh_thread.start()
+        return _refresh_thread
+
+
+def schedule(interval=None):
+    """Keep the recorded release fresh from a daemon thread, checking
+    whenever the record is older than **interval** seconds,
+    config.UPDATE_CHECK_INTERVAL by default. Only one schedule runs per
+    process."""
+    global _schedule_thread
+    if interval is None:
+        interval = config.UPDATE_CHECK_INTERVAL
+
+    def run():
+        while True:
+            record = cached_release()
+            if not is_fresh(record, interval):
+                _refresh_worker()
+                record = cached_release()
+            checked = record.get('checked', 0) if record else time.time()
+            # wake when the record goes stale, and at least hourly so a
+            # failed check is retried
+            time.sleep(max(60, min(3600, checked + interval - time.time())))
+
+    with _refresh_lock:
+        if _schedule_thread is None or not _schedule_thread.is_alive():
+            _schedule_thread = threading.Thread(target=run)
+            _schedule_thread.daemon = True
+            _schedule_thread.start()
+
+
+def latest_release(max_age=None, wait=True):
+    """The latest release, from the record when it is fresh.
+
+    Parameters
+    ----------
+    max_age: int, seconds a record is trusted for, defaults to
+             config.UPDATE_CHECK_INTERVAL.
+    wait: bool, when the record is stale, wait for a lookup. Otherwise
+          return the stale record, or None, and refresh in the background.
+
+    Returns
+    -------
+    dictionary with 'tag', 'download_url' and 'checked', or None.
+    """
+    record = cached_release()
+    if is_fresh(record, max_age):
+        return record
+    if not wait:
+        refresh_in_background()
+        return record
+    thread = _refresh_thread
+    if thread is not None and thread.is_alive():
+        # a check is under way, share its result
+        thread.join()
+        record = cached_release()
+        if is_fresh(record, max_age):
+            return record
+    return refresh()
+
+
+def newer_available(installed, max_age=None, wait=True):
+    """Compare an installed package version with the latest release.
+
+    Returns: (newer, record) tuple, newer is None when either version is
+    unknown, record as from `latest_release`."""
+    record = latest_release(max_age, wait)
+    newer = None
+    if record is not None:
+        latest = parse_version(record['tag'])
+        current = parse_version(installed)
+        if latest is not None and current is not None:
+            newer = latest > current
+    return (newer, record)
@@ -3,41 +3,87 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 
-import arcpy
-
-from .github_release import release_info
+from . import versions
 from .install_package import install_package, validate_environment
+from .lock import install_lock, record_install
+from .messages import add_error, add_message, add_warning
 from .rpath import r_lib_path, r_pkg_version
-from .utils import versiontuple
+from .update_check import newer_available
 
 
 def compare_release_versions():
-    newer_available = False
-    (url, tag) = release_info()
-    release = tag.strip('v')
-
-    if versiontuple(release) > versiontuple(r_pkg_version()):
-        newer_available = True
-    return newer_available
+    """Whether a newer release than the installed package exists, from
+    the recorded release when it was checked recently."""
+    (newer, record) = newer_available(r_pkg_version())
+    if record is None:
+        add_warning("Unable to get current release information.")
+    return bool(newer)
 
 
-def update_package(r_library_path=r_lib_path()):
+def update_package(r_library_path=None):
     """Update ArcGIS R bindings on this machine."""
+    if r_library_path is None:
+        r_library_path = r_lib_path()
 
     # check that we're in a sane installation environment
     validate_environment(overwrite=True)
 
     if r_pkg_version() is None:
-        arcpy.AddWarning(
+        add_warning(
             "Package is not installed. First use the \"Install R bindings\" script.")
     else:
         if compare_release_versions():
-            arcpy.AddMessage("New release detected! Installing.")
+            add_message("New release detected! Installing.")
             install_package(overwrite=True, r_library_path=r_library_path)
         else:
             msg = "The installed ArcGIS R package (version " + \
                   "{}) is the current version on GitHub.".format(r_pkg_version())
-            arcpy.AddMessage(msg)
+            add_message(msg)
+
+
+def rollback_package(r_library_path=None, version=None):
+    """Switch ArcGIS R bindings back to the version installed before the
+    current one, or to another version kept side by side, without
+    downloading or installing anything.
+
+    Parameters
+    ----------
+    r_library_path: str, library holding the package. Defaults to the
+                    highest-priority library.
+    version: str, version to switch to, defaults to the previous one.
+
+    Returns
+    -------
+    str, the version now active, or None if there was nothing to roll
+    back to.
+    """
+    if r_library_path is None:
+        r_library_path = r_lib_path()
+    if versions.active_version(r_library_path) is None:
+        add_warning("The package isn't installed side by side in {}, "
+                    "there are no earlier versions to roll back to.".format(
+                        r_library_path))
+        return None
+
+    restored = None
+    with install_lock(r_library_path) as lock_state:
+        if lock_state['timed_out']:
+            return None
+        try:
+            restored = versions.rollback(r_library_path, version)
+        except ValueError as e:
+            add_error(str(e))
+            return None
+        if restored is not None:
+            record_install(r_library_path, restored)
+
+    if restored is None:
+        add_warning("No earlier version to roll back to, installed "
+                    "versions: {}.".format(
+                        ", ".join(versions.installed_versions(r_library_path))))
+    else:
+        add_message("Rolled back to version {}.".format(restored))
+    return restored
 
 # execute as standalone script, get parameters from sys.argv
 if __name__ == '__main__':
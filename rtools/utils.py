@@ -6,6 +6,9 @@ import shutil
 import sys
 import tempfile
 import textwrap
+import threading
+
+from .compat import parse_version
 
 
 def platform():
@@ -26,9 +29,12 @@ def dedent(text, ending='\r\n'):
 
 
 def versiontuple(v):
+    """Sortable key for a version string, tolerating suffixes such as
+    '3.2.4revised'. See `rtools.compat.Version`."""
     res = None
-    if v is not None:
-        res = tuple(map(int, (v.split("."))))
+    version = parse_version(v)
+    if version is not None:
+        res = version.key
     return res
 
 
@@ -70,3 +76,104 @@ def set_env_tmpdir(path=None):
         os.putenv("TMPDIR", path)
 
     return path
+
+
+@contextlib.contextmanager
+def r_tmpdir():
+    """Set an R-compatible TMPDIR, see `set_env_tmpdir`, for the duration
+    of a with block when it isn't set already, and return it to its
+    original value on the way out; it's only needed for running R."""
+    orig_tmpdir = os.getenv("TMPDIR")
+    if not orig_tmpdir:
+        set_env_tmpdir()
+    try:
+        yield
+    finally:
+        if orig_tmpdir:
+            set_env_tmpdir(orig_tmpdir)
+        elif hasattr(os, 'unsetenv'):
+            os.unsetenv("TMPDIR")
+        else:
+            # an empty value removes the variable on Windows
+            os.putenv("TMPDIR", "")
+
+
+def user_data_dir():
+    """Per-user directory for rtools state, such as the latest known
+    release: %LOCALAPPDATA%\\rtools, or rtools in the temporary directory
+    when that isn't set."""
+    base = os.environ.get('LOCALAPPDATA') or tempfile.gettempdir()
+    return os.path.join(base, 'rtools')
+
+
+def parallel_map(func, items, workers=4):
+    """Apply a function to each item using a small pool of threads.
+
+    Parameters
+    ----------
+    func: callable, called once per item.
+    items: iterable, inputs to func.
+    workers: int, maximum number of concurrent threads.
+
+    Returns
+    -------
+    list, results of func in the same order as items. If any call raised,
+    the first exception is re-raised once all items have finished.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    positions = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                pos = next(positions, None)
+            if pos is None:
+                return
+            try:
+                results[pos] = func(items[pos])
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+class BackgroundCall(object):
+    """Run a function on a daemon thread, and collect its result later."""
+
+    def __init__(self, func, *args, **kwargs):
+        self._value = None
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._value = func(*args, **kwargs)
+        except Exception as e:
+            self._error = e
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish, and return its value. Exceptions
+        raised by the call are re-raised here."""
+        self._thread.join(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._value
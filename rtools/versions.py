@@ -0,0 +1,246 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+
+from . import config
+from .compat import parse_version
+from .fs import create_dir_link, is_dir_link, links_supported, remove_dir_link
+from .integrity import MANIFEST_NAME, read_manifest
+from .probe import invalidate
+from .rpath import package_description_version
+
+# Side by side installs: each version of the package is installed into its
+# own directory in a store within the library,
+#
+#   <library>/.arcgisbinding-versions/<version>/arcgisbinding
+#
+# and <library>/arcgisbinding is a directory link to the active one. An
+# update or rollback to a version in the store only replaces the link.
+
+PACKAGE_NAME = 'arcgisbinding'
+STORE_NAME = '.{}-versions'.format(PACKAGE_NAME)
+STATE_NAME = 'versions.json'
+STAGING_PREFIX = '.staging-'
+
+
+def store_dir(library):
+    return os.path.join(library, STORE_NAME)
+
+
+def _version_dir(library, version):
+    return os.path.join(store_dir(library), version, PACKAGE_NAME)
+
+
+def _read_state(library):
+    try:
+        with open(os.path.join(store_dir(library), STATE_NAME)) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        state = {}
+    state.setdefault('active', None)
+    state.setdefault('history', [])
+    return state
+
+
+def _write_state(library, state):
+    with open(os.path.join(store_dir(library), STATE_NAME), 'w') as f:
+        json.dump(state, f, indent=1)
+
+
+def enabled(library):
+    """Whether installs into a library are kept side by side, see
+    config.VERSIONED_INSTALLS, or already are. Needs a volume supporting
+    directory links.
+    """
+    if not library:
+        return False
+    # installing in place would write through the link into the store
+    return bool((config.VERSIONED_INSTALLS or
+                 active_version(library) is not None) and
+                links_supported(library))
+
+
+def installed_versions(library):
+    """Versions in the store of a library, newest first."""
+    try:
+        names = os.listdir(store_dir(library))
+    except OSError:
+        return []
+    versions = [name for name in names if not name.startswith('.') and
+                os.path.isdir(_version_dir(library, name))]
+    unknown = parse_version('0')
+    return sorted(versions, key=lambda v: parse_version(v) or unknown,
+                  reverse=True)
+
+
+def active_version(library):
+    """The version the package link of a library points to.
+
+    Returns: version string, or None when the package isn't installed side
+    by side."""
+    if not is_dir_link(os.path.join(library, PACKAGE_NAME)):
+        return None
+    return _read_state(library)['active']
+
+
+def staging_dir(library):
+    """A new directory within the store to install a version into, as an
+    R library. Being on the same volume, it is moved into place by
+    `commit_staged` with a rename."""
+    store = store_dir(library)
+    if not os.path.exists(store):
+        os.makedirs(store)
+    return tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=store)
+
+
+def commit_staged(library, staging):
+    """Move a package installed into a staging directory into the store.
+
+    Returns: the version installed, or None if the staging directory
+    doesn't hold the package, in which case it is removed."""
+    staged = os.path.join(staging, PACKAGE_NAME)
+    version = None
+    if os.path.isdir(staged):
+        version = package_description_version(staged)
+    if version is None:
+        shutil.rmtree(staging, ignore_errors=True)
+        return None
+
+    target = os.path.join(store_dir(library), version)
+    if os.path.exists(target):
+        # reinstalling a version: swap the directories, so a link to it
+        # is only dangling between two renames
+        old = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=store_dir(library))
+        os.rmdir(old)
+        os.rename(target, old)
+        os.rename(staging, target)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.rename(staging, target)
+    return version
+
+
+def _swap_manifest(library, previous, version):
+    """Keep the manifest of the installed files with the version it
+    describes, and restore the one of the version being activated."""
+    library_manifest = os.path.join(library, MANIFEST_NAME)
+    manifest = read_manifest(library)
+    if previous and manifest is not None and \
+            manifest.get('version') == previous:
+        shutil.copyfile(library_manifest, os.path.join(
+            store_dir(library), previous, MANIFEST_NAME))
+    stored = os.path.join(store_dir(library), version, MANIFEST_NAME)
+    if os.path.exists(stored):
+        shutil.copyfile(stored, library_manifest)
+    elif manifest is not None and manifest.get('version') != version:
+        os.remove(library_manifest)
+
+
+def _adopt(library, state):
+    """Move a package installed in place into the store, so it can be
+    rolled back to."""
+    package_dir = os.path.join(library, PACKAGE_NAME)
+    version = package_description_version(package_dir) or 'unknown'
+    target = _version_dir(library, version)
+    if os.path.exists(target):
+        shutil.rmtree(package_dir)
+    else:
+        os.makedirs(os.path.dirname(target))
+        os.rename(package_dir, target)
+    if version not in state['history']:
+        state['history'].insert(0, version)
+
+
+def activate(library, version, record=True):
+    """Point the package link of a library at a version in its store.
+
+    Parameters
+    ----------
+    library: str, R library.
+    version: str, version in the store.
+    record: bool, make this the most recent version in the history that
+            `rollback` steps back through.
+    """
+    target = _version_dir(library, version)
+    if not os.path.isdir(target):
+        raise ValueError("Version {} isn't installed in {}.".format(
+            version, library))
+    state = _read_state(library)
+    link = os.path.join(library, PACKAGE_NAME)
+    if os.path.isdir(link) and not is_dir_link(link):
+        _adopt(library, state)
+
+    temp_link = os.path.join(
+        library, '.{}-link-{}'.format(PACKAGE_NAME, os.getpid()))
+    if is_dir_link(temp_link):
+        remove_dir_link(temp_link)
+    create_dir_link(temp_link, target)
+    if is_dir_link(link):
+        if os.name == 'nt':
+            # rename can't replace a link on Windows
+            remove_dir_link(link)
+        # elsewhere, rename replaces the link atomically
+    os.rename(temp_link, link)
+
+    _swap_manifest(library, state['active'], version)
+    state['active'] = version
+    if record:
+        if version in state['history']:
+            state['history'].remove(version)
+        state['history'].append(version)
+    _write_state(library, state)
+    invalidate()
+
+
+def rollback(library, version=None):
+    """Switch back to the version active before the current one, or to
+    a given version in the store.
+
+    Returns: the version now active, or None if there is nothing to roll
+    back to."""
+    if version is None:
+        state = _read_state(library)
+        available = set(installed_versions(library))
+        history = [v for v in state['history'] if v in available]
+        if state['active'] in history:
+            history = history[:history.index(state['active'])]
+        if not history:
+            return None
+        version = history[-1]
+    activate(library, version, record=False)
+    return version
+
+
+def prune(library, keep=None):
+    """Remove old versions from the store, keeping the active version and
+    the most recently activated ones, **keep** in all, by default
+    config.KEEP_VERSIONS.
+
+    Returns: list of versions removed."""
+    if keep is None:
+        keep = config.KEEP_VERSIONS
+    state = _read_state(library)
+    installed = installed_versions(library)
+    # most recently activated first, then any others, newest first
+    order = [v for v in reversed(state['history']) if v in installed]
+    order += [v for v in installed if v not in order]
+    kept = set(order[:max(keep, 1)])
+    if state['active']:
+        kept.add(state['active'])
+
+    removed = []
+    for version in order:
+        if version not in kept:
+            shutil.rmtree(os.path.join(store_dir(library), version),
+                          ignore_errors=True)
+            removed.append(version)
+    if removed:
+        state['history'] = [v for v in state['history'] if v not in removed]
+        _write_state(library, state)
+    return removed
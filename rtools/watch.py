@@ -0,0 +1,413 @@
+# Py3 compat layer
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+
+try:
+    import winreg
+except ImportError:
+    # py 2
+    import _winreg as winreg
+
+from . import config
+from . import probe
+
+# Change watching for discovery caches.
+#
+# Discovery results depend on the R-core and ESRI registry keys and on the
+# R homes and library directories. A DiscoveryWatcher follows them, and
+# only drops cached results when one of them changes, so a long-lived
+# ArcGIS Pro session can keep warm results without serving stale ones.
+# On Windows, it waits on change notifications: RegNotifyChangeKeyValue
+# for registry keys, FindFirstChangeNotification for directories. Where
+# those aren't available, it polls key last write times and directory
+# modification times instead.
+
+log = logging.getLogger(__name__)
+
+# registry keys discovery reads, within HKEY_LOCAL_MACHINE and
+# HKEY_CURRENT_USER
+REGISTRY_PATHS = ("SOFTWARE\\R-core",
+                  "SOFTWARE\\Wow6432Node\\R-core",
+                  "SOFTWARE\\ESRI",
+                  "SOFTWARE\\Wow6432Node\\ESRI")
+# levels of subkeys compared when polling: R-core\R\<version>
+POLL_DEPTH = 2
+
+# seconds between polls, when change notifications aren't available
+POLL_INTERVAL = 1.0
+# seconds between checks of change notifications
+NOTIFY_INTERVAL = 0.1
+
+# RegNotifyChangeKeyValue filter: subkeys added or removed, values set,
+# and keep watching after the registering thread exits (Windows 8+)
+REG_NOTIFY_CHANGE_NAME = 0x1
+REG_NOTIFY_CHANGE_LAST_SET = 0x4
+REG_NOTIFY_THREAD_AGNOSTIC = 0x10000000
+# FindFirstChangeNotification filter: entries added, removed or renamed
+FILE_NOTIFY_CHANGE_FILE_NAME = 0x1
+FILE_NOTIFY_CHANGE_DIR_NAME = 0x2
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x10
+WAIT_OBJECT_0 = 0
+INVALID_HANDLE_VALUE = -1
+
+_clock = getattr(time, 'monotonic', time.time)
+_watcher = None
+
+
+def _win32():
+    """kernel32 and advapi32, when change notifications are available.
+
+    Returns: (kernel32, advapi32) tuple, or None."""
+    if os.name != 'nt':
+        return None
+    try:
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.windll.kernel32
+        advapi32 = ctypes.windll.advapi32
+    except (ImportError, AttributeError, OSError):
+        return None
+    kernel32.CreateEventW.restype = wintypes.HANDLE
+    kernel32.FindFirstChangeNotificationW.restype = wintypes.HANDLE
+    kernel32.FindFirstChangeNotificationW.argtypes = [
+        wintypes.LPCWSTR, wintypes.BOOL, wintypes.DWORD]
+    kernel32.WaitForSingleObject.argtypes = [wintypes.HANDLE,
+                                             wintypes.DWORD]
+    for name in ('FindNextChangeNotification',
+                 'FindCloseChangeNotification', 'ResetEvent',
+                 'CloseHandle'):
+        getattr(kernel32, name).argtypes = [wintypes.HANDLE]
+    advapi32.RegNotifyChangeKeyValue.argtypes = [
+        wintypes.HANDLE, wintypes.BOOL, wintypes.DWORD, wintypes.HANDLE,
+        wintypes.BOOL]
+    return (kernel32, advapi32)
+
+
+def _key_state(key, depth):
+    """Last write times of a key and its subkeys, **depth** levels down."""
+    info = winreg.QueryInfoKey(key)
+    state = [info[2]]
+    if depth > 0:
+        for pos in range(info[0]):
+            try:
+                name = winreg.EnumKey(key, pos)
+                subkey = winreg.OpenKey(key, name, 0, winreg.KEY_READ)
+            except OSError:
+                continue
+            try:
+                state.append((name, _key_state(subkey, depth - 1)))
+            finally:
+                winreg.CloseKey(subkey)
+    return state
+
+
+class RegistryWatch(object):
+    """Watch a registry key and its subkeys for changes. A missing key is
+    watched for being created."""
+
+    def __init__(self, root_key, path, win32=None):
+        self.root_key = root_key
+        self.path = path
+        self.win32 = win32
+        self.key = None
+        self.event = None
+        self.state = None
+        self._open()
+
+    def _open(self):
+        access = winreg.KEY_READ | winreg.KEY_WOW64_64KEY
+        if self.win32 is not None:
+            access |= winreg.KEY_NOTIFY
+        try:
+            self.key = winreg.OpenKey(self.root_key, self.path, 0, access)
+        except OSError:
+            self.key = None
+            return
+        if self.win32 is None:
+            self.state = _key_state(self.key, POLL_DEPTH)
+            return
+        (kernel32, _) = self.win32
+        self.event = kernel32.CreateEventW(None, True, False, None)
+        if not self._arm():
+            self._poll()
+
+    def _arm(self):
+        """Ask for the event to be signalled on the next change.
+
+        Returns: whether the notification was registered."""
+        (kernel32, advapi32) = self.win32
+        kernel32.ResetEvent(self.event)
+        error = advapi32.RegNotifyChangeKeyValue(
+            int(self.key), True,
+            REG_NOTIFY_CHANGE_NAME | REG_NOTIFY_CHANGE_LAST_SET |
+            REG_NOTIFY_THREAD_AGNOSTIC, self.event, True)
+        if error:
+            # REG_NOTIFY_THREAD_AGNOSTIC needs Windows 8
+            log.debug("Unable to watch %s for changes, error %d, polling "
+                      "it instead", self.path, error)
+        return not error
+
+    def _poll(self):
+        """Poll the key from now on, rather than wait on notifications."""
+        if self.event is not None:
+            self.win32[0].CloseHandle(self.event)
+            self.event = None
+        self.win32 = None
+        try:
+            self.state = _key_state(self.key, POLL_DEPTH)
+        except OSError:
+            # the key was removed, watch for it being created
+            self.close()
+
+    def changed(self):
+        """Whether the key changed since the last call."""
+        if self.key is None:
+            self._open()
+            return self.key is not None
+        if self.win32 is not None:
+            (kernel32, _) = self.win32
+            if kernel32.WaitForSingleObject(self.event, 0) != WAIT_OBJECT_0:
+                return False
+            if not self._arm():
+                self._poll()
+            return True
+        try:
+            state = _key_state(self.key, POLL_DEPTH)
+        except OSError:
+            # the key was removed
+            self.close()
+            return True
+        if state == self.state:
+            return False
+        self.state = state
+        return True
+
+    def close(self):
+        if self.event is not None:
+            self.win32[0].CloseHandle(self.event)
+            self.event = None
+        if self.key is not None:
+            winreg.CloseKey(self.key)
+            self.key = None
+
+
+def _dir_state(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class DirectoryWatch(object):
+    """Watch a directory for entries being added, removed or renamed. A
+    missing directory is watched for being created."""
+
+    def __init__(self, path, win32=None):
+        self.path = path
+        self.win32 = win32
+        self.handle = None
+        self.state = _dir_state(path)
+        if win32 is not None and self.state is not None:
+            self._open()
+
+    def _open(self):
+        (kernel32, _) = self.win32
+        handle = kernel32.FindFirstChangeNotificationW(
+            self.path, False,
+            FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_DIR_NAME |
+            FILE_NOTIFY_CHANGE_LAST_WRITE)
+        # HANDLE results are unsigned, compare with INVALID_HANDLE_VALUE
+        # as one
+        if not handle or handle == _invalid_handle():
+            self.handle = None
+        else:
+            self.handle = handle
+
+    def changed(self):
+        """Whether the directory changed since the last call."""
+        if self.handle is not None:
+            (kernel32, _) = self.win32
+            if kernel32.WaitForSingleObject(self.handle, 0) != WAIT_OBJECT_0:
+                return False
+            kernel32.FindNextChangeNotification(self.handle)
+            return True
+        state = _dir_state(self.path)
+        if state == self.state:
+            return False
+        self.state = state
+        if self.win32 is not None and state is not None:
+            self._open()
+        return True
+
+    def close(self):
+        if self.handle is not None:
+            self.win32[0].FindCloseChangeNotification(self.handle)
+            self.handle = None
+
+
+def _invalid_handle():
+    from ctypes import wintypes
+    return wintypes.HANDLE(INVALID_HANDLE_VALUE).value
+
+
+def discovery_directories():
+    """Directories discovery results depend on: every library of the
+    current R, R homes registered on the machine and their libraries, the
+    per-user library's parent, and the ArcMap Rintegration directories.
+    Each library's parent is included, to see the library being created.
+
+    Returns: list of normalized paths."""
+    # imported here, rpath uses probe, which uses the watcher
+    from .rpath import (
+        arcgis_products,
+        r_all_lib_paths,
+        r_user_lib_path,
+        r_version_dict,
+    )
+    paths = []
+    for library in r_all_lib_paths():
+        paths.extend((library, os.path.dirname(library)))
+    for r_home in (r_version_dict() or {}).values():
+        if r_home:
+            paths.extend((r_home, os.path.join(r_home, 'library')))
+    user_library = r_user_lib_path()
+    if user_library:
+        paths.append(os.path.dirname(user_library))
+    for record in arcgis_products():
+        if record.product == 'ArcMap':
+            paths.append(record.rintegration_dir)
+
+    unique = []
+    seen = set()
+    for path in paths:
+        key = os.path.normcase(os.path.normpath(path))
+        if key not in seen:
+            seen.add(key)
+            unique.append(os.path.normpath(path))
+    return unique
+
+
+class DiscoveryWatcher(object):
+    """Follows the registry keys and directories discovery reads, and
+    drops the discovery caches when any of them changes. While it runs,
+    cached probes of the watched directories, and of paths up to two
+    levels within them, are trusted for probe.WATCHED_TTL rather than a
+    few seconds.
+
+    Parameters
+    ----------
+    native: bool, use change notifications. Defaults to whether they are
+            available, polling is used otherwise.
+    poll_interval: float, seconds between checks, by default
+                   NOTIFY_INTERVAL with change notifications, otherwise
+                   POLL_INTERVAL.
+    """
+
+    def __init__(self, native=None, poll_interval=None):
+        self.win32 = _win32() if native is not False else None
+        if poll_interval is None:
+            poll_interval = NOTIFY_INTERVAL if self.win32 is not None \
+                else POLL_INTERVAL
+        self.poll_interval = poll_interval
+        self.changes = 0
+        self._lock = threading.Lock()
+        self._next_check = 0
+        self._keys = [RegistryWatch(root_key, path, self.win32)
+                      for root_key in (winreg.HKEY_LOCAL_MACHINE,
+                                       winreg.HKEY_CURRENT_USER)
+                      for path in REGISTRY_PATHS]
+        self._directories = {}
+        self._covered = frozenset()
+        self._watch_directories()
+
+    @property
+    def native(self):
+        return self.win32 is not None
+
+    def _watch_directories(self):
+        paths = discovery_directories()
+        keys = dict((os.path.normcase(path), path) for path in paths)
+        for key in list(self._directories):
+            if key not in keys:
+                self._directories.pop(key).close()
+        for (key, path) in keys.items():
+            if key not in self._directories:
+                self._directories[key] = DirectoryWatch(path, self.win32)
+        self._covered = frozenset(keys)
+
+    def covers(self, path):
+        """Whether changes to a path would be seen: it is a watched
+        directory, or within one, up to two levels down."""
+        key = os.path.normcase(os.path.normpath(path))
+        for _ in range(3):
+            if key in self._covered:
+                return True
+            parent = os.path.dirname(key)
+            if parent == key:
+                break
+            key = parent
+        return False
+
+    def check(self):
+        """Look for changes, dropping the discovery caches if there are
+        any. Checks are skipped within **poll_interval** of the last one,
+        and while another thread is checking.
+
+        Returns: bool, whether anything changed."""
+        if _clock() < self._next_check or \
+                not self._lock.acquire(False):
+            return False
+        try:
+            # every watch is asked, so each one re-arms
+            changed = [watch for watch in self._keys +
+                       list(self._directories.values()) if watch.changed()]
+            if changed:
+                self.changes += 1
+                log.debug("Discovery inputs changed: %s", ", ".join(
+                    getattr(watch, 'path', '') for watch in changed))
+                # dropped first, so the directories are found afresh
+                probe.invalidate()
+                self._watch_directories()
+            self._next_check = _clock() + self.poll_interval
+            return bool(changed)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        for watch in self._keys + list(self._directories.values()):
+            watch.close()
+        self._keys = []
+        self._directories = {}
+        self._covered = frozenset()
+
+
+def start(native=None, poll_interval=None):
+    """Start watching for changes to discovery inputs, see
+    DiscoveryWatcher. Does nothing when config.WATCH_DISCOVERY is off, or
+    a watcher is already running.
+
+    Returns: the DiscoveryWatcher, or None."""
+    global _watcher
+    if not config.WATCH_DISCOVERY:
+        return None
+    if _watcher is None:
+        watcher = DiscoveryWatcher(native, poll_interval)
+        probe.set_watcher(watcher)
+        _watcher = watcher
+    return _watcher
+
+
+def stop():
+    """Stop watching, going back to caching discovery results for a few
+    seconds."""
+    global _watcher
+    if _watcher is not None:
+        probe.set_watcher(None)
+        _watcher.close()
+        _watcher = None